@@ -0,0 +1,833 @@
+# encoding=utf8
+#
+# Downloads the video of a "url" item into the item's WARC, in place of
+# wget-lua. Unlike wget, it can carry on where an interrupted attempt left
+# off, instead of throwing away every byte of a multi-GB flv that it already
+# fetched.
+#
+# This runs in a process of its own, started by the DownloadMedia task in
+# pipeline.py:
+#
+#     python download.py --user-agent ArchiveTeam --warc-header "operator: Archive Team" --checkpoint-dir CHECKPOINT_DIR URL ITEM_DIR WARC_FILE_BASE
+#
+# While it works, it keeps a checkpoint in CHECKPOINT_DIR (the item
+# directory, if there's none). The pipeline gives every item a new item
+# directory, so it hands us one that belongs to the item's name instead,
+# and survives the item failing and the warrior restarting:
+#
+#  * download.warc.gz holds the records that are complete (any redirects on
+#    the way to the video),
+#  * download.partial holds the body of the video response, as far as it
+#    has arrived, and
+#  * download.checkpoint says how much of download.warc.gz is complete,
+#    what the video response looked like (its request, status line and
+#    headers, date and address, and validator), and which byte ranges of
+#    the body are in download.partial.
+#
+# If it gets started again with a checkpoint for the same URL lying around,
+# it asks for the rest of the video with Range requests (and If-Range, so
+# a video that changed in the meantime gets fetched all over again). With
+# --connections, a big video is fetched as that many ranges at once in the
+# first place, which gets a lot more out of a high-latency link than a
+# single connection does. When the body is complete (and matches the MD5
+# the server gave for it, if any), it's stitched together with the head of
+# the original response into a single response record, exactly as if the
+# whole thing had come in one go; a metadata record lists the requests it
+# took. All of that goes into ITEM_DIR/%(warc_file_base)s.warc.gz, after a
+# warcinfo record that names that file (whatever the attempt that started
+# the download called it), and the checkpoint goes.
+#
+# With --segment-size, a video bigger than that is cut into WARC files of
+# about that size instead, %(warc_file_base)s-00001.warc.gz and on, so that
+# they can be uploaded (and deleted) while the rest is still coming in. The
+# first one has the response record, with as much of the body as fits, and
+# every other one a continuation record with the next piece; they're
+# written as soon as their piece of the body is in, and the log goes in the
+# last one. A video that does fit makes %(warc_file_base)s-00001.warc.gz.
+# Segments are part of the checkpoint: they're written to CHECKPOINT_DIR,
+# for the pipeline to upload from there, and keep the name they started
+# out with.
+import argparse
+import base64
+import hashlib
+import httplib
+import json
+import glob
+import os
+import Queue
+import re
+import sys
+import threading
+import time
+import urlparse
+import uuid
+
+# for writing warc records
+import warc
+# the streaming record writers of the post-processing
+from postprocess import ParallelGzipWriter, write_record_header, \
+    finish_record, WARC_CHUNK_SIZE
+
+
+###########################################################################
+# Checkpoint.
+
+CHECKPOINT_NAME = "download.checkpoint"
+PARTIAL_BODY_NAME = "download.partial"
+PARTIAL_WARC_NAME = "download.warc.gz"
+
+# The checkpoint is brought up to date every this many bytes of body.
+CHECKPOINT_INTERVAL = 16 * 1024 * 1024
+
+# The WARCs of segments are named like this.
+SEGMENT_PATTERN = "*-[0-9][0-9][0-9][0-9][0-9].warc.gz"
+
+
+def read_checkpoint():
+    try:
+        with open(CHECKPOINT_NAME) as checkpoint_file:
+            return json.load(checkpoint_file, object_hook=byte_strings)
+    except (IOError, ValueError):
+        return None
+
+
+def byte_strings(obj):
+    # json gives us unicode; the warc library wants byte strings.
+    for key, value in obj.items():
+        if isinstance(value, unicode):
+            obj[key] = value.encode("utf-8")
+        elif isinstance(value, list):
+            obj[key] = [v.encode("utf-8") if isinstance(v, unicode) else v
+                for v in value]
+    return obj
+
+
+def write_checkpoint(checkpoint):
+    # Replaces the checkpoint in one go, so a crash leaves either the old
+    # one or the new one.
+    with open(CHECKPOINT_NAME + ".tmp", "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.rename(CHECKPOINT_NAME + ".tmp", CHECKPOINT_NAME)
+
+
+def remove_checkpoint():
+    for filename in [CHECKPOINT_NAME, PARTIAL_BODY_NAME, PARTIAL_WARC_NAME] + \
+            glob.glob(PARTIAL_BODY_NAME + ".*"):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+###########################################################################
+# HTTP.
+
+# Seconds to wait on the server.
+TIMEOUT = 60
+
+# Give up after this many redirects.
+MAX_REDIRECTS = 10
+
+# A big video is fetched as this many byte ranges at once, on connections
+# of their own, but no range is made smaller than PARALLEL_MIN_PART_SIZE.
+DOWNLOAD_CONNECTIONS = 1
+PARALLEL_MIN_PART_SIZE = 16 * 1024 * 1024
+
+# Videos bigger than this many bytes are cut into WARCs of this size (well,
+# their bodies are); 0 means one WARC, however big.
+SEGMENT_SIZE = 0
+
+
+def http_get(url, user_agent, extra_headers=()):
+    # Sends a GET request for `url`. Returns the request as it was sent, the
+    # response (with the body still to be read) and the server's address.
+    #
+    # The request is put together by hand rather than by httplib, so that
+    # the request record has exactly the bytes that went over the wire.
+    parts = urlparse.urlsplit(url)
+    if parts.scheme == "https":
+        connection = httplib.HTTPSConnection(parts.netloc, timeout=TIMEOUT)
+    else:
+        connection = httplib.HTTPConnection(parts.netloc, timeout=TIMEOUT)
+    connection.connect()
+
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    request = "GET %s HTTP/1.1\r\n" % path
+    request += "User-Agent: %s\r\n" % user_agent
+    request += "Accept: */*\r\n"
+    request += "Host: %s\r\n" % parts.netloc
+    request += "Connection: close\r\n"
+    for name, value in extra_headers:
+        request += "%s: %s\r\n" % (name, value)
+    request += "\r\n"
+
+    connection.sock.sendall(request)
+    response = httplib.HTTPResponse(connection.sock, method="GET")
+    response.begin()
+    return request, response, connection.sock.getpeername()[0]
+
+
+def response_head(response):
+    # The status line and headers of `response`, as they came in.
+    return "HTTP/%s %d %s\r\n%s\r\n" % ("1.1" if response.version == 11 else "1.0",
+        response.status, response.reason, "".join(response.msg.headers))
+
+
+def read_raw(response, out_file, length=None, progress=None):
+    # Copies the body of `response` to `out_file` as it comes off the wire
+    # (no dechunking), `length` bytes of it or everything up to EOF.
+    # `progress` gets called with the number of bytes copied now and then.
+    copied = 0
+    since_progress = 0
+    while length is None or copied < length:
+        size = WARC_CHUNK_SIZE if length is None else \
+            min(WARC_CHUNK_SIZE, length - copied)
+        chunk = response.fp.read(size)
+        if not chunk:
+            break
+        out_file.write(chunk)
+        copied += len(chunk)
+        since_progress += len(chunk)
+        if progress is not None and since_progress >= CHECKPOINT_INTERVAL:
+            progress(copied)
+            since_progress = 0
+    return copied
+
+
+def resumable(response):
+    # Only a plain, complete response of known length can be picked up
+    # again with a Range request.
+    return (response.status == 200 and
+        response.getheader("content-length", "").isdigit() and
+        not response.getheader("transfer-encoding") and
+        response.getheader("accept-ranges", "bytes").lower() != "none")
+
+
+###########################################################################
+# WARC records.
+
+def warc_digest(sha1):
+    # Digests in the form wget writes them.
+    return "sha1:" + base64.b32encode(sha1.digest())
+
+
+def open_partial_warc(length):
+    # Opens download.warc.gz for adding records, dropping anything after the
+    # first `length` bytes (half a record, from a crash).
+    mode = "r+b" if os.path.exists(PARTIAL_WARC_NAME) else "w+b"
+    fileobj = open(PARTIAL_WARC_NAME, mode)
+    fileobj.truncate(length)
+    fileobj.seek(length)
+    return warc.WARCFile(fileobj=ParallelGzipWriter(fileobj))
+
+
+def write_block_record(warc_file, header, block):
+    header["Content-Length"] = str(len(block))
+    header["WARC-Block-Digest"] = warc_digest(hashlib.sha1(block))
+    write_record_header(warc_file, header, block)
+    warc_file.fileobj.write(block)
+    finish_record(warc_file)
+
+
+def write_warcinfo_record(warc_file, filename, warc_headers, record_id=None):
+    # Same fields as the one wget writes.
+    block = "software: twitchtv-grab download.py (Python %s)\r\n" % \
+        sys.version.split()[0]
+    block += "format: WARC File Format 1.0\r\n"
+    block += "conformsTo: http://bibnum.bnf.fr/WARC/WARC_ISO_28500_version1_latestdraft.pdf\r\n"
+    block += "robots: off\r\n"
+    for warc_header in warc_headers:
+        block += warc_header + "\r\n"
+    block += "\r\n"
+
+    header = warc.WARCHeader({
+        "WARC-Type": "warcinfo",
+        "WARC-Filename": filename,
+        "Content-Type": "application/warc-fields",
+    }, defaults=True)
+    if record_id:
+        header["WARC-Record-ID"] = record_id
+    write_block_record(warc_file, header, block)
+    return header["WARC-Record-ID"]
+
+
+def write_exchange_records(warc_file, warcinfo_id, url, ip, date, request,
+                           head, body_name=None, body="", response_id=None,
+                           response_fields=None):
+    # Writes the request record and the response record of one HTTP
+    # exchange. The body of the response comes from the file `body_name`, if
+    # given, and is streamed from there. `response_fields` go in the header
+    # of the response record as well.
+    response_header = warc.WARCHeader({
+        "WARC-Type": "response",
+        "WARC-Target-URI": url,
+        "WARC-Date": date,
+        "WARC-IP-Address": ip,
+        "WARC-Warcinfo-ID": warcinfo_id,
+    }, defaults=True)
+    if response_id:
+        response_header["WARC-Record-ID"] = response_id
+    request_header = warc.WARCHeader({
+        "WARC-Type": "request",
+        "WARC-Target-URI": url,
+        "WARC-Date": date,
+        "WARC-IP-Address": ip,
+        "WARC-Warcinfo-ID": warcinfo_id,
+        "WARC-Concurrent-To": response_header["WARC-Record-ID"],
+    }, defaults=True)
+    write_block_record(warc_file, request_header, request)
+
+    # The first segment of a segmented response has only part of the
+    # payload, so no payload digest.
+    if response_fields:
+        response_header.update(response_fields)
+    write_streamed_record(warc_file, response_header, head, body_name, body,
+        payload_digest=not response_fields)
+
+
+def write_streamed_record(warc_file, header, head, body_name=None, body="",
+                          payload_digest=False):
+    # Writes a record whose block is `head` followed by the contents of the
+    # file `body_name` (or `body`), streamed from there.
+
+    # one pass to hash the body, one to write it
+    block_sha1 = hashlib.sha1(head)
+    payload_sha1 = hashlib.sha1()
+    length = len(head)
+    body_file = open(body_name, "rb") if body_name else None
+    for chunk in iter_body(body_file, body):
+        block_sha1.update(chunk)
+        payload_sha1.update(chunk)
+        length += len(chunk)
+
+    header["Content-Length"] = str(length)
+    header["WARC-Block-Digest"] = warc_digest(block_sha1)
+    if payload_digest:
+        header["WARC-Payload-Digest"] = warc_digest(payload_sha1)
+    write_record_header(warc_file, header, head)
+    warc_file.fileobj.write(head)
+    for chunk in iter_body(body_file, body):
+        warc_file.fileobj.write(chunk)
+    finish_record(warc_file)
+
+    if body_file is not None:
+        body_file.close()
+
+
+def iter_body(body_file, body):
+    if body_file is None:
+        yield body
+        return
+    body_file.seek(0)
+    while True:
+        chunk = body_file.read(WARC_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def write_log_record(warc_file, warcinfo_id, log):
+    header = warc.WARCHeader({
+        "WARC-Type": "metadata",
+        "WARC-Target-URI": "metadata://twitchtv-grab/download.log",
+        "WARC-Warcinfo-ID": warcinfo_id,
+        "Content-Type": "text/plain",
+    }, defaults=True)
+    write_block_record(warc_file, header, "".join(log))
+
+
+###########################################################################
+# The download.
+
+def warc_date():
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+
+def split_parts(length, connections):
+    # Cuts `length` bytes into `connections` ranges, as [start, end, done]
+    # lists, none of them smaller than PARALLEL_MIN_PART_SIZE.
+    count = max(1, min(connections, length // PARALLEL_MIN_PART_SIZE))
+    bounds = [length * number // count for number in range(count + 1)]
+    return [[bounds[number], bounds[number + 1], 0] for number in range(count)]
+
+
+def split_segments(length, segment_size):
+    # Cuts `length` bytes into ranges of `segment_size`, one per WARC.
+    return [[start, min(start + segment_size, length), 0]
+        for start in range(0, length, segment_size)]
+
+
+def expected_md5(head):
+    # The MD5 of the body, if the response says what it is: in a Content-MD5
+    # header, or as the ETag, which is what most CDNs use for one.
+    match = re.search(r"(?im)^Content-MD5:\s*(\S+)", head)
+    if match:
+        try:
+            return base64.b64decode(match.group(1)).encode("hex")
+        except TypeError:
+            return None
+    match = re.search(r'(?im)^ETag:\s*"?([0-9a-f]{32})"?\s*$', head)
+    if match:
+        return match.group(1).lower()
+    return None
+
+
+class RangeNotHonored(Exception):
+    pass
+
+
+class Download(object):
+    # The download of one URL into one warc, with its checkpoint.
+
+    def __init__(self, url, user_agent, connections=DOWNLOAD_CONNECTIONS,
+                 segment_size=SEGMENT_SIZE, warc_file_base=None):
+        self.url = url
+        self.user_agent = user_agent
+        self.connections = connections
+        self.lock = threading.Lock()
+        self.ranges_failed = False
+
+        self.checkpoint = read_checkpoint()
+        if self.checkpoint is None or self.checkpoint["url"] != url:
+            # (segments of an earlier download that did finish are no use
+            # to this one)
+            remove_checkpoint()
+            for filename in glob.glob(SEGMENT_PATTERN) + \
+                    glob.glob(SEGMENT_PATTERN + ".tmp"):
+                os.remove(filename)
+            # The warcinfo record only gets written with the WARC, so that
+            # it names the right file; the redirects refer to it by this.
+            self.checkpoint = {"url": url, "target": url, "warc_length": 0,
+                "log": [], "warcinfo_id": "<urn:uuid:%s>" % uuid.uuid1()}
+
+        # Once segments have been written, the rest go by the same name.
+        if not self.checkpoint.get("segments_written"):
+            self.checkpoint["warc_file_base"] = warc_file_base
+        if "parts" not in self.checkpoint:
+            self.checkpoint["segment_size"] = segment_size
+
+        self.warc_file = open_partial_warc(self.checkpoint["warc_length"])
+
+        # A segment that was written but not yet renamed when we stopped.
+        for number in range(self.checkpoint.get("segments_written", 0)):
+            if os.path.exists(self.warc_name(number) + ".tmp"):
+                os.rename(self.warc_name(number) + ".tmp",
+                    self.warc_name(number))
+
+    def warc_name(self, number=0):
+        # The name of the item's WARC, or of its `number`th segment.
+        if self.checkpoint["segment_size"]:
+            return "%s-%05d.warc.gz" % (self.checkpoint["warc_file_base"],
+                number + 1)
+        else:
+            return "%s.warc.gz" % self.checkpoint["warc_file_base"]
+
+    def part_file(self, number):
+        # Where the body of a part goes, and where in there it starts. Each
+        # segment has a file of its own, which goes once it's in its WARC.
+        if self.checkpoint.get("segmented"):
+            return "%s.%05d" % (PARTIAL_BODY_NAME, number), 0
+        else:
+            return PARTIAL_BODY_NAME, self.checkpoint["parts"][number][0]
+
+    def log(self, message):
+        print(message)
+        sys.stdout.flush()
+        with self.lock:
+            self.checkpoint["log"].append("%s %s\n" % (warc_date(), message))
+
+    def save_warc(self):
+        # everything written to the warc so far is complete records
+        self.warc_file.fileobj.flush()
+        os.fsync(self.warc_file.fileobj.fileobj.fileno())
+        self.checkpoint["warc_length"] = self.warc_file.fileobj.fileobj.tell()
+        write_checkpoint(self.checkpoint)
+
+    def start_warc(self, name):
+        # Opens `name`.tmp for writing a WARC, and writes its warcinfo
+        # record and the records download.warc.gz has so far (the
+        # redirects).
+        fileobj = open(name + ".tmp", "wb")
+        warc_file = warc.WARCFile(fileobj=ParallelGzipWriter(fileobj))
+        write_warcinfo_record(warc_file, os.path.basename(name),
+            self.warc_headers, self.checkpoint["warcinfo_id"])
+
+        with open(PARTIAL_WARC_NAME, "rb") as partial_warc:
+            remaining = self.checkpoint["warc_length"]
+            while remaining:
+                chunk = partial_warc.read(min(WARC_CHUNK_SIZE, remaining))
+                fileobj.write(chunk)
+                remaining -= len(chunk)
+        return warc_file
+
+    def close_warc(self, warc_file, name):
+        # Makes `name`.tmp, as started by start_warc(), `name` for good.
+        warc_file.fileobj.flush()
+        os.fsync(warc_file.fileobj.fileobj.fileno())
+        warc_file.fileobj.close()
+        os.rename(name + ".tmp", name)
+
+    def run(self, warc_headers, item_dir):
+        checkpoint = self.checkpoint
+        self.warc_headers = warc_headers
+
+        redirects = 0
+        while True:
+            # Picking up a video where we left off?
+            if "parts" in checkpoint:
+                try:
+                    self.fetch_parts()
+                    break
+                except RangeNotHonored, error:
+                    # It changed, or the server doesn't do Range; all of the
+                    # video again, in one go.
+                    self.start_over(error)
+
+            request, response, ip = http_get(checkpoint["target"],
+                self.user_agent)
+            self.log("%d %s" % (response.status, checkpoint["target"]))
+
+            if response.status in (301, 302, 303, 307, 308) and \
+                    response.getheader("location"):
+                # Redirects are small, and go straight into the warc.
+                redirects += 1
+                if redirects > MAX_REDIRECTS:
+                    raise Exception("Too many redirects.")
+                write_exchange_records(self.warc_file,
+                    checkpoint["warcinfo_id"], checkpoint["target"], ip,
+                    warc_date(), request, response_head(response),
+                    body=response.fp.read())
+                checkpoint["target"] = urlparse.urljoin(checkpoint["target"],
+                    response.getheader("location"))
+                self.save_warc()
+                continue
+
+            # This is the video (or whatever the server had to say instead).
+            checkpoint.update({
+                # (these may not be valid UTF-8, which is all json can take)
+                "request": base64.b64encode(request),
+                "head": base64.b64encode(response_head(response)),
+                "date": warc_date(),
+                "ip": ip,
+                "validator": response.getheader("etag") or
+                    response.getheader("last-modified"),
+            })
+
+            if not resumable(response):
+                # Nothing to resume with; get it all in one go.
+                with open(PARTIAL_BODY_NAME, "wb") as body_file:
+                    read_raw(response, body_file)
+                checkpoint["length"] = os.path.getsize(PARTIAL_BODY_NAME)
+                break
+
+            # The body is fetched in parts, as many as there are connections
+            # to fetch them on, or one per segment if it's too big for one
+            # WARC; the first one comes from this response.
+            checkpoint["length"] = int(response.getheader("content-length"))
+            if checkpoint["segment_size"] and not self.ranges_failed and \
+                    checkpoint["length"] > checkpoint["segment_size"]:
+                checkpoint["segmented"] = True
+                checkpoint["segments_written"] = 0
+                checkpoint["response_id"] = "<urn:uuid:%s>" % uuid.uuid1()
+                checkpoint["parts"] = split_segments(checkpoint["length"],
+                    checkpoint["segment_size"])
+                self.log("Cutting the video into %d WARCs" %
+                    len(checkpoint["parts"]))
+            else:
+                checkpoint["segmented"] = False
+                checkpoint["parts"] = split_parts(checkpoint["length"],
+                    self.connections)
+                with open(PARTIAL_BODY_NAME, "wb") as body_file:
+                    body_file.truncate(checkpoint["length"])
+            write_checkpoint(checkpoint)
+            try:
+                self.fetch_parts(response)
+                break
+            except RangeNotHonored, error:
+                self.start_over(error)
+
+        self.finish(item_dir)
+
+    def start_over(self, error):
+        if self.checkpoint.get("segments_written"):
+            # Some of it is gone already; a new video won't match it.
+            raise Exception("The video changed after %d of its WARCs were "
+                "written: %s" % (self.checkpoint["segments_written"], error))
+        self.log("Starting the video over: %s" % error)
+        del self.checkpoint["parts"]
+        self.checkpoint["segmented"] = False
+        self.connections = 1
+        self.ranges_failed = True
+
+    def fetch_parts(self, response=None):
+        # Fetches whatever is missing of every part of the body, on as many
+        # connections as there are parts (or segments, up to the number of
+        # connections). `response`, if given, is the one the first part
+        # starts in. Segments get written as soon as they, and the ones
+        # before them, are in.
+        todo = [number for number, (start, end, done)
+            in enumerate(self.checkpoint["parts"]) if done < end - start]
+        if len(todo) > 1:
+            self.log("Fetching %d parts of the video, %d at once" % (
+                len(todo), min(self.connections, len(todo))))
+
+        fetching = list(todo)
+        errors = []
+        finished = Queue.Queue()
+
+        def fetch():
+            while not errors:
+                with self.lock:
+                    if not todo:
+                        return
+                    number = todo.pop(0)
+                try:
+                    self.fetch_part(number,
+                        response if number == 0 and response is not None else None)
+                    finished.put(number)
+                except Exception, error:
+                    errors.append(error)
+
+        def write_segments():
+            if self.checkpoint.get("segmented") and not errors:
+                try:
+                    self.write_segments(last=False)
+                except Exception, error:
+                    errors.append(error)
+
+        # (some may have come in before we were stopped last time)
+        write_segments()
+
+        threads = [threading.Thread(target=fetch)
+            for thread in range(max(1, min(self.connections, len(todo))))]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads) or \
+                not finished.empty():
+            try:
+                finished.get(timeout=1)
+            except Queue.Empty:
+                continue
+            write_segments()
+        for thread in threads:
+            thread.join()
+
+        if response is not None and 0 not in fetching:
+            response.close()
+        for error in errors:
+            if isinstance(error, RangeNotHonored):
+                raise error
+        if errors:
+            raise errors[0]
+
+    def fetch_part(self, number, response=None):
+        checkpoint = self.checkpoint
+        start, end, done = checkpoint["parts"][number]
+
+        while start + done < end:
+            if response is None:
+                range_headers = [("Range", "bytes=%d-%d" % (start + done, end - 1))]
+                if checkpoint.get("validator"):
+                    range_headers.append(("If-Range", checkpoint["validator"]))
+                self.log("Fetching bytes %d-%d of %d" % (start + done, end - 1,
+                    checkpoint["length"]))
+                request, response, ip = http_get(checkpoint["target"],
+                    self.user_agent, range_headers)
+
+                content_range = re.match(r"bytes (\d+)-(\d+)/(\d+)$",
+                    response.getheader("content-range", ""))
+                if response.status == 200:
+                    raise RangeNotHonored("got %d %s for a Range request" % (
+                        response.status, response.reason))
+                if not (response.status == 206 and content_range and
+                        int(content_range.group(1)) == start + done and
+                        int(content_range.group(3)) == checkpoint["length"]):
+                    raise Exception("Could not fetch bytes %d-%d: %d %s" % (
+                        start + done, end - 1, response.status, response.reason))
+
+            body_name, offset = self.part_file(number)
+            with open(body_name,
+                    "r+b" if os.path.exists(body_name) else "w+b") as body_file:
+                body_file.seek(offset + done)
+
+                def progress(copied):
+                    body_file.flush()
+                    os.fsync(body_file.fileno())
+                    with self.lock:
+                        checkpoint["parts"][number][2] = done + copied
+                        write_checkpoint(checkpoint)
+
+                copied = read_raw(response, body_file, end - start - done,
+                    progress)
+                progress(copied)
+            response.close()
+            response = None
+
+            if copied == 0:
+                raise Exception("The server sent no more of the video.")
+            done += copied
+
+    def write_segments(self, last):
+        # Writes the WARCs of the segments that are in, in order; all of them
+        # if `last`, or else all but the last, which gets the log as well.
+        checkpoint = self.checkpoint
+        parts = checkpoint["parts"]
+        count = len(parts) if last else len(parts) - 1
+
+        while checkpoint["segments_written"] < count:
+            number = checkpoint["segments_written"]
+            start, end, done = parts[number]
+            if done < end - start:
+                break
+            self.write_segment(number, number == len(parts) - 1)
+
+    def write_segment(self, number, last):
+        checkpoint = self.checkpoint
+        head = base64.b64decode(checkpoint["head"])
+        body_name = self.part_file(number)[0]
+        temp_name = self.warc_name(number) + ".tmp"
+
+        if number == 0:
+            # The warcinfo record and redirects, then the request and the
+            # start of the response.
+            warc_file = self.start_warc(self.warc_name(number))
+            write_exchange_records(warc_file, checkpoint["warcinfo_id"],
+                checkpoint["target"], checkpoint["ip"], checkpoint["date"],
+                base64.b64decode(checkpoint["request"]), head,
+                body_name=body_name, response_id=checkpoint["response_id"],
+                response_fields={"WARC-Segment-Number": "1"})
+        else:
+            fileobj = open(temp_name, "wb")
+            warc_file = warc.WARCFile(fileobj=ParallelGzipWriter(fileobj))
+            warcinfo_id = write_warcinfo_record(warc_file,
+                self.warc_name(number), self.warc_headers)
+            header = warc.WARCHeader({
+                "WARC-Type": "continuation",
+                "WARC-Target-URI": checkpoint["target"],
+                "WARC-Date": checkpoint["date"],
+                "WARC-Warcinfo-ID": warcinfo_id,
+                "WARC-Segment-Origin-ID": checkpoint["response_id"],
+                "WARC-Segment-Number": str(number + 1),
+            }, defaults=True)
+            del header["Content-Type"]
+            if last:
+                header["WARC-Segment-Total-Length"] = str(len(head) +
+                    checkpoint["length"])
+            write_streamed_record(warc_file, header, "", body_name)
+            if last:
+                write_log_record(warc_file, warcinfo_id, checkpoint["log"])
+
+        warc_file.fileobj.flush()
+        os.fsync(warc_file.fileobj.fileobj.fileno())
+        warc_file.fileobj.close()
+
+        # Written for good; the checkpoint says so before the pipeline can
+        # see it (and upload and delete it).
+        with self.lock:
+            checkpoint["segments_written"] = number + 1
+            write_checkpoint(checkpoint)
+        os.rename(temp_name, self.warc_name(number))
+        os.remove(body_name)
+        self.log("Wrote %s" % self.warc_name(number))
+
+    def finish(self, item_dir):
+        # Writes the video's records, and the log, into the item's warc: in
+        # `item_dir`, or with the segments if it's the only one.
+        checkpoint = self.checkpoint
+        head = base64.b64decode(checkpoint["head"])
+
+        if checkpoint.get("segmented"):
+            missing = sum(end - start - done
+                for start, end, done in checkpoint["parts"])
+            if missing:
+                raise Exception("Got %d bytes of the video instead of %d." % (
+                    checkpoint["length"] - missing, checkpoint["length"]))
+            # (most of it may have been uploaded by now)
+            if expected_md5(head) is not None:
+                self.log("Not checking the MD5 of a video in segments")
+            self.write_segments(last=True)
+            self.warc_file.fileobj.close()
+            return
+
+        if os.path.getsize(PARTIAL_BODY_NAME) != checkpoint["length"]:
+            raise Exception("Got %d bytes of the video instead of %d." % (
+                os.path.getsize(PARTIAL_BODY_NAME), checkpoint["length"]))
+
+        # Parts that came in on different connections had better add up to
+        # the video the server has.
+        md5 = expected_md5(head)
+        if md5 is not None and "parts" in checkpoint:
+            body_md5 = hashlib.md5()
+            with open(PARTIAL_BODY_NAME, "rb") as body_file:
+                for chunk in iter_body(body_file, None):
+                    body_md5.update(chunk)
+            if body_md5.hexdigest() != md5:
+                remove_checkpoint()
+                raise Exception("The video's MD5 is %s instead of %s." % (
+                    body_md5.hexdigest(), md5))
+            self.log("MD5 of the video checks out")
+
+        self.warc_file.fileobj.close()
+        warc_name = self.warc_name()
+        if not checkpoint["segment_size"]:
+            warc_name = os.path.join(item_dir, warc_name)
+        warc_file = self.start_warc(warc_name)
+        write_exchange_records(warc_file, checkpoint["warcinfo_id"],
+            checkpoint["target"], checkpoint["ip"], checkpoint["date"],
+            base64.b64decode(checkpoint["request"]), head,
+            body_name=PARTIAL_BODY_NAME)
+        write_log_record(warc_file, checkpoint["warcinfo_id"],
+            checkpoint["log"])
+        self.close_warc(warc_file, warc_name)
+
+
+def download(url, item_dir, warc_file_base, user_agent, warc_headers,
+             connections=DOWNLOAD_CONNECTIONS, segment_size=SEGMENT_SIZE,
+             checkpoint_dir=None):
+    print("\nDonate to the Internet Archive! Help keep the library free for millions of people.")
+    print("Visit https://archive.org/donate/ for details. (Archive Team is not affiliated with the Internet Archive.)")
+    print("\n* A video file is now being downloaded. It may take a while.. *\n")
+    sys.stdout.flush()
+
+    item_dir = os.path.abspath(item_dir)
+    if checkpoint_dir:
+        if not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        os.chdir(checkpoint_dir)
+    else:
+        os.chdir(item_dir)
+    video = Download(url, user_agent, connections, segment_size,
+        warc_file_base)
+    video.run(warc_headers, item_dir)
+    remove_checkpoint()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Download a video into a WARC, resuming if need be.")
+    parser.add_argument("--user-agent", default="ArchiveTeam")
+    parser.add_argument("--warc-header", action="append", default=[],
+        help="a line to add to the warcinfo record")
+    parser.add_argument("--connections", type=int,
+        default=DOWNLOAD_CONNECTIONS,
+        help="how many ranges of a big video to fetch at once")
+    parser.add_argument("--segment-size", type=int,
+        default=SEGMENT_SIZE // (1024 * 1024),
+        help="cut videos bigger than this many MiB into WARCs of that size "
+             "(default: don't)")
+    parser.add_argument("--checkpoint-dir",
+        help="where to keep the checkpoint (default: the item directory)")
+    parser.add_argument("url")
+    parser.add_argument("item_dir")
+    parser.add_argument("warc_file_base")
+    args = parser.parse_args()
+
+    download(args.url, args.item_dir, args.warc_file_base, args.user_agent,
+        args.warc_header, args.connections, args.segment_size * 1024 * 1024,
+        args.checkpoint_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# encoding=utf8
+#
+# Runs a command and writes down what it cost: wall and CPU time, how many
+# bytes it read from and wrote to disk, and its peak RSS. The numbers count
+# everything the command waited for, too (the ffmpegs of postprocess.py, for
+# example), which is why this wraps the command instead of watching it from
+# pipeline.py:
+#
+#     python measure.py STATS_FILE -- wget-lua -U ArchiveTeam ...
+#
+# STATS_FILE gets a JSON object; the Measured task in pipeline.py puts it in
+# the stats for the tracker. The command's output and exit code go through
+# untouched.
+import errno
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+
+# ru_inblock and ru_oublock count 512-byte blocks
+BLOCK_SIZE = 512
+
+
+def measure(args):
+    start = time.time()
+    process = subprocess.Popen(args)
+
+    # Pass a stop on to the command and let it clean up, rather than leaving
+    # it running on its own.
+    def forward(signum, frame):
+        os.kill(process.pid, signum)
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    while True:
+        try:
+            pid, status, usage = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+    stats = {
+        "wall_time": round(time.time() - start, 3),
+        "cpu_user": round(usage.ru_utime, 3),
+        "cpu_system": round(usage.ru_stime, 3),
+        "disk_bytes_read": usage.ru_inblock * BLOCK_SIZE,
+        "disk_bytes_written": usage.ru_oublock * BLOCK_SIZE,
+        # kilobytes on Linux
+        "peak_rss_kb": usage.ru_maxrss,
+    }
+
+    if os.WIFSIGNALED(status):
+        return stats, 128 + os.WTERMSIG(status)
+    else:
+        return stats, os.WEXITSTATUS(status)
+
+
+def main():
+    if len(sys.argv) < 4 or sys.argv[2] != "--":
+        sys.stderr.write("usage: measure.py STATS_FILE -- COMMAND [ARG ...]\n")
+        sys.exit(2)
+
+    stats, exit_code = measure(sys.argv[3:])
+    stats["exit_code"] = exit_code
+
+    with open(sys.argv[1], "w") as f:
+        json.dump(stats, f)
+
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
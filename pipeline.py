@@ -1,51 +1,125 @@
 # encoding=utf8
+import collections
 import datetime
 from distutils.version import StrictVersion
+import functools
 import hashlib
 import os.path
 import random
-from seesaw.config import realize, NumberConfigValue
+import re
+import resource
+from seesaw.config import realize, NumberConfigValue, ConfigInterpolation
 from seesaw.item import ItemInterpolation, ItemValue
-from seesaw.task import SimpleTask, LimitConcurrent
+from seesaw.task import Task, SimpleTask, LimitConcurrent, ConditionalTask
 from seesaw.tracker import GetItemFromTracker, PrepareStatsForTracker, \
     UploadWithTracker, SendDoneToTracker
 import shutil
 import socket
 import subprocess
 import sys
+import threading
 import time
-
-# for properly parsing command line strings for insertion into call()s
-import shlex
-# for globbing files in a given path
-import glob
-# for making subprocesses (ffmpeg, tar, etc)
-from subprocess import call
-# for file length
+import json
 import os
-# for in-memory binary strings (rather than on-file)
-from cStringIO import StringIO
-# for manipulating warc files (open, write, read, close, compress)
-import warc
 
 import seesaw
-from seesaw.externalprocess import WgetDownload
+from seesaw.externalprocess import ExternalProcess, WgetDownload
 from seesaw.pipeline import Pipeline
 from seesaw.project import Project
-from seesaw.util import find_executable
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop, PeriodicCallback
 
 # check the seesaw version
 if StrictVersion(seesaw.__version__) < StrictVersion("0.1.5"):
     raise Exception("This pipeline needs seesaw version 0.1.5 or higher.")
 
 
+###########################################################################
+# Remember what we found out about files (what an executable says its
+# version is, or what the SHA-1 of a file is), so that starting up again
+# doesn't run every executable or read every file all over again. An answer
+# is good for as long as the file has the same inode, size and mtime.
+PROBE_CACHE = "probe-cache.json"
+
+
+def load_probe_cache():
+    try:
+        with open(PROBE_CACHE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+probe_cache = load_probe_cache()
+
+
+def save_probe_cache():
+    # Several warriors on one host may share the cache; the last one to
+    # learn something wins.
+    temp_name = "%s.%d" % (PROBE_CACHE, os.getpid())
+    try:
+        with open(temp_name, "w") as f:
+            json.dump(probe_cache, f, indent=1, sort_keys=True)
+        os.rename(temp_name, PROBE_CACHE)
+    except (IOError, OSError):
+        pass
+
+
+def cached_probe(kind, path, probe):
+    # Returns probe(path), or what it returned the last time the file at
+    # path was the same file; None if there's no file.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    file_key = [st.st_ino, st.st_size, st.st_mtime]
+    cache_key = "%s %s" % (kind, os.path.abspath(path))
+    entry = probe_cache.get(cache_key)
+
+    if entry is None or entry["file"] != file_key:
+        entry = {"file": file_key, "result": probe(path)}
+        probe_cache[cache_key] = entry
+        save_probe_cache()
+
+    return entry["result"]
+
+
+def version_output(path, version_arg):
+    # What path says when run with version_arg (or None if it won't run).
+    def probe(path):
+        try:
+            process = subprocess.Popen([path, version_arg],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output = "".join(process.communicate())
+        except OSError:
+            return None
+
+        if process.returncode != 0:
+            return None
+        return output.decode("utf-8", "replace")
+
+    return cached_probe("version " + version_arg, path, probe)
+
+
+def find_cached_executable(name, versions, paths, version_arg="-V"):
+    # seesaw.util.find_executable(), minus the probing when nothing changed.
+    for path in paths:
+        output = version_output(path, version_arg)
+        if output and any(version in output for version in versions):
+            print("Found usable %s in %s" % (name, path))
+            return path
+
+    return None
+
+
 ###########################################################################
 # Find a useful Wget+Lua executable.
 #
 # WGET_LUA will be set to the first path that
 # 1. does not crash with --version, and
 # 2. prints the required version string
-WGET_LUA = find_executable(
+WGET_LUA = find_cached_executable(
     "Wget+Lua",
     ["GNU Wget 1.14.lua.20130523-9a5c"],
     [
@@ -67,9 +141,9 @@ if not WGET_LUA:
 # Should probably utilize an ffmpeg build (or source) distributed from the
 # repo to avoid nasty API incompatibilities between FFMPEG versions.
 # However, if the options used are relatively simple, using distro-provided
-# ffmpeg builds shouldn't be too problematic. Just be sure to add a metadata
-# WARCRecord indicating the version string of the ffmpeg that is used.
-FFMPEG = find_executable(
+# ffmpeg builds shouldn't be too problematic. The version string of the ffmpeg
+# that is used goes in the warcinfo record of sampled WARCs.
+FFMPEG = find_cached_executable(
     "ffmpeg",
     ["ffmpeg version 2"],
     [
@@ -83,6 +157,11 @@ FFMPEG = find_executable(
 if not FFMPEG:
     raise Exception("No usable ffmpeg found.")
 
+FFMPEG_VERSION = "ffmpeg"
+match = re.search(r"ffmpeg version (\S+)", version_output(FFMPEG, "-version"))
+if match:
+    FFMPEG_VERSION = "ffmpeg/" + match.group(1)
+
 ###########################################################################
 # The version number of this pipeline definition.
 #
@@ -95,6 +174,67 @@ USER_AGENT = 'ArchiveTeam'
 TRACKER_ID = 'twitchtv-grab'
 TRACKER_HOST = 'tracker.centosdevbox.com'
 
+# Sampled items are uploaded as a .warc.gz, or as a .warc.zst with "zst"
+# (needs the zstandard module). The zstd dictionary is used if it's there;
+# make one with "python postprocess.py train-dictionary".
+WARC_COMPRESSION = "gz"
+ZSTD_DICTIONARY = "twitchtv.zstd-dictionary"
+
+# Where Sample keeps the webms and snapshots of videos it has sampled, in
+# case they come around again.
+SAMPLE_CACHE_DIR = "sample-cache"
+
+# Which of /a/, /b/ or /c/ a video page is really under, one "video_id url"
+# line per video. twitchtv.lua adds a line whenever a kraken video response
+# tells it something new, so retried items can go straight to the right
+# page. Only the most recent VIDEO_PAGE_CACHE_SIZE videos are kept.
+VIDEO_PAGE_CACHE = "video-pages.cache"
+VIDEO_PAGE_CACHE_SIZE = 50000
+
+# The JS, CSS, sprites and avatars every item fetches again. Wget writes a
+# revisit record instead of the whole thing when it gets one that's already
+# in this CDX (from an earlier item on this warrior). Only the most recently
+# seen ASSET_INDEX_SIZE assets are kept.
+ASSET_INDEX = "seen-assets.cdx"
+ASSET_INDEX_SIZE = 20000
+ASSET_INDEX_SKIP_TYPES = ("text/html", "application/json")
+
+# CheckIP wants CHECK_IP_HOST to resolve to an address starting with
+# CHECK_IP_PREFIX, and looks again every CHECK_IP_INTERVAL seconds.
+CHECK_IP_HOST = "twitch.tv"
+CHECK_IP_PREFIX = "192.16.71."
+CHECK_IP_INTERVAL = 600
+
+# download.py keeps the checkpoint of a video download (and the segments it
+# cut it into that haven't been uploaded yet) in a directory of this one,
+# named after the item, rather than in the item directory: seesaw gives
+# every attempt at an item a new one of those, and deletes it when the item
+# fails. This way a retried item picks up where the last attempt stopped,
+# even after a restart.
+PARTIAL_DIR = "partial"
+
+# download.py names the WARCs of a video it cuts into segments like this.
+# UploadSegments looks for new ones every SEGMENT_SCAN_INTERVAL seconds.
+SEGMENT_NAME = re.compile(r"-\d{5}\.warc\.gz$")
+SEGMENT_SCAN_INTERVAL = 10
+
+# Before an item is downloaded, it reserves the disk space it will take at
+# most: DISK_FOOTPRINT times the size of its video (the old WARC, the body
+# while it downloads, intermediate files, the new WARC...), or
+# DEFAULT_VIDEO_SIZE if the server won't say; PAGE_ITEM_SIZE for a video
+# page. No new item is taken unless MIN_FREE_SPACE bytes would be left over
+# once what is reserved is used up. Checked every DISK_CHECK_INTERVAL
+# seconds while waiting.
+DISK_FOOTPRINT = 3
+DEFAULT_VIDEO_SIZE = 2 * 1024 ** 3
+PAGE_ITEM_SIZE = 50 * 1024 ** 2
+MIN_FREE_SPACE = 2 * 1024 ** 3
+DISK_CHECK_INTERVAL = 30
+
+# What each stage cost each item also gets appended to this file, one JSON
+# object per line.
+METRICS_FILE = "metrics.jsonl"
+
 
 ###########################################################################
 # This section defines project-specific tasks.
@@ -102,30 +242,299 @@ TRACKER_HOST = 'tracker.centosdevbox.com'
 # Simple tasks (tasks that do not need any concurrency) are based on the
 # SimpleTask class and have a process(item) method that is called for
 # each item.
-class CheckIP(SimpleTask):
+class MeasuredArgs(object):
+    # Runs the command of an ExternalProcess under measure.py, which leaves
+    # what it cost in the item directory for the Measured task around it.
+    def __init__(self, stage, args):
+        self.stage = stage
+        self.args = args
+
+    def realize(self, item):
+        return [
+            sys.executable,
+            os.path.join(CWD, "measure.py"),
+            os.path.join(item["item_dir"], "%s.measure.json" % self.stage),
+            "--",
+        ] + realize(self.args, item)
+
+
+class Measured(Task):
+    # Keeps track of what a stage costs each item, in item["stage_stats"]:
+    # the wall time, and the CPU time, disk I/O and peak RSS of its command
+    # (see MeasuredArgs) or, for a simple task, of this process while it ran.
+    # size_function says how many bytes the stage moved, if we know better.
+    def __init__(self, stage, inner_task, size_function=None):
+        Task.__init__(self, "Measured")
+        self.stage = stage
+        self.inner_task = inner_task
+        self.size_function = size_function
+        self.inner_task.on_complete_item += self._inner_task_complete_item
+        self.inner_task.on_fail_item += self._inner_task_fail_item
+        self._started = {}
+
+    def enqueue(self, item):
+        self._started[id(item)] = (time.time(),
+            resource.getrusage(resource.RUSAGE_SELF))
+        self.inner_task.enqueue(item)
+
+    def record(self, item, failed):
+        start_time, start_usage = self._started.pop(id(item))
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+
+        stats = {"wall_time": round(time.time() - start_time, 3)}
+        if failed:
+            stats["failed"] = True
+
+        measure_file = None
+        if "item_dir" in item:
+            measure_file = os.path.join(item["item_dir"],
+                "%s.measure.json" % self.stage)
+
+        if measure_file and os.path.exists(measure_file):
+            with open(measure_file) as f:
+                command_stats = json.load(f)
+            del command_stats["wall_time"]
+            stats.update(command_stats)
+            os.remove(measure_file)
+
+        elif isinstance(self.inner_task, SimpleTask):
+            # Simple tasks block everything else, so all of it is theirs
+            # (except the peak RSS, which is the whole pipeline's).
+            stats.update({
+                "cpu_user": round(usage.ru_utime - start_usage.ru_utime, 3),
+                "cpu_system": round(usage.ru_stime - start_usage.ru_stime, 3),
+                "disk_bytes_read":
+                    (usage.ru_inblock - start_usage.ru_inblock) * 512,
+                "disk_bytes_written":
+                    (usage.ru_oublock - start_usage.ru_oublock) * 512,
+                "peak_rss_kb": usage.ru_maxrss,
+            })
+
+        if self.size_function and not failed:
+            stats["bytes"] = self.size_function(item)
+
+        stage_stats = item.get("stage_stats") or {}
+        stage_stats[self.stage] = stats
+        item["stage_stats"] = stage_stats
+
+    def _inner_task_complete_item(self, task, item):
+        self.record(item, False)
+        self.complete_item(item)
+
+    def _inner_task_fail_item(self, task, item):
+        self.record(item, True)
+        self.fail_item(item)
+
+    def fill_ui_task_list(self, task_list):
+        self.inner_task.fill_ui_task_list(task_list)
+
+    def __str__(self):
+        return "Measured(" + str(self.inner_task) + ")"
+
+
+def upload_size(item):
+    return sum(os.path.getsize(f) for f in item["upload_files"])
+
+
+class ReportStageStats(SimpleTask):
+    # Sends the stage costs along with the rest of the stats, and keeps them
+    # in METRICS_FILE.
     def __init__(self):
-        SimpleTask.__init__(self, "CheckIP")
-        self._counter = 0
+        SimpleTask.__init__(self, "ReportStageStats")
 
     def process(self, item):
-        # NEW for 2014! Check if we are behind firewall/proxy
+        stages = item.get("stage_stats") or {}
+        item["stats"]["stages"] = stages
+
+        with open(os.path.join(CWD, METRICS_FILE), "a") as f:
+            f.write(json.dumps({
+                "item": item["item_name"],
+                "time": int(time.time()),
+                "stages": stages,
+            }, sort_keys=True) + "\n")
+
+
+def disk_usage(path):
+    # Bytes actually taken up by the files under path (a sparse file only
+    # counts for what's been written).
+    usage = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                usage += os.lstat(os.path.join(dirpath, filename)).st_blocks * 512
+            except OSError:
+                pass
+    return usage
+
+
+class DiskReservations(object):
+    # The disk space the items in progress have reserved, until they're done.
+    def __init__(self):
+        self._items = {}
+
+    def reserve(self, item, size):
+        if id(item) not in self._items:
+            item.on_finish += self.release
+        self._items[id(item)] = (item, size)
+        item["disk_reserved"] = size
+
+    def release(self, item):
+        self._items.pop(id(item), None)
+
+    def outstanding(self, except_item=None):
+        # What the items still have to write of what they reserved.
+        return sum(max(0, size - disk_usage(item["data_dir"]) -
+                disk_usage(item["partial_dir"]))
+            for item, size in self._items.values() if item is not except_item)
+
+    def available(self, path, except_item=None):
+        # Free space at path, less what the items are about to use up.
+        st = os.statvfs(path)
+        return st.f_bavail * st.f_frsize - self.outstanding(except_item)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class WaitForDiskSpace(Task):
+    # Holds an item until `needed(item)` bytes are available; or, when
+    # `alone_ok`, until it's the only item with a reservation left. The wait
+    # goes in item["disk_waited"].
+    def __init__(self, name, reservations, needed, alone_ok=False):
+        Task.__init__(self, name)
+        self.reservations = reservations
+        self.needed = needed
+        self.alone_ok = alone_ok
+
+    def enqueue(self, item):
+        self.start_item(item)
+        item["disk_wait_started"] = time.time()
+        self.check(item, True)
+
+    def check(self, item, first=False):
+        needed = self.needed(item)
+        available = self.reservations.available(item["data_dir"], item)
+        alone = self.alone_ok and len(self.reservations) <= 1
+
+        if available >= needed or alone:
+            item["disk_waited"] = (item.get("disk_waited") or 0) + \
+                time.time() - item["disk_wait_started"]
+            self.complete_item(item)
+            return
+
+        if first:
+            item.log_output("Waiting for %d MB of disk space (%d MB left "
+                "after what other items have reserved)." % (
+                needed // 1024 ** 2, available // 1024 ** 2))
+        IOLoop.instance().add_timeout(
+            datetime.timedelta(seconds=DISK_CHECK_INTERVAL),
+            functools.partial(self.check, item))
+
+
+class ReserveDiskSpace(WaitForDiskSpace):
+    # Works out how much space the item needs (from the Content-Length of
+    # the video of a url item), reserves it, and waits until it's there.
+    def __init__(self, reservations):
+        WaitForDiskSpace.__init__(self, "ReserveDiskSpace", reservations,
+            lambda item: item["disk_reserved"], alone_ok=True)
+        self.http_client = AsyncHTTPClient()
+
+    def enqueue(self, item):
+        if not is_url_item(item):
+            self.reserve(item, PAGE_ITEM_SIZE)
+            return
+
+        self.http_client.fetch(HTTPRequest(
+            item["item_name"].split(":", 1)[1],
+            method="HEAD",
+            user_agent=USER_AGENT,
+            follow_redirects=True,
+            request_timeout=60,
+            ), functools.partial(self.handle_response, item))
+
+    def handle_response(self, item, response):
+        length = response.headers.get("Content-Length", "") \
+            if response.code == 200 else ""
+        if length.isdigit():
+            self.reserve(item, int(length) * DISK_FOOTPRINT)
+        else:
+            self.reserve(item, DEFAULT_VIDEO_SIZE * DISK_FOOTPRINT)
+
+    def reserve(self, item, size):
+        self.reservations.reserve(item, size)
+        WaitForDiskSpace.enqueue(self, item)
 
-        if self._counter <= 0:
+
+class CheckIP(Task):
+    # NEW for 2014! Check if we are behind firewall/proxy: twitch.tv has to
+    # resolve to one of Twitch's own addresses.
+    #
+    # The lookup happens in a thread of its own, so a slow resolver doesn't
+    # hold up the other items; items that come along meanwhile wait for the
+    # same answer. The answer is good for `interval` seconds. `resolver` is
+    # anything that turns a host name into an address, like
+    # socket.gethostbyname.
+    def __init__(self, host=CHECK_IP_HOST, prefix=CHECK_IP_PREFIX,
+                 interval=CHECK_IP_INTERVAL, resolver=socket.gethostbyname):
+        Task.__init__(self, "CheckIP")
+        self.host = host
+        self.prefix = prefix
+        self.interval = interval
+        self.resolver = resolver
+        self._address = None
+        self._checked_at = None
+        self._waiting = None
+
+    def enqueue(self, item):
+        self.start_item(item)
+
+        if (self._checked_at is not None
+            and time.time() - self._checked_at < self.interval):
+            self.finish(item, self._address, None)
+        elif self._waiting is not None:
+            self._waiting.append(item)
+        else:
             item.log_output('Checking IP address.')
-            result = socket.gethostbyname('twitch.tv')
-
-            if not result.startswith('192.16.71.'):
-                item.log_output('Got IP address: {0}'.format(result))
-                item.log_output(
-                    'Are you behind a firewall/proxy? That is a big no-no!')
-                raise Exception(
-                    'Are you behind a firewall/proxy? That is a big no-no!')
-
-        # Check only occasionally
-        if self._counter <= 0:
-            self._counter = 10
+            self._waiting = [item]
+            thread = threading.Thread(target=self.resolve,
+                args=(IOLoop.instance(),))
+            thread.daemon = True
+            thread.start()
+
+    def resolve(self, ioloop):
+        address, error = None, None
+        try:
+            address = self.resolver(self.host)
+        except Exception as e:
+            error = e
+
+        ioloop.add_callback(self.resolved, address, error)
+
+    def resolved(self, address, error):
+        # Only a proper answer gets remembered; a failed lookup is tried
+        # again for the next item.
+        if error is None:
+            self._address = address
+            self._checked_at = time.time()
+
+        waiting, self._waiting = self._waiting, None
+        for item in waiting:
+            self.finish(item, address, error)
+
+    def finish(self, item, address, error):
+        if error is None and not address.startswith(self.prefix):
+            item.log_output('Got IP address: {0}'.format(address))
+            item.log_output(
+                'Are you behind a firewall/proxy? That is a big no-no!')
+            error = Exception(
+                'Are you behind a firewall/proxy? That is a big no-no!')
+
+        if error is not None:
+            item.log_output("Failed %s for %s\n" % (self, item.description()))
+            item.log_error(self, error)
+            self.fail_item(item)
         else:
-            self._counter -= 1
+            self.complete_item(item)
 
 
 class PrepareDirectories(SimpleTask):
@@ -145,428 +554,114 @@ class PrepareDirectories(SimpleTask):
         os.makedirs(dirname)
 
         item["item_dir"] = dirname
+        item["partial_dir"] = os.path.join(CWD, PARTIAL_DIR, escaped_item_name)
         item["warc_file_base"] = "%s-%s-%s" % (self.warc_prefix, escaped_item_name,
             time.strftime("%Y%m%d-%H%M%S"))
 
         open("%(item_dir)s/%(warc_file_base)s.warc.gz" % item, "w").close()
 
 
-# Will utilize ffmpeg to sample the downloaded item.
-#
-# First, sample the video at its native resolution.  This sampling ought to be
-# regular. That is, we should sample the same frame in every period. Ex.) for a
-# 30 fps video, we should always grab the Nth frame at each second.
-#
-# This sampling rate should scale with the length of the video. A short video
-# might be afforded 2 frames per second, while an extra long video might only
-# be afforded 1 frame every 2 or 3 seconds.
-#
-# Second, after taking a native-resolution snapshot of the video, 
-#
-# 1.) shrink it down to a small but visible resolution.
-# 2.) cut the framerate down to a low but still motion-preserving number.
-#     (frame-dropping)
-#
-# Both of these parameters ought to scale with the length of the
-# source video. A relatively short video might be able to get away with
-# 480p resolution, but a longer one should be cut down to 360p or even
-# 240p resolution. A short video might have a higher preserved framerate,
-# but not a longer video.
-#
-# This high-fidelity data from taking native-resolution snapshots, in
-# combination with low-fidelity data from shrinking the resolution and dropping
-# frames, will (hopefully) constitute a minimum viable dataset that might be of
-# use to someone in the future.
-class Sample(SimpleTask):
-    def __init__(self):
-        SimpleTask.__init__(self, "Sample")
+def item_segments(item):
+    # The WARC segments of the item that are still here, oldest first.
+    if not os.path.isdir(item["partial_dir"]):
+        return []
+    return sorted(os.path.join(item["partial_dir"], filename)
+        for filename in os.listdir(item["partial_dir"])
+        if SEGMENT_NAME.search(filename))
 
-    def process(self, item):
 
-    # assert that this item is flagged for sampling. If not,
-    # return immediately. We don't want to butcher uploads that
-    # have been determined to be worth saving in their original
-    # state.
-    #
-    # Presumably, the tracker is tagging these items as something
-    # appropriate. Alternately, one could create a "Phase 3" grab
-    # and know for a fact that we are only receiving videos that
-    # should be sampled. In which case, one may skip the item_type
-    # check and proceed directly to sampling.
-
-        item_name = item['item_name']
-        item_type, item_value = item_name.split(':', 1)
-
-        item['item_type'] = item_type
-        item['item_value'] = item_value
+# The tracker hands out "video" items (a video's page and API responses)
+# and "url" items (the flv of a video), and, for videos that are only worth
+# keeping in sampled form, "video-bulk" and "url-bulk" items. Those are
+# downloaded just like the others, and then Sample truncates the video and
+# adds snapshots and a shrunken webm to the WARC instead.
+SAMPLED_ITEM_TYPES = ("video-bulk", "url-bulk")
 
-        assert item_type in ('video-bulk', 'url-bulk')
 
-        # Item type is not marked as "video-bulk" from tracker.
-        # Carry on. Nothing to do here.
-        if item_type != 'video-bulk' or 'url-bulk':
-            return
-
-        # ok. This is an item that needs to be sampled.
-
-        # remember where we started from so we can get back there and
-        # not mess up the expectations for the rest of stages in the
-        # pipeline
-        original_path = os.getcwd()
-
-        # get to item_dir ; begin work
-        os.chdir(item['item_dir'])
-
-        # we will need some data from the warcfile
-        warcinfo_record_ID = ""
-        metadata_record_ID = ""
-        truncated_record_ID = ""
-
-        # set up old and new warc files for reading and writing, respectively.
-        # If a file ends in *.gz for writing, the warc library handles gz
-        # compression transparently.
-        old_warc_file = warc.open("%(warc_file_base)s.warc.gz" % item)
-        new_warc_file = warc.open("%(warc_file_base)s-POSTPROCESSED.warc.gz" % item , "w")
-
-        # ------------------------ Start of main for loop -------------------#
-
-        # and here... we... go
-        for record in old_warc_file:
-
-            # Firstly, we detect whether the record we're iterating over holds
-            # data we'll need later. If so, behave appropriately. After the
-            # if-elif-elif dance, we proceed to copy each record into a new
-            # record in the %(warc_file_base)s-POSTPROCESSED.warc.gz file,
-            # modifying as necesary (truncated long records, etc)
-
-            # ------------------------ Check for data -------------------------#
-
-            # Grab the lengthy payload (the flv file); if the content-length is
-            # longer than ~5MiB, and the record is of the "response" type, then
-            # this record *probably* has the flv file.
-            if ((long(record['Content-Length']) >= 5000000) and record['WARC-Type'] == "response"):
-
-                # need the record id of the original flv record. Will refernece
-                # it in truncated record.
-                truncated_record_id = record['warc-record-id']
-
-                # add "WARC-Truncated" to this record, indicating that it has
-                # been truncated due to length.
-                record['warc-truncated'] = "length"
-
-                # extract the payload
-                tempfile = open("intermediate.int", 'wb')
-                for line in record.payload:
-                    tempfile.write(line)
-                tempfile.close()
-
-                # put the payload back; iterating through record.payload
-                # invokes a generator on the payload that seems to
-                # "eat up" the payload in the original file. I say so because
-                # attempting to, say, write the payload out twice (to TWO files)
-                # will fail, as will any attempt to read out the payload again
-                # without first "putting it back." (I'd love an explanation for
-                # just what's going on here; but for now, this hack works)
-                # (for the record with the long content-length, we end up reading
-                # the payload twice; once here, to get it to a separate file, and
-                # once again, in COPY PAYLOAD, to write out a truncated version to
-                # the new warc file)
-                stream = StringIO(open("intermediate.dat", 'rb').read())
-                stream.seek(0, os.SEEK_END)
-                streamlength = stream.tell()
-                stream.seek(0)
-                record.payload = warc.utils.FilePart(fileobj = stream, length = streamlength)
-
-                # can't close the stream yet for some reason. This might
-                # introduce leaks of some sort, so keep an eye on it.
-                # The relevant error: "IO Operation on a closed file."
-                # I suspect this operation occurs somewhere in the warc library,
-                # and i'm hoping that the stream object just falls out of scope
-                # at some point other than when the entire pipeline shuts down.
-                # stream.close()
-
-            # Adjust the warcinfo record to note that we also utilized ffmpeg
-            elif (record['WARC-Type'] == "warcinfo"):
-
-                # grab the record-id for later use in resource records
-                warcinfo_record_ID = record['warc-record-id']
-
-                # gotta add another "software" key to the content-block of the
-                # warcinfo record that indicates the use of ffmpeg.
-                warcinfo_stream = StringIO()
-                for line in record.payload:
-                    warcinfo_stream.write(line)
-
-                # trailing \r\n\r\n is already present in the payload; just seek back
-                # two bytes (yes, the second \r\n will get clobbered; potential unicode
-                # byte-length issues here) and then tack on the additional lines you
-                # need to like so:
-                warcinfo_stream.seek(-2,os.SEEK_END)
-                warcinfo_stream.write("software: ffmpeg/2.3.1\r\n\r\n")
-                warcinfo_stream.seek(0, os.SEEK_END)
-                warcinfo_stream_len = warcinfo_stream.tell()
-                warcinfo_stream.seek(0)
-                record.payload = warc.utils.FilePart(fileobj=warcinfo_stream,length=warcinfo_stream_len)
-
-            # Get the metadata record's warc-record-id for later resource
-            # records.
-            elif (record['WARC-Type'] == "metadata"):
-
-                metadata_record_ID = record['warc-record-id']
-
-            # End of conditionals. Proceed to write the new record to the
-            # post-processed warcfile.
-
-            # ------------------------ Copy Record -------------------------#
-
-            # COPY HEADER
-
-            # Should we add defaults=False ? It seems that some additional headers
-            # are added in WARCHeader as well as WARCRecord. However, they don't
-            # seem harmful: digests and timestamps.
-            new_header = warc.WARCHeader(record.header)
-
-            # COPY PAYLOAD
-
-            # if the current record gets truncated, then set the content-length
-            # to the new, truncated length as per spec.
-            truncated_flag = None
-
-            # SHORT record payloads
-            if long(record['content-length']) < 500000:
-
-                #print "Copying payload..."
-                new_payload = StringIO()
-                for line in record.payload:
-                    new_payload.write(line)
-                #if we don't seek back to 0, new_payload.read() is empty
-                new_payload.seek(0)
-                #print "Done copying payload."
-
-            # LONG record payloads (the one that probably has video data)
-            else:
-
-            #print "Found long content-length. Truncating..."
-                new_payload = StringIO()
-                decrement = 25
-                #Grab some lines
-                #print "Gonna grab some lines. Decrement: ", decrement
-                for line in record.payload:
-                    #print "Grabbing a line."
-                    new_payload.write(line)
-                    decrement -= 1
-                    #print "Decrement: ", decrement
-                    if decrement == 0:
-                        break
-                # be kind: rewind
-                new_payload.seek(0)
-                truncated_flag = True
-
-                #print "Done truncating."
-
-            # CREATE RECORD FROM HEADER AND PAYLOAD
-
-            new_rec = warc.WARCRecord(payload=new_payload.read(), headers=new_header, defaults=False)
-
-            # if this record happened to be one that got truncated, then we
-            # need to adjust its content-length header.
-            if truncated_flag:
-
-                #print "Adjusting content-length header"
-
-                # From page 9 of the ISO WARC Standard:
-                #
-                # "The WARC-Truncated field may be used on any WARC record. The WARC
-                # field Content-Length shall still report the actual truncated size of
-                # the record block."
-
-                # Get the length of the truncated content-block and set
-                # Content-Length header appropriately
-                new_payload.seek(0)
-                new_payload.seek(0, os.SEEK_END)
-                thelength = new_payload.tell()
-                new_rec['content-length'] = str(thelength)
-                new_payload.seek(0)
-
-            # WRITE THE NEW RECORD OUT TO THE NEW WARCFILE
-
-            # (the warc library handles the gz-compression and putting each record
-            # in a separate gz "member" transparently; no need to much with the gzip
-            # library ourselves)
-
-            #print "Copying record to new .warc.gz"
-            new_warc_file.write_record(new_rec)
-            #print "Done copying record to new .warc.gz"
-            #print "\n\n"
-
-        #------------------------ END OF MAIN FOR LOOP ------------------------#
-
-        # at this point, we have a new warcfile with copied and truncated
-        # records; now, we need to sample the content and add these "conversion"
-        # records to the warc file.
-
-        # Should probably delete old warc at this point, since new warcfile has all
-        # of the old records, and we've already got another copy of the main
-        # payload. If we proceed to write out the full newfile with the shrunken
-        # payload before deleting the old warc, we'll basically be using nearly
-        # 3x the interim diskspace rather than 2x. (Don't get me wrong, I'd love
-        # to have more of a generator-like setup that negates the need to use
-        # twice the disk space, but it's beyond the scope of my abilities at the
-        # moment and I don't think I'd be able to get up to speed before the
-        # deadline for this project drops (August 27 2014) Update: LOL Twitch is
-        # already deleting things on August 26; oh well, I suppose this code
-        # could come in handy if the IA suddenly needs to compress lots of
-        # material)
-
-        # Now, we need to convert the flv, and add conversion records
-
-        # Our "payload.flv" is not quite an flv yet; the payload still includes the
-        # HTTP Response headers. We need to grep for "CRLFCRLF" and then chop off
-        # anything prior to it, including it, leaving nothing but the flv file for
-        # ffmpeg to work with.
-        thefile = open("intermediate.int").read() # NOT A FILE; just a "str"
-        theflv = thefile.split('\r\n\r\n')[1]
-        writetheflv = open("samplethis.flv", "w")
-        writetheflv.write(theflv)
-        writetheflv.close()
-
-        # Get Snapshots
-        SnapShot()
-
-        # Get shrinked video
-        ShrinkRay()
-
-        # Clean up
-        print("********************* \n\n Removing temporary files; cleaning up \n\n*********************")
-        # remove original file intermediates: "intermediate.int" and "samplethis.flv"
-        rmargs = shlex.split("rm intermediate.int samplethis.flv")
-        call(rmargs)
-
-        # And we're done!
-        new_warc_file.close()
-        os.chdir(original_path)
-
-    ###################
-    # Sampling routines
-    #
+def is_url_item(item):
+    return item["item_name"].split(":", 1)[0] in ("url", "url-bulk")
 
-    # High fidelity snapshots
-    def SnapShot():
-
-        # TODO:
-        # figure out length of video and develop native-resolution frame
-        # sampling rate based off of this length.
-
-        print("********************* \n\n Getting snapshots. \n\n*********************")
-
-        os.environ["FFREPORT"] = "file=ffmpeg-snapshots.log"
-
-        # snapshot
-        # This is the "proper" way to handle complex command lines with lots of args
-        # https://stackoverflow.com/questions/8581140/python-subprocess-call-with-arguments-having-multiple-quotations
-        ffmpegsnapshotargs = shlex.split("ffmpeg -i samplethis.flv -vf fps=fps=1/15 -f image2 -q:v 1 images%05d.jpg")
-        call(ffmpegsnapshotargs)
-
-        print("********************* \n\n Compressing snapshots. \n\n*********************")
-
-        imagelist = glob.glob("*.jpg")
-        imageliststring = ' '.join(imagelist)
-        tarcommand = "tar -czvf snapshots.tar.gz " + imageliststring
-
-        # compress all the snapshots
-        tarargs = shlex.split(tarcommand)
-        call(tarargs)
-
-        # delete jpgs
-        rmcommand = "rm " + imageliststring
-        rmargs = shlex.split(rmcommand)
-        call(rmargs)
-
-        os.environ["FFREPORT"] = ""
-
-        # Add ffmpeg log record
-        ffmpegsampleheader = warc.WARCHeader({
-            "WARC-Type": "resource",
-            "WARC-Warcinfo-ID": warcinfo_record_ID,
-            "Content-Type": "text/plain",
-            "WARC-Concurrent-To": metadata_record_ID
-        })
-        ffmpegsamplepayload = StringIO(open("ffmpeg-snapshots.log").read()).getvalue()
-        ffmpegsamplerecord = warc.WARCRecord(headers=ffmpegsampleheader,payload=ffmpegsamplepayload)
-        new_warc_file.write_record(ffmpegsamplerecord)
-
-        # Add the actual snapshot record
-        snapshotrecord = warc.WARCRecord(
-            headers = warc.WARCHeader({
-                "WARC-Type": "conversion",
-                "Content-Type": "application/x-gtar",
-                "WARC-Refers-To": truncated_record_ID
-            }),
-            payload = StringIO(open("snapshots.tar.gz").read()).getvalue()
-        )
-        new_warc_file.write_record(snapshotrecord)
 
-        # remove snapshots and log
-        call(shlex.split("rm snapshots.tar.gz ffmpeg-snapshots.log"))
+def is_sampled_item(item):
+    return item["item_name"].split(":", 1)[0] in SAMPLED_ITEM_TYPES
 
-        # end of SnapShot()
 
-    # Low fidelity, shrinked video
-    def ShrinkRay():
+class SegmentSize(object):
+    # The --segment-size of an item's download: none for a video that gets
+    # sampled, which has to be in the item's WARC in one piece for Sample
+    # (and must not go up before it's been truncated).
+    def __init__(self, segment_size):
+        self.segment_size = segment_size
 
-        # TODO:
-        # figure out length of video and develop number of frames to
-        # drop out of every FPS interval.
-
-        print("********************* \n\n Shrinking Video. (This will take a while) \n\n*********************")
-
-        os.environ["FFREPORT"] = "file=ffmpeg-shrinking.log"
+    def realize(self, item):
+        if is_sampled_item(item):
+            return "0"
+        return "%d" % realize(self.segment_size, item)
 
-        # shrink; using the webm format at this resolution cuts the file size by
-        # *about* an order of magnitude, while still maintaining more-or-less
-        # perfectly crisp detail and motion. I'm thinking we don't need to drop
-        # frames, and that cutting the resolution down to this ~240P-level
-        # resolution is good enough.
 
-        # We really need to check for resolution and select an output resolution
-        # appropriately; this one-liner only works for 16:9 inputs
+class DownloadMedia(ExternalProcess):
+    # Downloads the flv of a "url" item with download.py rather than wget,
+    # so that an interrupted download can be resumed with Range requests
+    # instead of starting from scratch, and so that a big one can come in
+    # over several connections at once. See there for how.
+    def __init__(self):
+        ExternalProcess.__init__(self, "DownloadMedia", MeasuredArgs("DownloadMedia", [
+            sys.executable,
+            os.path.join(CWD, "download.py"),
+            "--user-agent", USER_AGENT,
+            "--connections", ConfigInterpolation("%d", NumberConfigValue(
+                min=1, max=16, default="1",
+                name="twitchtv:download_connections",
+                title="Download connections",
+                description="How many parts of a video to download at once.")),
+            "--segment-size", SegmentSize(NumberConfigValue(
+                min=0, max=100000, default="0",
+                name="twitchtv:warc_segment_size",
+                title="WARC segment size",
+                description="Upload big videos in WARCs of this many MB while "
+                    "they download, to save disk space (0: in one piece).")),
+            "--warc-header", "operator: Archive Team",
+            "--warc-header", "twitchtv-dld-script-version: " + VERSION,
+            "--warc-header", ItemInterpolation("twitchtv-user: %(item_name)s"),
+            "--checkpoint-dir", ItemInterpolation("%(partial_dir)s"),
+            ItemInterpolation("%(item_value)s"),
+            ItemInterpolation("%(item_dir)s"),
+            ItemInterpolation("%(warc_file_base)s"),
+        ]), max_tries=2, env=dict(os.environ))
 
-        ffmpegshrinkargs = shlex.split("ffmpeg -i samplethis.flv -c:v libvpx -b:v 500K -c:a libvorbis -s 432x243 shrunken-to-webm.webm")
-        call(ffmpegshrinkargs)
+    def enqueue(self, item):
+        item["item_value"] = item["item_name"].split(":", 1)[1]
+        ExternalProcess.enqueue(self, item)
 
-        # The final size of snapshots and shrunken video is anywhere from a fifth to
-        # a seventh of the original file size.
 
-        os.environ["FFREPORT"] = ""
+class Sample(ExternalProcess):
+    # Runs postprocess.py for a "-bulk" item in a process of its own. See
+    # there for the gory details of how the video gets sampled.
+    def __init__(self):
+        args = [
+            sys.executable,
+            os.path.join(CWD, "postprocess.py"),
+            "sample",
+            "--ffmpeg", FFMPEG,
+            "--ffmpeg-version", FFMPEG_VERSION,
+            "--compression", WARC_COMPRESSION,
+        ]
 
-        # add ffmpeg log record
-        ffmpegshrinkheader = warc.WARCHeader({
-            "WARC-Type": "resource",
-            "WARC-Warcinfo-ID": warcinfo_record_ID,
-            "Content-Type": "text/plain",
-            "WARC-Concurrent-To": metadata_record_ID
-        })
-        ffmpegshrinkpayload = StringIO(open("ffmpeg-shrinking.log").read()).getvalue()
-        ffmpegshrinkrecord = warc.WARCRecord(headers=ffmpegshrinkheader,payload=ffmpegshrinkpayload)
-        new_warc_file.write_record(ffmpegshrinkrecord)
+        if os.path.exists(os.path.join(CWD, ZSTD_DICTIONARY)):
+            args.extend(["--zstd-dictionary", os.path.join(CWD, ZSTD_DICTIONARY)])
 
-        # add actual shrunken webm record
-        shrinkrecord = warc.WARCRecord(
-            headers = warc.WARCHeader({
-                "WARC-Type": "conversion",
-                "Content-Type": "video/webm",
-                "WARC-Refers-To": truncated_record_ID
-            }),
-            payload = StringIO(open("shrunken-to-webm.webm").read()).getvalue()
-        )
-        new_warc_file.write_record(shrinkrecord)
+        # Retried and requeued items don't get transcoded all over again.
+        args.extend(["--cache-dir", os.path.join(CWD, SAMPLE_CACHE_DIR)])
 
-        # remove log file
-        call(shlex.split("rm snapshots.tar.gz ffmpeg-shrinking.log"))
+        args.extend([
+            ItemInterpolation("%(item_name)s"),
+            ItemInterpolation("%(item_dir)s"),
+            ItemInterpolation("%(warc_file_base)s"),
+        ])
 
-        # end of ShrinkRay()
+        ExternalProcess.__init__(self, "Sample", MeasuredArgs("Sample", args),
+            env=dict(os.environ))
 
-    #end of class Sample(SimpleTask)
 
 class MoveFiles(SimpleTask):
     def __init__(self):
@@ -578,20 +673,288 @@ class MoveFiles(SimpleTask):
         if os.path.exists("%(item_dir)s/%(warc_file_base)s.warc"):
             raise Exception('Please compile wget with zlib support!')
 
-        os.rename("%(item_dir)s/%(warc_file_base)s.warc.gz" % item,
-              "%(data_dir)s/%(warc_file_base)s.warc.gz" % item)
+        # If Sample made a post-processed warc, that's the one we upload.
+        item["warc_file_name"] = "%(warc_file_base)s.warc.gz" % item
+        for extension in ("zst", "gz"):
+            warc_file_name = "%s-POSTPROCESSED.warc.%s" % (item["warc_file_base"], extension)
+            if os.path.exists(os.path.join(item["item_dir"], warc_file_name)):
+                item["warc_file_name"] = warc_file_name
+                break
+
+        # Its record index, if there is one, goes up right next to it. The
+        # empty placeholder PrepareDirectories made never goes up, though:
+        # that's all that is left of a video whose segments UploadSegments
+        # already sent off.
+        upload_files = [os.path.join(item["item_dir"], item["warc_file_name"])]
+        if not os.path.getsize(upload_files[0]):
+            upload_files = []
+
+        # Or the segments of a video that UploadSegments didn't get to.
+        segments = item_segments(item)
+        if segments and item["warc_file_name"] == "%(warc_file_base)s.warc.gz" % item:
+            upload_files = segments
+        if os.path.exists("%(item_dir)s/%(warc_file_base)s-POSTPROCESSED.cdxj" % item):
+            upload_files.append("%(item_dir)s/%(warc_file_base)s-POSTPROCESSED.cdxj" % item)
+
+        if not upload_files and not item.get("segment_bytes"):
+            raise Exception("No WARC to upload.")
+
+        item["upload_files"] = []
+        for path in upload_files:
+            new_path = os.path.join(item["data_dir"], os.path.basename(path))
+            shutil.move(path, new_path)
+            item["upload_files"].append(new_path)
+
+        # The CDX wget wrote stays around (but isn't uploaded), for
+        # UpdateAssetIndex to look at once the upload went through.
+        item_cdx = "%(item_dir)s/%(warc_file_base)s.cdx" % item
+        if os.path.exists(item_cdx):
+            item["asset_cdx"] = os.path.join(item["data_dir"],
+                os.path.basename(item_cdx))
+            os.rename(item_cdx, item["asset_cdx"])
 
         shutil.rmtree("%(item_dir)s" % item)
+        # The download is done with, and so is its checkpoint.
+        shutil.rmtree(item["partial_dir"], ignore_errors=True)
+
+
+class UploadSlots(object):
+    # The number of uploads that may run at once, shared by the Upload stage
+    # and UploadSegments. Works like LimitConcurrent.
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self._queue = []
+        self._working = 0
+
+    def acquire(self, item, start):
+        # Calls start() when an upload may start.
+        if self._working < realize(self.concurrency, item):
+            self._working += 1
+            start()
+        else:
+            self._queue.append(start)
+
+    def release(self):
+        self._working -= 1
+        if len(self._queue) > 0:
+            self._working += 1
+            self._queue.pop(0)()
+
+
+class LimitUploads(Task):
+    # LimitConcurrent, with the limit in UploadSlots.
+    def __init__(self, slots, inner_task):
+        Task.__init__(self, "LimitUploads")
+        self.slots = slots
+        self.inner_task = inner_task
+        self.inner_task.on_complete_item += self._inner_task_complete_item
+        self.inner_task.on_fail_item += self._inner_task_fail_item
+
+    def enqueue(self, item):
+        self.slots.acquire(item, lambda: self.inner_task.enqueue(item))
+
+    def _inner_task_complete_item(self, task, item):
+        self.slots.release()
+        self.complete_item(item)
+
+    def _inner_task_fail_item(self, task, item):
+        self.slots.release()
+        self.fail_item(item)
+
+    def fill_ui_task_list(self, task_list):
+        self.inner_task.fill_ui_task_list(task_list)
+
+    def __str__(self):
+        return "LimitUploads(" + str(self.inner_task) + ")"
+
+
+def upload_task(files, source_path):
+    return UploadWithTracker(
+        "http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
+        downloader=downloader,
+        version=VERSION,
+        files=files,
+        rsync_target_source_path=source_path,
+        rsync_extra_args=[
+            "--recursive",
+            "--partial",
+            "--partial-dir", ".rsync-tmp",
+            "--sockopts=SO_SNDBUF=16777216,SO_RCVBUF=16777216"  # speedbooster!!!
+        ]
+        )
+
+
+class UploadSegments(Task):
+    # While `inner_task` (DownloadMedia) runs, uploads every WARC segment
+    # download.py finishes, taking turns with the other uploads, and deletes
+    # it once it's up. The item goes on when the download is done and no
+    # segment is on its way any more; whatever is left goes up with the rest
+    # of the item.
+    def __init__(self, slots, inner_task):
+        Task.__init__(self, "UploadSegments")
+        self.slots = slots
+        self.inner_task = inner_task
+        self.inner_task.on_complete_item += self._inner_task_complete_item
+        self.inner_task.on_fail_item += self._inner_task_fail_item
+        self._items = {}
+
+    def enqueue(self, item):
+        state = {
+            "uploading": set(),
+            "finished": None,
+            "timer": PeriodicCallback(lambda: self.scan(item),
+                SEGMENT_SCAN_INTERVAL * 1000),
+        }
+        self._items[id(item)] = state
+        state["timer"].start()
+        self.inner_task.enqueue(item)
+
+    def scan(self, item):
+        state = self._items[id(item)]
+        for segment in item_segments(item):
+            if segment not in state["uploading"]:
+                state["uploading"].add(segment)
+                self.slots.acquire(item,
+                    functools.partial(self.upload, item, segment))
+
+    def upload(self, item, segment):
+        item.log_output("Uploading %s while downloading the rest." %
+            os.path.basename(segment))
+        task = upload_task([segment], ItemInterpolation("%(partial_dir)s/"))
+        task.on_complete_item += lambda task, item: self.uploaded(item, segment)
+        task.enqueue(item)
+
+    def uploaded(self, item, segment):
+        state = self._items[id(item)]
+        item["segment_bytes"] = (item.get("segment_bytes") or 0) + \
+            os.path.getsize(segment)
+        os.remove(segment)
+        state["uploading"].remove(segment)
+        self.slots.release()
+        self.finish(item)
+
+    def finish(self, item):
+        state = self._items[id(item)]
+        if state["finished"] is None or state["uploading"]:
+            return
+
+        del self._items[id(item)]
+        if state["finished"] == "complete":
+            self.complete_item(item)
+        else:
+            self.fail_item(item)
+
+    def _inner_task_complete_item(self, task, item):
+        # One last look, for the segments written since the last one.
+        self._items[id(item)]["timer"].stop()
+        self._items[id(item)]["finished"] = "complete"
+        self.scan(item)
+        self.finish(item)
+
+    def _inner_task_fail_item(self, task, item):
+        self._items[id(item)]["timer"].stop()
+        self._items[id(item)]["finished"] = "failed"
+        self.finish(item)
+
+    def fill_ui_task_list(self, task_list):
+        self.inner_task.fill_ui_task_list(task_list)
+
+    def __str__(self):
+        return "UploadSegments(" + str(self.inner_task) + ")"
+
+
+class PrepareStats(PrepareStatsForTracker):
+    # Counts the segments UploadSegments already sent off as data, too, and
+    # says how much disk space the item reserved.
+    def process(self, item):
+        PrepareStatsForTracker.process(self, item)
+        item["stats"]["bytes"]["data"] += item.get("segment_bytes") or 0
+        for segment in item_segments(item):
+            item["stats"]["bytes"]["data"] += os.path.getsize(segment)
+
+        item["stats"]["disk"] = {
+            "reserved": item.get("disk_reserved") or 0,
+            "waited": round(item.get("disk_waited") or 0, 1),
+        }
+
+
+class UpdateAssetIndex(SimpleTask):
+    # Adds the assets of the item's CDX (from wget --warc-cdx) to the index
+    # wget dedups against. Only the first record of an asset is ever listed;
+    # seeing it again only moves it to the end, away from eviction.
+    #
+    # This has to wait until the item is uploaded: the revisit records of
+    # later items are no good if the records they point to never made it.
+    def __init__(self):
+        SimpleTask.__init__(self, "UpdateAssetIndex")
+
+    def process(self, item):
+        item_cdx = item.get("asset_cdx")
+        if not item_cdx or not os.path.exists(item_cdx):
+            return
+
+        index_name = os.path.join(CWD, ASSET_INDEX)
+        header = None
+        assets = collections.OrderedDict()
+        added = 0
+
+        for file_name in (index_name, item_cdx):
+            if not os.path.exists(file_name):
+                continue
+
+            with open(file_name) as f:
+                fields = f.readline().split()[1:]
+
+                if header is None:
+                    header = fields
+                elif fields != header:
+                    # Some other wget's idea of a CDX; start over with it.
+                    header = fields
+                    assets.clear()
+
+                for line in f:
+                    record = dict(zip(fields, line.split()))
+                    key = (record.get("a"), record.get("k"))
+
+                    if (record.get("s") != "200"
+                        or record.get("m", "").startswith("warc/")
+                        or record.get("m", "").split(";")[0] in ASSET_INDEX_SKIP_TYPES):
+                        continue
+
+                    if key in assets:
+                        assets[key] = assets.pop(key)
+                    else:
+                        assets[key] = line
+                        if file_name == item_cdx:
+                            added += 1
+
+        if not assets or not set("akbu").issubset(header):
+            return
+
+        while len(assets) > ASSET_INDEX_SIZE:
+            assets.popitem(last=False)
+
+        with open(index_name + ".tmp", "w") as f:
+            f.write(" CDX %s\n" % " ".join(header))
+            f.writelines(assets.values())
+        os.rename(index_name + ".tmp", index_name)
+
+        item.log_output("%d new assets, %d in the index." % (added, len(assets)))
 
 
 def get_hash(filename):
-    with open(filename, 'rb') as in_file:
-        return hashlib.sha1(in_file.read()).hexdigest()
+    def probe(filename):
+        with open(filename, 'rb') as in_file:
+            return hashlib.sha1(in_file.read()).hexdigest()
+
+    return cached_probe("sha1", filename, probe)
 
 
 CWD = os.getcwd()
 PIPELINE_SHA1 = get_hash(os.path.join(CWD, 'pipeline.py'))
 LUA_SHA1 = get_hash(os.path.join(CWD, 'twitchtv.lua'))
+POSTPROCESS_SHA1 = get_hash(os.path.join(CWD, 'postprocess.py'))
+DOWNLOAD_SHA1 = get_hash(os.path.join(CWD, 'download.py'))
 
 
 def stats_id_function(item):
@@ -599,12 +962,61 @@ def stats_id_function(item):
     d = {
         'pipeline_hash': PIPELINE_SHA1,
         'lua_hash': LUA_SHA1,
+        'postprocess_hash': POSTPROCESS_SHA1,
+        'download_hash': DOWNLOAD_SHA1,
         'python_version': sys.version,
     }
 
     return d
 
 
+# VIDEO_PAGE_CACHE, as of when it was last read.
+video_page_cache = {"file": None, "pages": {}}
+
+
+def load_video_page_cache():
+    # Returns the video pages by video ID, reading the file again only if
+    # twitchtv.lua added to it since. If it has more lines than it needs to
+    # (a video that came up twice, or too many videos), it's tidied up.
+    path = os.path.join(CWD, VIDEO_PAGE_CACHE)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return {}
+
+    file_key = [st.st_ino, st.st_size, st.st_mtime]
+    if file_key == video_page_cache["file"]:
+        return video_page_cache["pages"]
+
+    pages = collections.OrderedDict()
+    line_count = 0
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2:
+                line_count += 1
+                pages.pop(fields[0], None)
+                pages[fields[0]] = fields[1]
+
+    while len(pages) > VIDEO_PAGE_CACHE_SIZE:
+        pages.popitem(last=False)
+
+    if line_count > len(pages):
+        with open(path + ".tmp", "w") as f:
+            f.writelines("%s %s\n" % page for page in pages.items())
+        os.rename(path + ".tmp", path)
+        st = os.stat(path)
+        file_key = [st.st_ino, st.st_size, st.st_mtime]
+
+    video_page_cache["file"] = file_key
+    video_page_cache["pages"] = pages
+    return pages
+
+
+def cached_video_page(video_id):
+    return load_video_page_cache().get(video_id)
+
+
 class WgetArgs(object):
     def realize(self, item):
         wget_args = [
@@ -631,8 +1043,13 @@ class WgetArgs(object):
             "--warc-header", "operator: Archive Team",
             "--warc-header", "twitchtv-dld-script-version: " + VERSION,
             "--warc-header", ItemInterpolation("twitchtv-user: %(item_name)s"),
+            "--warc-cdx",
         ]
 
+        # Assets earlier items already got become revisit records
+        if os.path.exists(os.path.join(CWD, ASSET_INDEX)):
+            wget_args.extend(["--warc-dedup", os.path.join(CWD, ASSET_INDEX)])
+
         # Randomly get the assets
         if random.randint(1, 10) == 1:
             wget_args.extend(["--domains", "twitch.tv,justin.tv,jtvnw.net", ])
@@ -645,25 +1062,29 @@ class WgetArgs(object):
         item['item_type'] = item_type
         item['item_value'] = item_value
 
-        assert item_type in ('video', 'url')
+        # "url" items are downloaded by DownloadMedia, with download.py,
+        # not by wget.
+        assert item_type in ('video', 'video-bulk')
 
-        if item_type == 'video':
+        if item_type in ('video', 'video-bulk'):
             video_id, username = item_value.split(':', 1)
             video_type = video_id[0:1]
-            video_num = video_id[1:]
 
             assert video_type in ('a', 'b', 'c')
 
-            # I guess we should have scraped for a video type since they don't
-            # match the video ID.
-            for video_type_ in ('a', 'b', 'c'):
-                wget_args.append('http://www.twitch.tv/{0}/{1}/{2}'.format(username, video_type_, video_num))
+            # The video type in the page URL doesn't always match the video
+            # ID, so the page comes from the kraken response: twitchtv.lua
+            # queues the "url" it gives (or all three types if it has none).
+            # If we've been told before, fetch the page straight away.
+            video_page = cached_video_page(video_id)
 
-            wget_args.append('https://api.twitch.tv/kraken/videos/{0}'.format(video_id))
+            if video_page:
+                wget_args.append(video_page)
+
+            # so twitchtv.lua only adds to the cache what it doesn't know
+            item['known_video_page'] = video_page or ""
 
-        elif item_type == 'url':
-            # This should be a URL to a flv
-            wget_args.append(item_value)
+            wget_args.append('https://api.twitch.tv/kraken/videos/{0}'.format(video_id))
 
         else:
             raise Exception('Unknown item')
@@ -693,22 +1114,39 @@ project = Project(
     utc_deadline=datetime.datetime(2014, 8, 27, 23, 59, 0)
 )
 
+# Uploads of finished items and of the segments of videos still downloading
+# take turns.
+UPLOAD_SLOTS = UploadSlots(NumberConfigValue(min=1, max=4, default="1",
+    name="shared:rsync_threads", title="Rsync threads",
+    description="The maximum number of concurrent uploads."))
+
+# What the items in progress may still write to disk.
+DISK_RESERVATIONS = DiskReservations()
+
 pipeline = Pipeline(
-    CheckIP(),
+    Measured("CheckIP", CheckIP()),
+    WaitForDiskSpace("WaitForDiskSpace", DISK_RESERVATIONS,
+        lambda item: MIN_FREE_SPACE),
     GetItemFromTracker("http://%s/%s" % (TRACKER_HOST, TRACKER_ID), downloader,
         VERSION),
-    PrepareDirectories(warc_prefix="twitchtv"),
-    WgetDownload(
-        WgetArgs(),
-        max_tries=2,
-        accept_on_exit_code=[0, 8],
-        env={
-            "item_dir": ItemValue("item_dir"),
-            "item_value": ItemValue("item_value"),
-            "item_type": ItemValue("item_type"),
-        }
-    ),
-    PrepareStatsForTracker(
+    Measured("PrepareDirectories", PrepareDirectories(warc_prefix="twitchtv")),
+    ReserveDiskSpace(DISK_RESERVATIONS),
+    ConditionalTask(lambda item: not is_url_item(item), Measured("WgetDownload",
+        WgetDownload(
+            MeasuredArgs("WgetDownload", WgetArgs()),
+            max_tries=2,
+            accept_on_exit_code=[0, 8],
+            env={
+                "item_dir": ItemValue("item_dir"),
+                "item_value": ItemValue("item_value"),
+                "item_type": ItemValue("item_type"),
+                "video_page_cache": os.path.join(CWD, VIDEO_PAGE_CACHE),
+                "known_video_page": ItemValue("known_video_page"),
+            }
+        ))),
+    ConditionalTask(is_url_item, UploadSegments(UPLOAD_SLOTS,
+        Measured("DownloadMedia", DownloadMedia()))),
+    PrepareStats(
         defaults={"downloader": downloader, "version": VERSION},
         file_groups={
             "data": [
@@ -717,27 +1155,19 @@ pipeline = Pipeline(
         },
         id_function=stats_id_function,
     ),
-    Sample(),
-    MoveFiles(),
-    LimitConcurrent(NumberConfigValue(min=1, max=4, default="1",
-        name="shared:rsync_threads", title="Rsync threads",
-        description="The maximum number of concurrent uploads."),
-        UploadWithTracker(
-            "http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
-            downloader=downloader,
-            version=VERSION,
-            files=[
-                ItemInterpolation("%(data_dir)s/%(warc_file_base)s.warc.gz")
-            ],
-            rsync_target_source_path=ItemInterpolation("%(data_dir)s/"),
-            rsync_extra_args=[
-                "--recursive",
-                "--partial",
-                "--partial-dir", ".rsync-tmp",
-                "--sockopts=SO_SNDBUF=16777216,SO_RCVBUF=16777216"  # speedbooster!!!
-            ]
-            ),
-    ),
+    ConditionalTask(is_sampled_item, LimitConcurrent(NumberConfigValue(
+        min=1, max=8, default="1",
+        name="twitchtv:sample_threads", title="Sample threads",
+        description="The maximum number of videos to sample at once."),
+        Measured("Sample", Sample()),
+    )),
+    Measured("MoveFiles", MoveFiles()),
+    ConditionalTask(lambda item: item["upload_files"], LimitUploads(UPLOAD_SLOTS,
+        Measured("Upload", upload_task(ItemValue("upload_files"),
+            ItemInterpolation("%(data_dir)s/")), size_function=upload_size),
+    )),
+    Measured("UpdateAssetIndex", UpdateAssetIndex()),
+    ReportStageStats(),
     SendDoneToTracker(
         tracker_url="http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
         stats=ItemValue("stats")
@@ -0,0 +1,2050 @@
+# encoding=utf8
+#
+# Post-processing of a grabbed item: truncates the video record in the item's
+# WARC and adds sampled versions of the video (snapshots and a shrunken webm)
+# as conversion records, in a new %(warc_file_base)s-POSTPROCESSED.warc.gz,
+# with a CDXJ index of its records in %(warc_file_base)s-POSTPROCESSED.cdxj.
+#
+# This runs in a process of its own, started by the Sample task in
+# pipeline.py, so that a long transcode never holds up the downloads and
+# uploads of the other items:
+#
+#     python postprocess.py sample --ffmpeg /usr/bin/ffmpeg ITEM_NAME ITEM_DIR WARC_FILE_BASE
+#
+# It can also train a zstd dictionary for .warc.zst output on some grabbed
+# WARCs, and compare gzip and zstd on them:
+#
+#     python postprocess.py train-dictionary twitchtv.zstd-dictionary WARC...
+#     python postprocess.py benchmark --zstd-dictionary twitchtv.zstd-dictionary WARC...
+#
+# And it can post-process WARCs that were grabbed long ago, lots at a time:
+#
+#     python postprocess.py batch --jobs 16 --output-dir /data/sampled /data/warcs
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+import sys
+import tarfile
+import zlib
+import tempfile
+import time
+import traceback
+import urlparse
+# for compressing the new warc on several cores
+from multiprocessing.pool import ThreadPool
+# for sampling lots of old warcs at once
+import multiprocessing
+
+# for properly parsing command line strings for insertion into call()s
+import shlex
+# for globbing files in a given path
+import glob
+# for making subprocesses (ffmpeg, tar, etc)
+from subprocess import call, Popen, PIPE
+# for manipulating warc files (open, write, read, close, compress)
+import warc
+
+# zstd compressed warcs are optional, and need the zstandard module
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+###########################################################################
+# Streaming WARC helpers.
+#
+# The warc library wants whole payloads as strings when writing records,
+# which is no good for multi-GB videos. These helpers write a record's
+# header and block straight to the (gzip) file object of a warc.WARCFile
+# instead, a chunk at a time.
+
+# Records are copied in chunks of this many bytes.
+WARC_CHUNK_SIZE = 1024 * 1024
+
+# How much of a truncated record's block is kept in the post-processed warc.
+TRUNCATED_BLOCK_LENGTH = 64 * 1024
+
+
+def write_record_header(warc_file, header, block_start=""):
+    # `block_start` is as much of the block as is at hand, for the index to
+    # find the HTTP headers in.
+    begin_index_entry(warc_file, header, block_start)
+    header.write_to(warc_file.fileobj)
+
+
+def copy_record_block(payload, out_file, length, tee_file=None):
+    # Copies the first `length` bytes of `payload` to `out_file`. The payload
+    # is always read to the end, so the warc reader never has to slurp the
+    # rest of it in one go; if `tee_file` is given, the whole payload is
+    # written to it as well.
+    remaining = length
+    while True:
+        chunk = payload.read(WARC_CHUNK_SIZE)
+        if not chunk:
+            break
+        if remaining > 0:
+            out_file.write(chunk[:remaining])
+            remaining -= len(chunk)
+        if tee_file is not None:
+            tee_file.write(chunk)
+
+
+def finish_record(warc_file):
+    # Each record ends with two CRLFs and lives in its own gzip member.
+    warc_file.fileobj.write("\r\n\r\n")
+    if isinstance(warc_file.fileobj,
+            (warc.gzip2.GzipFile, ParallelGzipWriter, ZstdWARCWriter)):
+        warc_file.fileobj.close_member()
+    end_index_entry(warc_file)
+
+
+# The post-processed warc is compressed at this level, by this many threads,
+# in blocks of this many bytes.
+COMPRESS_LEVEL = 9
+COMPRESS_THREADS = 1
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+
+# gzip member header: deflate, no flags, no mtime, unknown OS
+GZIP_MEMBER_HEADER = "\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+
+def deflate_block(data, level, flush_mode):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(flush_mode)
+
+
+class ParallelGzipWriter(object):
+    # Writes a multi-member gzip file, one member per record, like
+    # warc.gzip2.GzipFile does, but deflates big records on several threads.
+    #
+    # The data of a member is cut into blocks of COMPRESS_BLOCK_SIZE bytes
+    # that are compressed independently (zlib lets go of the GIL while it
+    # works), each ending on a sync flush, so that the blocks simply follow
+    # one another in a single, ordinary deflate stream. This is what pigz
+    # does; any gzip reader can read the result. The CRC is computed as the
+    # data comes in.
+
+    def __init__(self, fileobj, level=COMPRESS_LEVEL, threads=COMPRESS_THREADS):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads
+        self.pool = ThreadPool(threads) if threads > 1 else None
+
+        # compressed blocks that haven't been written out yet, in order
+        self.pending = []
+        self.block = []
+        self.block_size = 0
+        self.in_member = False
+        self.crc = 0
+        self.size = 0
+
+    def write(self, data):
+        if not self.in_member:
+            self.fileobj.write(GZIP_MEMBER_HEADER)
+            self.in_member = True
+            self.crc = zlib.crc32("")
+            self.size = 0
+
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.block.append(data)
+        self.block_size += len(data)
+
+        if self.block_size >= COMPRESS_BLOCK_SIZE:
+            self._compress_block(zlib.Z_SYNC_FLUSH)
+
+    def _compress_block(self, flush_mode):
+        block = "".join(self.block)
+        self.block = []
+        self.block_size = 0
+
+        if self.pool is None:
+            self.fileobj.write(deflate_block(block, self.level, flush_mode))
+            return
+
+        self.pending.append(self.pool.apply_async(deflate_block,
+            (block, self.level, flush_mode)))
+
+        # don't let more than a couple of blocks per thread pile up
+        while len(self.pending) > self.threads * 2:
+            self.fileobj.write(self.pending.pop(0).get())
+
+    def close_member(self):
+        if not self.in_member:
+            return
+
+        self._compress_block(zlib.Z_FINISH)
+        for result in self.pending:
+            self.fileobj.write(result.get())
+        self.pending = []
+
+        self.fileobj.write(struct.pack("<II", self.crc & 0xffffffff,
+            self.size & 0xffffffff))
+        self.in_member = False
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.close_member()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        self.fileobj.close()
+
+
+# Raw bytes are read from the old warc in chunks of this many bytes.
+GZIP_CHUNK_SIZE = 64 * 1024
+
+
+class WARCMember(object):
+    # One gzip member of a .warc.gz, holding one record.
+    #
+    # Reads like a file of the member's decompressed data, while keeping track
+    # of where the member starts and ends in the compressed file. That way a
+    # record that needs no changes can be copied over as the raw gzip member,
+    # byte for byte, instead of being decompressed, rebuilt and recompressed.
+
+    def __init__(self, fileobj, offset, leftover):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.length = 0
+        self.record = None
+
+        # raw bytes read past the end of the previous member
+        self.leftover = leftover
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ""
+        self.done = False
+        # how much the member decompressed to so far, and whether its
+        # deflate stream really ended (as opposed to the file)
+        self.data_length = 0
+        self.ended = False
+
+        # raw bytes of this member read so far; only kept until we know
+        # whether the member gets copied as it is
+        self.raw = []
+        self.keep_raw = True
+
+    def _feed(self):
+        # Decompresses the next raw chunk of this member into the buffer and
+        # returns the raw bytes that belonged to the member.
+        if self.done:
+            return ""
+
+        chunk = self.leftover or self.fileobj.read(GZIP_CHUNK_SIZE)
+        self.leftover = ""
+        if not chunk:
+            self.done = True
+            if self.length and not self.stream_ended():
+                raise Exception("The gzip member at offset %d of the warc "
+                    "is cut short." % self.offset)
+            return ""
+
+        data = self.decompressor.decompress(chunk)
+        self.buffer += data
+        self.data_length += len(data)
+        unused = self.decompressor.unused_data
+        if unused:
+            # the member ended inside this chunk; the rest is the next one's
+            self.done = True
+            self.ended = True
+            self.leftover = unused
+            chunk = chunk[:len(chunk) - len(unused)]
+
+        self.length += len(chunk)
+        if self.keep_raw:
+            self.raw.append(chunk)
+        return chunk
+
+    def stream_ended(self):
+        # Whether the deflate stream ended, CRC and length checked, right at
+        # the end of the file. A finished decompressor leaves anything it's
+        # fed after that in unused_data; an unfinished one takes it as more of
+        # the stream (or chokes on it).
+        if not self.ended:
+            try:
+                self.decompressor.decompress("\0")
+            except zlib.error:
+                return False
+            self.ended = self.decompressor.unused_data == "\0"
+        return self.ended
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size) and not self.done:
+            self._feed()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def peek(self, size):
+        # The next `size` bytes (or as many as there are), left to be read.
+        while len(self.buffer) < size and not self.done:
+            self._feed()
+        return self.buffer[:size]
+
+    def readline(self):
+        while "\n" not in self.buffer and not self.done:
+            self._feed()
+        line_end = self.buffer.find("\n") + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:line_end], self.buffer[line_end:]
+        return line
+
+    def copy_raw(self, out_file):
+        # Copies the whole member, compressed, to `out_file`.
+        out_file.write("".join(self.raw))
+        self.raw = []
+        self.keep_raw = False
+        while not self.done:
+            out_file.write(self._feed())
+            self.buffer = ""
+
+    def drop_raw(self):
+        # The member won't be copied as it is; stop holding on to its raw
+        # bytes.
+        self.raw = []
+        self.keep_raw = False
+
+    def finish(self):
+        # Skips to the end of the member.
+        self.drop_raw()
+        while not self.done:
+            self._feed()
+            self.buffer = ""
+
+
+def iter_warc_members(fileobj):
+    # Yields a WARCMember for each record of a .warc.gz, with the record's
+    # header read and its payload ready to be read from member.record.payload.
+    reader = warc.WARCReader(None)
+    offset = 0
+    leftover = ""
+
+    while True:
+        member = WARCMember(fileobj, offset, leftover)
+        header = reader.read_header(member)
+        if header is None:
+            return
+
+        header_length = member.data_length - len(member.buffer)
+        member.record = warc.WARCRecord(header,
+            warc.utils.FilePart(member, header.content_length), defaults=False)
+        yield member
+
+        member.finish()
+        if member.data_length - header_length < header.content_length:
+            raise Exception("The %s record at offset %d of the warc is shorter "
+                "than its Content-Length." % (header.type, member.offset))
+        offset = member.offset + member.length
+        leftover = member.leftover
+
+
+def write_raw_member(warc_file, member):
+    # Copies a member straight to the file under the gzip layer of
+    # `warc_file`, in between the members it writes itself.
+    begin_index_entry(warc_file, member.record.header,
+        member.peek(HTTP_HEAD_PEEK_LENGTH))
+    member.copy_raw(warc_file.fileobj.fileobj)
+    end_index_entry(warc_file)
+
+
+###########################################################################
+# Record index.
+#
+# Next to the post-processed warc goes a CDXJ index of it: a line for every
+# record, with the offset and length of the gzip member or zstd frame that
+# holds it. Replay and QA tools can seek straight to the video, warcinfo or
+# conversion records with it, instead of decompressing the whole warc.
+
+# The HTTP headers of a record are looked for in this many bytes at the
+# start of its block.
+HTTP_HEAD_PEEK_LENGTH = 16 * 1024
+
+
+class RecordIndex(object):
+    # Collects index entries while a warc is written. Set one as the `index`
+    # of a warc.WARCFile, and the record writers above fill it in.
+
+    def __init__(self, warc_name):
+        self.warc_name = warc_name
+        self.lines = []
+        self.header = None
+        self.offset = None
+        self.mime = None
+
+    def begin(self, header, offset, mime=None):
+        self.header = header
+        self.offset = offset
+        self.mime = mime
+
+    def end(self, offset):
+        header = self.header
+        entry = {
+            "filename": self.warc_name,
+            "offset": str(self.offset),
+            "length": str(offset - self.offset),
+            "type": header["WARC-Type"],
+            "id": header["WARC-Record-ID"],
+        }
+        if "WARC-Target-URI" in header:
+            entry["url"] = header["WARC-Target-URI"]
+        if self.mime:
+            entry["mime"] = self.mime
+        digest = header.get("WARC-Payload-Digest") or header.get("WARC-Block-Digest")
+        if digest:
+            entry["digest"] = digest
+        if "WARC-Refers-To" in header:
+            entry["refers_to"] = header["WARC-Refers-To"]
+        if "WARC-Truncated" in header:
+            entry["truncated"] = header["WARC-Truncated"]
+
+        self.lines.append("%s %s %s\n" % (surt_key(entry.get("url")),
+            re.sub(r"\D", "", header["WARC-Date"])[:14],
+            json.dumps(entry, sort_keys=True)))
+        self.header = None
+
+    def write(self, filename):
+        with open(filename, "w") as out_file:
+            out_file.writelines(sorted(self.lines))
+
+
+def surt_key(uri):
+    # The sort key of `uri` in the index: its SURT form, host parts reversed
+    # and www. dropped, e.g. "tv,twitch)/foo/b/123". Records without a
+    # target URI (warcinfo, conversion) all sort under "-".
+    if not uri:
+        return "-"
+    parts = urlparse.urlsplit(uri)
+    host = (parts.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    key = ",".join(reversed(host.split("."))) + ")" + (parts.path or "/")
+    if parts.query:
+        key += "?" + parts.query
+    return key.replace(" ", "%20")
+
+
+def record_mime_type(header, block_start):
+    # What the index gives as the MIME type of a record: that of the payload,
+    # from the Content-Type in the HTTP headers, for a response (or request)
+    # record, and the Content-Type of the record itself for anything that
+    # isn't HTTP. None if an HTTP message doesn't say.
+    content_type = header.get("Content-Type")
+    if not content_type or not content_type.startswith("application/http"):
+        return content_type
+
+    http_head = block_start.split("\r\n\r\n", 1)[0]
+    match = re.search(r"(?im)^Content-Type:[ \t]*([^;\r\n]*)", http_head)
+    if match and match.group(1).strip():
+        return match.group(1).strip().lower()
+    return None
+
+
+def begin_index_entry(warc_file, header, block_start=""):
+    index = getattr(warc_file, "index", None)
+    if index is not None:
+        index.begin(header, warc_file.fileobj.fileobj.tell(),
+            record_mime_type(header, block_start))
+
+
+def end_index_entry(warc_file):
+    index = getattr(warc_file, "index", None)
+    if index is not None:
+        index.end(warc_file.fileobj.fileobj.tell())
+
+
+# zstd compression level of a .warc.zst
+ZSTD_LEVEL = 10
+
+# Magic number of the skippable frame a .warc.zst keeps its dictionary in.
+ZSTD_DICTIONARY_FRAME_MAGIC = 0x184D2A5D
+
+# Size of trained dictionaries, and how many bytes of records to train on.
+ZSTD_DICTIONARY_SIZE = 112 * 1024
+ZSTD_TRAINING_BYTES = 100 * 1024 * 1024
+
+
+class ZstdWARCWriter(object):
+    # Writes a .warc.zst, the zstd counterpart of a .warc.gz: every record is
+    # a zstd frame of its own. If there is a dictionary, it's used for every
+    # frame, and stored at the very start of the file in a skippable frame,
+    # so that readers can find it. Small HTML and JSON records from Twitch
+    # and the kraken API compress a lot better with a dictionary that has
+    # seen their like before.
+
+    def __init__(self, fileobj, level=ZSTD_LEVEL, dictionary=None):
+        if zstandard is None:
+            raise Exception("Writing .warc.zst files needs the zstandard module.")
+
+        self.fileobj = fileobj
+        self.frame = None
+
+        if dictionary:
+            self.compressor = zstandard.ZstdCompressor(level=level,
+                dict_data=zstandard.ZstdCompressionDict(dictionary))
+            self.fileobj.write(struct.pack("<II", ZSTD_DICTIONARY_FRAME_MAGIC,
+                len(dictionary)))
+            self.fileobj.write(dictionary)
+        else:
+            self.compressor = zstandard.ZstdCompressor(level=level)
+
+    def write(self, data):
+        if self.frame is None:
+            self.frame = self.compressor.compressobj()
+        self.fileobj.write(self.frame.compress(data))
+
+    def close_member(self):
+        if self.frame is None:
+            return
+        self.fileobj.write(self.frame.flush())
+        self.frame = None
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.close_member()
+        self.fileobj.close()
+
+
+def open_warc_writer(filename, compression="gz", compress_level=COMPRESS_LEVEL,
+                     compress_threads=COMPRESS_THREADS, zstd_level=ZSTD_LEVEL,
+                     zstd_dictionary=None):
+    # Opens a new warc file compressed with gzip ("gz") or zstd ("zst").
+    fileobj = open(filename, "wb")
+    if compression == "zst":
+        return warc.WARCFile(fileobj=ZstdWARCWriter(fileobj, zstd_level,
+            zstd_dictionary))
+    return warc.WARCFile(fileobj=ParallelGzipWriter(fileobj, compress_level,
+        compress_threads))
+
+
+def train_zstd_dictionary(warc_names, dictionary_size=ZSTD_DICTIONARY_SIZE):
+    # Trains a dictionary on the small records of some grabbed .warc.gz
+    # files: the page, API and asset records that make up most of a warc by
+    # count. The video records are skipped.
+    samples = []
+    sample_bytes = 0
+
+    for warc_name in warc_names:
+        with open(warc_name, "rb") as warc_fileobj:
+            for member in iter_warc_members(warc_fileobj):
+                record = member.record
+                if long(record['Content-Length']) >= 500000:
+                    continue
+
+                sample = str(record.header) + record.payload.read() + "\r\n\r\n"
+                samples.append(sample)
+                sample_bytes += len(sample)
+                if sample_bytes >= ZSTD_TRAINING_BYTES:
+                    break
+
+        if sample_bytes >= ZSTD_TRAINING_BYTES:
+            break
+
+    return zstandard.train_dictionary(dictionary_size, samples).as_bytes()
+
+
+def rewrite_warc(warc_names, warc_file):
+    # Copies every record of the .warc.gz files to `warc_file` as it is,
+    # recompressing it. Returns the number of uncompressed bytes written.
+    written = 0
+    for warc_name in warc_names:
+        with open(warc_name, "rb") as warc_fileobj:
+            for member in iter_warc_members(warc_fileobj):
+                header = str(member.record.header)
+                length = long(member.record['Content-Length'])
+                warc_file.fileobj.write(header)
+                copy_record_block(member.record.payload, warc_file.fileobj,
+                    length)
+                finish_record(warc_file)
+                written += len(header) + length + 4
+    return written
+
+
+def gunzip_members(in_file, out_file):
+    # Decompresses all the members of a multi-member gzip file.
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in iter(lambda: in_file.read(WARC_CHUNK_SIZE), ""):
+        while chunk:
+            out_file.write(decompressor.decompress(chunk))
+            chunk = decompressor.unused_data
+            if chunk:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def benchmark_compression(warc_names, compress_level=COMPRESS_LEVEL,
+                          compress_threads=COMPRESS_THREADS,
+                          zstd_level=ZSTD_LEVEL, zstd_dictionary=None):
+    # Recompresses the records of some grabbed .warc.gz files as gzip, as
+    # zstd, and as zstd with a dictionary, and prints how big each one gets
+    # and how fast it is written and read back. Reading the source warcs is
+    # timed separately and left out of the write speeds.
+    start = time.time()
+    null_file = warc.WARCFile(fileobj=open(os.devnull, "wb"))
+    uncompressed = rewrite_warc(warc_names, null_file)
+    null_file.close()
+    read_time = time.time() - start
+
+    formats = [("gzip -%d" % compress_level, "gz")]
+    if zstandard is not None:
+        formats.append(("zstd -%d" % zstd_level, "zst"))
+        if zstd_dictionary:
+            formats.append(("zstd -%d + dictionary" % zstd_level, "zst+dict"))
+
+    megabytes = uncompressed / 1000000.0
+    print("%-24s %14s %7s %14s %14s" % ("format", "bytes", "ratio",
+        "write MB/s", "read MB/s"))
+    print("%-24s %14d %7.3f %14s %14s" % ("uncompressed", uncompressed, 1,
+        "", "%.1f" % (megabytes / max(read_time, 0.001))))
+
+    for name, compression in formats:
+        fd, filename = tempfile.mkstemp(suffix=".warc")
+        os.close(fd)
+        try:
+            start = time.time()
+            warc_file = open_warc_writer(filename, compression.split("+")[0],
+                compress_level, compress_threads, zstd_level,
+                zstd_dictionary if compression == "zst+dict" else None)
+            rewrite_warc(warc_names, warc_file)
+            warc_file.close()
+            write_time = max(time.time() - start - read_time, 0.001)
+            size = os.path.getsize(filename)
+
+            start = time.time()
+            with open(filename, "rb") as in_file, open(os.devnull, "wb") as out_file:
+                if compression == "gz":
+                    gunzip_members(in_file, out_file)
+                else:
+                    # zstd reads all the frames one after another, and skips
+                    # the dictionary frame
+                    if compression == "zst+dict":
+                        decompressor = zstandard.ZstdDecompressor(
+                            dict_data=zstandard.ZstdCompressionDict(zstd_dictionary))
+                    else:
+                        decompressor = zstandard.ZstdDecompressor()
+                    decompressor.copy_stream(in_file, out_file)
+            decompress_time = max(time.time() - start, 0.001)
+        finally:
+            os.remove(filename)
+
+        print("%-24s %14d %7.3f %14.1f %14.1f" % (name, size,
+            float(size) / max(uncompressed, 1), megabytes / write_time,
+            megabytes / decompress_time))
+
+
+def write_file_record(warc_file, header, filename):
+    # Writes the contents of `filename` as the block of a new record.
+    header['Content-Length'] = str(os.path.getsize(filename))
+    header['WARC-Payload-Digest'] = "sha1:" + get_hash(filename)
+
+    write_record_header(warc_file, header)
+    with open(filename, 'rb') as in_file:
+        shutil.copyfileobj(in_file, warc_file.fileobj, WARC_CHUNK_SIZE)
+    finish_record(warc_file)
+
+
+class DigestWriter(object):
+    # File-like sink that keeps nothing but the length and SHA-1 of what is
+    # written to it.
+    def __init__(self):
+        self.sha1 = hashlib.sha1()
+        self.length = 0
+
+    def write(self, data):
+        self.sha1.update(data)
+        self.length += len(data)
+
+
+# What the snapshot archive goes in the WARC as: a gzipped tar, the same
+# snapshots.tar.gz that "tar -czvf" used to make.
+SNAPSHOT_CONTENT_TYPE = "application/x-gtar"
+
+
+def write_snapshot_archive(filenames, fileobj, remove=False):
+    # Streams a gzipped tar archive of `filenames` to `fileobj`. The output
+    # only depends on the files, so writing it twice gives the same bytes
+    # twice. (tarfile's own "w|gz" puts the current time in the gzip header,
+    # hence the GzipFile with mtime=0.)
+    gzip_file = gzip.GzipFile(filename="", mode="wb", fileobj=fileobj,
+        mtime=0)
+    archive = tarfile.open(fileobj=gzip_file, mode="w|",
+        format=tarfile.USTAR_FORMAT)
+    for filename in filenames:
+        archive.add(filename)
+        if remove:
+            os.remove(filename)
+    archive.close()
+    gzip_file.close()
+
+
+def write_archive_record(warc_file, header, filenames):
+    # Writes a gzipped tar archive of `filenames` as the block of a new record,
+    # without ever putting the archive on disk or in memory: the first pass
+    # only measures and hashes it, the second writes it to the warc and
+    # removes each file once it's in.
+    digest = DigestWriter()
+    write_snapshot_archive(filenames, digest)
+    header['Content-Length'] = str(digest.length)
+    header['WARC-Payload-Digest'] = "sha1:" + digest.sha1.hexdigest()
+
+    write_record_header(warc_file, header)
+    write_snapshot_archive(filenames, warc_file.fileobj, remove=True)
+    finish_record(warc_file)
+
+
+def log_header(record_ids):
+    return warc.WARCHeader({
+        "WARC-Type": "resource",
+        "WARC-Warcinfo-ID": record_ids["warcinfo"],
+        "Content-Type": "text/plain",
+        "WARC-Concurrent-To": record_ids["metadata"]
+    }, defaults=True)
+
+
+def conversion_header(record_ids, content_type):
+    return warc.WARCHeader({
+        "WARC-Type": "conversion",
+        "Content-Type": content_type,
+        "WARC-Refers-To": record_ids["truncated"]
+    }, defaults=True)
+
+
+def write_sample_records(warc_file, record_ids, log_name, content_type,
+                         filename):
+    # Adds the ffmpeg log as a resource record, followed by the conversion
+    # record holding the sampled output in `filename`.
+    write_file_record(warc_file, log_header(record_ids), log_name)
+    write_file_record(warc_file, conversion_header(record_ids, content_type),
+        filename)
+
+
+def write_snapshot_records(warc_file, record_ids, log_name, snapshots):
+    # Same as write_sample_records(), for an archive of the snapshots.
+    write_file_record(warc_file, log_header(record_ids), log_name)
+    write_archive_record(warc_file,
+        conversion_header(record_ids, SNAPSHOT_CONTENT_TYPE), snapshots)
+
+
+class HTTPBodyWriter(object):
+    # File-like object that drops the HTTP response headers from whatever is
+    # written to it and passes the rest (the body) on to `fileobj`.
+    #
+    # Only the bytes up to the first CRLFCRLF are ever buffered, so the video
+    # body goes straight from the warc to the file ffmpeg reads, in a single
+    # pass, with no intermediate copy of the whole response on disk or in
+    # memory. Anything after the header block, including any CRLFCRLF inside
+    # the binary body, is passed through untouched. The body is hashed on the
+    # way, for the sample cache.
+
+    # Give up looking for the end of the headers after this many bytes.
+    MAX_HEADER_LENGTH = 1024 * 1024
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.head = ""
+        self.in_body = False
+        self.sha1 = hashlib.sha1()
+
+    def write(self, data):
+        if self.in_body:
+            self.fileobj.write(data)
+            self.sha1.update(data)
+            return
+
+        self.head += data
+        header_end = self.head.find("\r\n\r\n")
+
+        if header_end != -1:
+            self.in_body = True
+            self.fileobj.write(self.head[header_end + 4:])
+            self.sha1.update(self.head[header_end + 4:])
+            self.head = ""
+        elif len(self.head) > self.MAX_HEADER_LENGTH:
+            raise Exception("No end of HTTP headers in the video record.")
+
+    def close(self):
+        if not self.in_body:
+            raise Exception("No end of HTTP headers in the video record.")
+        self.fileobj.close()
+
+
+###########################################################################
+# Sampling settings.
+
+# ffmpeg writes its log to the file named in FFREPORT. Every ffmpeg run gets
+# an environment of its own, so several items can be sampled at once.
+def ffmpeg_env(log_name):
+    env = dict(os.environ)
+    env["FFREPORT"] = "file=" + log_name
+    return env
+
+
+# Runs ffmpeg with its log going to `log_name`. A failed transcode must not
+# end up in the warc (or the sample cache) as if it were a good one, so
+# this raises if ffmpeg does.
+def call_ffmpeg(args, log_name):
+    returncode = call(args, env=ffmpeg_env(log_name))
+    if returncode != 0:
+        raise Exception("ffmpeg exited with %d; see %s." % (returncode,
+            log_name))
+
+
+# Raises unless every one of `filenames` is there and has something in it.
+def check_outputs(filenames):
+    if not filenames:
+        raise Exception("ffmpeg made no output.")
+    for filename in filenames:
+        if not os.path.exists(filename) or not os.path.getsize(filename):
+            raise Exception("ffmpeg made no %s." % filename)
+
+
+# What goes in the "software" line the warcinfo record gets for ffmpeg, e.g.
+# "ffmpeg/2.3.1", from what "ffmpeg -version" says.
+def ffmpeg_version(ffmpeg):
+    try:
+        process = Popen([ffmpeg, "-version"], stdout=PIPE, stderr=PIPE)
+        output = "".join(process.communicate())
+    except OSError:
+        output = ""
+
+    return software_version(output)
+
+
+def software_version(output):
+    match = re.search(r"ffmpeg version (\S+)", output)
+    if match:
+        return "ffmpeg/" + match.group(1)
+    else:
+        return "ffmpeg"
+
+
+# Get the snapshots and the shrunken video out of a single ffmpeg run that
+# decodes the video only once, instead of running ffmpeg for each.
+SAMPLE_IN_ONE_PASS = True
+
+# ffmpeg output options for the snapshots.
+SNAPSHOT_OUTPUT_ARGS = ["-f", "image2", "-q:v", "1", "images%05d.jpg"]
+
+
+def snapshot_files():
+    return sorted(glob.glob("images*.jpg"))
+
+
+# How snapshots are taken: "decode" keeps a frame every so often while
+# decoding the whole video; "seek" seeks to each snapshot's timestamp and
+# decodes only from the keyframe before it; "keyframe" takes the keyframe
+# nearest each timestamp and decodes nothing else. Seeking runs this many
+# ffmpeg processes at once.
+SNAPSHOT_MODE = "decode"
+SNAPSHOT_JOBS = 4
+
+
+def snapshot_times(plan):
+    # When the snapshots are taken, in seconds; the same ones the fps filter
+    # of snapshot_filter() keeps.
+    times = []
+    time = 0
+    while time < plan["duration"]:
+        times.append(time)
+        time += plan["snapshot_interval"]
+    return times
+
+
+# When deduplication is on, a snapshot is dropped if its perceptual hash is
+# no more than this many bits (out of 64) away from that of the last one
+# kept: a "BRB" screen or a paused game needs only one. The dropped ones are
+# listed, with their timestamps, in SNAPSHOT_MANIFEST in the archive.
+SNAPSHOT_DEDUP_DISTANCE = None
+SNAPSHOT_MANIFEST = "dropped-snapshots.txt"
+
+
+def snapshot_hashes(ffmpeg, filenames):
+    # The dHash of every snapshot: a single ffmpeg run shrinks them all to
+    # 9x8 grey pixels, and each hash gets a bit for every pair of neighbouring
+    # pixels, set if it gets darker from left to right. Returns None if
+    # ffmpeg doesn't come back with a hash for every file.
+    output = Popen([ffmpeg, "-nostdin", "-loglevel", "error",
+        "-f", "image2", "-i", "images%05d.jpg", "-vf", "scale=9:8,format=gray",
+        "-f", "rawvideo", "-"], stdout=PIPE).communicate()[0]
+    if len(output) != 9 * 8 * len(filenames):
+        return None
+
+    hashes = []
+    for start in range(0, len(output), 9 * 8):
+        pixels = bytearray(output[start:start + 9 * 8])
+        dhash = 0
+        for row in range(0, 9 * 8, 9):
+            for column in range(8):
+                dhash = dhash << 1 | (pixels[row + column] > pixels[row + column + 1])
+        hashes.append(dhash)
+    return hashes
+
+
+def dedup_snapshots(ffmpeg, plan, distance):
+    # Removes the snapshots that look like the last one kept, and writes
+    # down which ones went. Returns the files that go into the archive.
+    filenames = snapshot_files()
+    hashes = snapshot_hashes(ffmpeg, filenames)
+    if hashes is None:
+        print("Could not hash the snapshots; keeping all of them.")
+        return filenames
+
+    kept = []
+    kept_hash = None
+    with open(SNAPSHOT_MANIFEST, "w") as manifest:
+        manifest.write("# snapshot, seconds into the video, same as\n")
+        for number, (filename, dhash) in enumerate(zip(filenames, hashes)):
+            if kept and bin(dhash ^ kept_hash).count("1") <= distance:
+                manifest.write("%s %d %s\n" % (filename,
+                    number * plan["snapshot_interval"], kept[-1]))
+                os.remove(filename)
+            else:
+                kept.append(filename)
+                kept_hash = dhash
+
+    print("Kept %d of %d snapshots." % (len(kept), len(filenames)))
+    return kept + [SNAPSHOT_MANIFEST]
+
+
+def seek_snapshot_args(ffmpeg, time, filename, keyframe_only):
+    args = [ffmpeg, "-nostdin", "-loglevel", "error"]
+    if keyframe_only:
+        args.append("-noaccurate_seek")
+    return args + ["-ss", "%.3f" % time, "-i", "samplethis.flv",
+        "-frames:v", "1", "-an", "-f", "image2", "-q:v", "1", filename]
+
+
+# What each item may cost. The sampling plan is scaled down until the
+# shrunken video fits in SAMPLE_BYTE_BUDGET bytes and ffmpeg has to encode no
+# more than SAMPLE_PIXEL_BUDGET pixels (width * height * frames), which is
+# what the transcode time mostly depends on. The default pixel budget is two
+# hours of 432x243 at 30 fps.
+SAMPLE_BYTE_BUDGET = 300 * 1000 * 1000
+SAMPLE_PIXEL_BUDGET = 432 * 243 * 30 * 2 * 3600
+
+# Keep at most this many snapshots, taken no more often than every
+# SNAPSHOT_MIN_INTERVAL and no less often than every SNAPSHOT_MAX_INTERVAL
+# seconds.
+SNAPSHOT_MAX_COUNT = 240
+SNAPSHOT_MIN_INTERVAL = 2
+SNAPSHOT_MAX_INTERVAL = 120
+
+# Heights the video may be shrunk to, with the most video bitrate (kbit/s)
+# worth spending on each, and the frame rates it may be cut down to.
+SHRINK_BITRATES = [(480, 1000), (360, 700), (240, 500), (144, 200)]
+SHRINK_FRAME_RATES = [30, 15, 10, 5]
+SHRINK_MIN_BITRATE = 100
+SHRINK_AUDIO_BITRATE = 64
+
+# Videos longer than SHRINK_SEGMENT_LENGTH seconds may be cut into segments
+# of about that length (at keyframes) that are shrunk by SHRINK_JOBS ffmpeg
+# processes at once, then put back together. If the result is more than
+# SHRINK_MAX_DURATION_ERROR seconds longer or shorter than the source, it's
+# thrown away and the video gets shrunk in one go after all.
+SHRINK_JOBS = 1
+SHRINK_SEGMENT_LENGTH = 300
+SHRINK_MAX_DURATION_ERROR = 2
+
+# What we did before there was a plan; used when the probe comes up empty.
+DEFAULT_SAMPLING_PLAN = {
+    "snapshot_interval": 15,
+    "width": 432,
+    "height": 243,
+    "fps": None,
+    "video_bitrate": 500,
+}
+
+
+def probe_video(ffmpeg, filename):
+    # Reads duration, resolution, display aspect ratio and frame rate of the
+    # first video stream out of what "ffmpeg -i" prints. Anything it can't
+    # find is left out of the result.
+    output = Popen([ffmpeg, "-i", filename], stderr=PIPE).communicate()[1]
+    video = {}
+
+    match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", output)
+    if match:
+        hours, minutes, seconds = match.groups()
+        video["duration"] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    match = re.search(r"Stream #.*?: Video: (.*)", output)
+    if match:
+        stream = match.group(1)
+
+        size = re.search(r"\b(\d{2,5})x(\d{2,5})\b", stream)
+        if size:
+            video["width"], video["height"] = int(size.group(1)), int(size.group(2))
+            video["aspect"] = float(video["width"]) / video["height"]
+
+        aspect = re.search(r"DAR (\d+):(\d+)", stream)
+        if aspect and int(aspect.group(2)):
+            video["aspect"] = float(aspect.group(1)) / int(aspect.group(2))
+
+        fps = re.search(r"([\d.]+)(k?) fps", stream)
+        if fps:
+            video["fps"] = float(fps.group(1)) * (1000 if fps.group(2) else 1)
+
+    return video
+
+
+def make_sampling_plan(video, byte_budget, pixel_budget):
+    # Works out the snapshot interval and the size, frame rate and bitrate of
+    # the shrunken video from what probe_video() found, so that long
+    # broadcasts get sampled more sparsely instead of taking hours of CPU and
+    # turning into huge webms.
+    duration = video.get("duration")
+    if not duration or "height" not in video:
+        return dict(DEFAULT_SAMPLING_PLAN)
+
+    plan = {"duration": duration}
+    plan["snapshot_interval"] = int(round(min(max(
+        duration / SNAPSHOT_MAX_COUNT, SNAPSHOT_MIN_INTERVAL),
+        SNAPSHOT_MAX_INTERVAL)))
+
+    # Never scale up, and never go faster than the source.
+    heights = [height for height, bitrate in SHRINK_BITRATES
+        if height <= video["height"]] or [video["height"]]
+    source_fps = video.get("fps") or SHRINK_FRAME_RATES[0]
+    frame_rates = [min(source_fps, SHRINK_FRAME_RATES[0])] + \
+        [fps for fps in SHRINK_FRAME_RATES[1:] if fps < source_fps]
+
+    # Pick the size and frame rate that encode the most pixels while staying
+    # within the pixel budget, or the cheapest one if nothing fits.
+    candidates = []
+    for height in heights:
+        # libvpx wants even dimensions
+        width = int(round(height * video["aspect"] / 2)) * 2
+        height -= height % 2
+        for fps in frame_rates:
+            candidates.append((width * height * fps * duration, width, height, fps))
+    candidates.sort(reverse=True)
+    affordable = [c for c in candidates if c[0] <= pixel_budget] or candidates[-1:]
+    pixels, plan["width"], plan["height"], plan["fps"] = affordable[0]
+
+    # Spend no more than the byte budget allows, and no more than is worth
+    # spending at this size.
+    max_bitrate = [bitrate for height, bitrate in SHRINK_BITRATES
+        if height <= plan["height"]] or [SHRINK_BITRATES[-1][1]]
+    budget_bitrate = byte_budget * 8 / 1000 / duration - SHRINK_AUDIO_BITRATE
+    plan["video_bitrate"] = int(max(min(max_bitrate[0], budget_bitrate),
+        SHRINK_MIN_BITRATE))
+
+    return plan
+
+
+def snapshot_filter(plan):
+    return "fps=fps=1/%d" % plan["snapshot_interval"]
+
+
+def shrink_filter(plan):
+    scale = "scale=%d:%d" % (plan["width"], plan["height"])
+    if plan["fps"]:
+        return "fps=fps=%s,%s" % (plan["fps"], scale)
+    return scale
+
+
+def shrink_output_args(plan, filename="shrunken-to-webm.webm"):
+    return ["-c:v", "libvpx", "-b:v", "%dK" % plan["video_bitrate"],
+        "-c:a", "libvorbis", "-b:a", "%dK" % SHRINK_AUDIO_BITRATE,
+        filename]
+
+
+def join_logs(log_names, filename):
+    # Puts the logs of several ffmpeg runs into one, in order, and removes
+    # them.
+    with open(filename, "wb") as log_file:
+        for log_name in log_names:
+            if os.path.exists(log_name):
+                with open(log_name, "rb") as in_file:
+                    shutil.copyfileobj(in_file, log_file)
+                os.remove(log_name)
+
+
+###########################################################################
+# Sample cache.
+#
+# The same video can come around more than once: wget retries, the tracker
+# requeues items, and every attempt starts over in a clean item directory.
+# So the files the sampling ends up putting in the warc (ffmpeg logs, the
+# webm, the snapshots) are kept in a cache directory, under the SHA-1 of the
+# video and the sampling settings, and the next time that video shows up
+# they go straight back into the warc without running ffmpeg at all. The
+# least recently used entries go once the cache is over its size.
+
+# Size of the sample cache, in bytes.
+SAMPLE_CACHE_SIZE = 2 * 1000 * 1000 * 1000
+
+# Lists the records an entry makes, and the files that go in them.
+SAMPLE_CACHE_MANIFEST = "samples.json"
+
+
+class SampleCache(object):
+    def __init__(self, directory, max_size=SAMPLE_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def restore(self, key):
+        # Copies the files of the entry for `key` into the current directory,
+        # and returns its list of samples, or None if there is no such entry.
+        entry_dir = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(entry_dir, SAMPLE_CACHE_MANIFEST)) as manifest:
+                # (the warc library wants byte strings, not unicode)
+                samples = [{
+                    "log": str(sample["log"]),
+                    "content_type": str(sample["content_type"]),
+                    "files": [str(filename) for filename in sample["files"]],
+                } for sample in json.load(manifest)]
+            if not all(os.path.getsize(os.path.join(entry_dir, filename))
+                    for sample in samples for filename in sample["files"]):
+                # (an empty transcode, from before those were caught)
+                return None
+            for sample in samples:
+                for filename in [sample["log"]] + sample["files"]:
+                    shutil.copy2(os.path.join(entry_dir, filename), filename)
+            # now it's the most recently used one
+            os.utime(entry_dir, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return samples
+
+    def start(self):
+        # A directory for a new entry to be put together in.
+        return tempfile.mkdtemp(prefix=".new-", dir=self.directory)
+
+    def add(self, entry_dir, sample):
+        # Copies the files of a sample into a new entry. Modification times
+        # go along, so a snapshot archive made of them comes out the same.
+        for filename in [sample["log"]] + sample["files"]:
+            shutil.copy2(filename, os.path.join(entry_dir, filename))
+
+    def finish(self, key, entry_dir, samples):
+        # Makes the new entry available under `key`, and makes room for it.
+        with open(os.path.join(entry_dir, SAMPLE_CACHE_MANIFEST), "w") as manifest:
+            json.dump(samples, manifest)
+        try:
+            os.rename(entry_dir, os.path.join(self.directory, key))
+        except OSError:
+            # someone else cached the same video in the meantime
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for key in os.listdir(self.directory):
+            entry_dir = os.path.join(self.directory, key)
+            if key.startswith(".") or not os.path.isdir(entry_dir):
+                # new entries that never got finished go after a day
+                if (key.startswith(".new-") and
+                        os.path.getmtime(entry_dir) < time.time() - 86400):
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_dir, filename))
+                    for filename in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+            except OSError:
+                continue
+
+        total_size = sum(size for mtime, size, entry_dir in entries)
+        for mtime, size, entry_dir in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+
+
+# Only items of these types get sampled; the tracker hands them out for
+# videos that aren't worth keeping whole.
+SAMPLED_ITEM_TYPES = ("video-bulk", "url-bulk")
+
+
+# Will utilize ffmpeg to sample the downloaded item.
+#
+# First, sample the video at its native resolution.  This sampling ought to be
+# regular. That is, we should sample the same frame in every period. Ex.) for a
+# 30 fps video, we should always grab the Nth frame at each second.
+#
+# This sampling rate should scale with the length of the video. A short video
+# might be afforded 2 frames per second, while an extra long video might only
+# be afforded 1 frame every 2 or 3 seconds.
+#
+# Second, after taking a native-resolution snapshot of the video, 
+#
+# 1.) shrink it down to a small but visible resolution.
+# 2.) cut the framerate down to a low but still motion-preserving number.
+#     (frame-dropping)
+#
+# Both of these parameters ought to scale with the length of the
+# source video. A relatively short video might be able to get away with
+# 480p resolution, but a longer one should be cut down to 360p or even
+# 240p resolution. A short video might have a higher preserved framerate,
+# but not a longer video.
+#
+# This high-fidelity data from taking native-resolution snapshots, in
+# combination with low-fidelity data from shrinking the resolution and dropping
+# frames, will (hopefully) constitute a minimum viable dataset that might be of
+# use to someone in the future.
+class Sampler(object):
+    def __init__(self, ffmpeg, byte_budget=SAMPLE_BYTE_BUDGET,
+                 pixel_budget=SAMPLE_PIXEL_BUDGET,
+                 compress_level=COMPRESS_LEVEL,
+                 compress_threads=COMPRESS_THREADS, compression="gz",
+                 zstd_level=ZSTD_LEVEL, zstd_dictionary=None,
+                 snapshot_mode=SNAPSHOT_MODE, snapshot_jobs=SNAPSHOT_JOBS,
+                 shrink_jobs=SHRINK_JOBS,
+                 shrink_segment_length=SHRINK_SEGMENT_LENGTH,
+                 snapshot_dedup_distance=SNAPSHOT_DEDUP_DISTANCE,
+                 cache_dir=None, cache_size=SAMPLE_CACHE_SIZE,
+                 ffmpeg_version=None):
+        self.ffmpeg = ffmpeg
+        self.ffmpeg_version = ffmpeg_version
+        self.byte_budget = byte_budget
+        self.pixel_budget = pixel_budget
+        self.compress_level = compress_level
+        self.compress_threads = compress_threads
+        self.compression = compression
+        self.zstd_level = zstd_level
+        self.zstd_dictionary = zstd_dictionary
+        self.snapshot_mode = snapshot_mode
+        self.snapshot_jobs = snapshot_jobs
+        self.shrink_jobs = shrink_jobs
+        self.shrink_segment_length = shrink_segment_length
+        self.snapshot_dedup_distance = snapshot_dedup_distance
+        self.cache = SampleCache(cache_dir, cache_size) if cache_dir else None
+        self.cache_entry = None
+        self.samples = []
+
+    def process(self, item):
+
+    # assert that this item is flagged for sampling. If not,
+    # return immediately. We don't want to butcher uploads that
+    # have been determined to be worth saving in their original
+    # state.
+    #
+    # The tracker tags these items as "video-bulk" or "url-bulk"; the
+    # pipeline downloads them like "video" and "url" items, and only
+    # runs us for them. Alternately, one could create a "Phase 3" grab
+    # and know for a fact that we are only receiving videos that
+    # should be sampled. In which case, one may skip the item_type
+    # check and proceed directly to sampling.
+
+        item_name = item['item_name']
+        item_type, item_value = item_name.split(':', 1)
+
+        item['item_type'] = item_type
+        item['item_value'] = item_value
+
+        # Item type is not marked as "video-bulk" or "url-bulk" from
+        # tracker. Carry on. Nothing to do here.
+        if item_type not in SAMPLED_ITEM_TYPES:
+            print("%s is not a -bulk item; leaving its WARC as it is." % item_name)
+            return
+
+        # ok. This is an item that needs to be sampled.
+
+        # The warcinfo record says which ffmpeg did it.
+        if self.ffmpeg_version is None:
+            self.ffmpeg_version = ffmpeg_version(self.ffmpeg)
+
+        # remember where we started from so we can get back there and
+        # not mess up the expectations for the rest of stages in the
+        # pipeline
+        original_path = os.getcwd()
+
+        # get to item_dir ; begin work
+        os.chdir(item['item_dir'])
+
+        # we will need some data from the warcfile
+        warcinfo_record_ID = ""
+        metadata_record_ID = ""
+        truncated_record_ID = ""
+        video_sha1 = None
+
+        # set up old and new warc files for reading and writing, respectively.
+        # The old one is read one raw gzip member at a time, so records can
+        # be copied over without recompressing them. The new one is either a
+        # .warc.gz compressed by a ParallelGzipWriter, on as many threads as
+        # we were told to use, or a .warc.zst.
+        old_warc_file = open("%(warc_file_base)s.warc.gz" % item, "rb")
+        new_warc_file = open_warc_writer(
+            "%(warc_file_base)s-POSTPROCESSED.warc." % item + self.compression,
+            self.compression, self.compress_level, self.compress_threads,
+            self.zstd_level, self.zstd_dictionary)
+
+        # every record that goes into the new warc gets a line in its index
+        new_warc_file.index = RecordIndex(
+            "%(warc_file_base)s-POSTPROCESSED.warc." % item + self.compression)
+
+        # ------------------------ Start of main for loop -------------------#
+
+        # and here... we... go
+        #
+        # Every record is copied from the old warc to the new one in chunks of
+        # WARC_CHUNK_SIZE bytes, so memory use stays flat no matter how big the
+        # video record is. The payload of the video record is read exactly
+        # once: while its truncated head goes into the new warc, the whole
+        # block is teed out through an HTTPBodyWriter, which chops off the
+        # HTTP response headers and leaves nothing but the flv file for
+        # ffmpeg to work with in "samplethis.flv". Records that need no
+        # changes at all skip even that, and are copied as raw gzip members.
+        for member in iter_warc_members(old_warc_file):
+            record = member.record
+
+            # Firstly, we detect whether the record we're iterating over holds
+            # data we'll need later. If so, behave appropriately. After the
+            # if-elif-elif dance, we proceed to copy each record into a new
+            # record in the %(warc_file_base)s-POSTPROCESSED.warc.gz file,
+            # modifying as necesary (truncated long records, etc)
+
+            # Should we add defaults=False ? It seems that some additional headers
+            # are added in WARCHeader as well as WARCRecord. However, they don't
+            # seem harmful: digests and timestamps.
+            new_header = warc.WARCHeader(record.header)
+            record_length = long(record['Content-Length'])
+
+            # where the full block of this record gets teed to (if anywhere)
+            tee_file = None
+
+            # ------------------------ Check for data -------------------------#
+
+            # Grab the lengthy payload (the flv file); if the content-length is
+            # longer than ~5MiB, and the record is of the "response" type, then
+            # this record *probably* has the flv file.
+            if (record_length >= 5000000 and record['WARC-Type'] == "response"):
+
+                # need the record id of the original flv record. Will refernece
+                # it in truncated record.
+                truncated_record_ID = record['warc-record-id']
+
+                # the body gets copied out to a separate file on the same
+                # pass that writes the truncated record.
+                tee_file = HTTPBodyWriter(open("samplethis.flv", 'wb'))
+
+            # Adjust the warcinfo record to note that we also utilized ffmpeg
+            elif (record['WARC-Type'] == "warcinfo"):
+
+                # grab the record-id for later use in resource records
+                warcinfo_record_ID = record['warc-record-id']
+
+                # gotta add another "software" key to the content-block of the
+                # warcinfo record that indicates the use of ffmpeg. The
+                # warcinfo block is tiny, so it is fine to hold it in memory.
+                #
+                # trailing \r\n\r\n is already present in the payload; just chop
+                # off two bytes (yes, the second \r\n will get clobbered; potential
+                # unicode byte-length issues here) and then tack on the
+                # additional lines you need to like so:
+                member.drop_raw()
+                warcinfo_block = record.payload.read()[:-2] + "software: %s\r\n\r\n" % self.ffmpeg_version
+                new_header['Content-Length'] = str(len(warcinfo_block))
+
+                write_record_header(new_warc_file, new_header)
+                new_warc_file.fileobj.write(warcinfo_block)
+                finish_record(new_warc_file)
+                continue
+
+            # Get the metadata record's warc-record-id for later resource
+            # records.
+            elif (record['WARC-Type'] == "metadata"):
+
+                metadata_record_ID = record['warc-record-id']
+
+            # End of conditionals. Proceed to write the new record to the
+            # post-processed warcfile.
+
+            # ------------------------ Copy Record -------------------------#
+
+            # SHORT record payloads are copied as they are, gzip member and
+            # all; their digests and everything else stay untouched. (Unless
+            # we're writing zstd; then they only get recompressed.)
+            if record_length < 500000:
+                if self.compression == "gz":
+                    write_raw_member(new_warc_file, member)
+                    continue
+                block_length = record_length
+
+            # LONG record payloads (the one that probably has video data) get
+            # truncated.
+            else:
+
+                # From page 9 of the ISO WARC Standard:
+                #
+                # "The WARC-Truncated field may be used on any WARC record. The WARC
+                # field Content-Length shall still report the actual truncated size of
+                # the record block."
+                block_length = min(record_length, TRUNCATED_BLOCK_LENGTH)
+                new_header['WARC-Truncated'] = "length"
+                new_header['Content-Length'] = str(block_length)
+
+
+            # (the writer handles the compression and putting each record in a
+            # separate gz "member" or zstd frame transparently; finish_record()
+            # tells it where the record ends)
+            member.drop_raw()
+            write_record_header(new_warc_file, new_header,
+                member.peek(HTTP_HEAD_PEEK_LENGTH))
+            copy_record_block(record.payload, new_warc_file.fileobj,
+                block_length, tee_file)
+            finish_record(new_warc_file)
+
+            if tee_file is not None:
+                tee_file.close()
+                video_sha1 = tee_file.sha1.hexdigest()
+
+        #------------------------ END OF MAIN FOR LOOP ------------------------#
+
+        old_warc_file.close()
+
+        # A "video-bulk" item only has the video's pages, and the video may
+        # not have been big enough to bother with; either way there's
+        # nothing to sample, and the WARC goes up as it is.
+        if not truncated_record_ID:
+            print("No video to sample in this WARC; leaving it as it is.")
+            new_warc_file.close()
+            os.remove("%(warc_file_base)s-POSTPROCESSED.warc." % item + self.compression)
+            os.chdir(original_path)
+            return
+
+        # at this point, we have a new warcfile with copied and truncated
+        # records; now, we need to sample the content and add these "conversion"
+        # records to the warc file.
+
+        # Should probably delete old warc at this point, since new warcfile has all
+        # of the old records, and we've already got another copy of the main
+        # payload. If we proceed to write out the full newfile with the shrunken
+        # payload before deleting the old warc, we'll basically be using nearly
+        # 3x the interim diskspace rather than 2x. (Don't get me wrong, I'd love
+        # to have more of a generator-like setup that negates the need to use
+        # twice the disk space, but it's beyond the scope of my abilities at the
+        # moment and I don't think I'd be able to get up to speed before the
+        # deadline for this project drops (August 27 2014) Update: LOL Twitch is
+        # already deleting things on August 26; oh well, I suppose this code
+        # could come in handy if the IA suddenly needs to compress lots of
+        # material; `postprocess.py batch` runs it over whole directories)
+
+        # Now, we need to convert the flv, and add conversion records
+        record_ids = {
+            "warcinfo": warcinfo_record_ID,
+            "metadata": metadata_record_ID,
+            "truncated": truncated_record_ID,
+        }
+
+        # Look at the video first, and figure out how much of it we can
+        # afford to keep.
+        plan = make_sampling_plan(probe_video(self.ffmpeg, "samplethis.flv"),
+            self.byte_budget, self.pixel_budget)
+        print("Sampling plan: %r" % plan)
+
+        # Snapshots may be taken by seeking, and long videos may be shrunk
+        # in segments on several cores; either way, the snapshots and the
+        # shrunken video can't come out of the same decode any more.
+        seek_snapshots = self.snapshot_mode != "decode" and plan.get("duration")
+        shrink_in_segments = (self.shrink_jobs > 1 and
+            plan.get("duration", 0) > self.shrink_segment_length)
+
+        # Maybe we've sampled this very video the very same way before.
+        cache_key = None
+        cached_samples = None
+        if self.cache is not None and video_sha1:
+            cache_key = hashlib.sha1(json.dumps([video_sha1, plan,
+                self.snapshot_mode, self.snapshot_dedup_distance,
+                bool(seek_snapshots), shrink_in_segments,
+                SAMPLE_IN_ONE_PASS, self.ffmpeg_version],
+                sort_keys=True)).hexdigest()
+            cached_samples = self.cache.restore(cache_key)
+            if cached_samples is None:
+                self.cache_entry = self.cache.start()
+                self.samples = []
+
+        try:
+            if cached_samples is not None:
+                # No ffmpeg needed
+                print("Found the samples of this video in the cache.")
+                self.write_cached_samples(new_warc_file, record_ids, cached_samples)
+            elif SAMPLE_IN_ONE_PASS and not seek_snapshots and not shrink_in_segments:
+                # Get snapshots and shrinked video out of a single decode
+                self.SnapShotAndShrinkRay(new_warc_file, record_ids, plan)
+            else:
+                # Get Snapshots
+                if seek_snapshots:
+                    self.SeekSnapShot(new_warc_file, record_ids, plan)
+                else:
+                    self.SnapShot(new_warc_file, record_ids, plan)
+
+                # Get shrinked video
+                if shrink_in_segments:
+                    self.SegmentedShrinkRay(new_warc_file, record_ids, plan)
+                else:
+                    self.ShrinkRay(new_warc_file, record_ids, plan)
+        except Exception:
+            # Whatever made it into the new cache entry is no good.
+            if self.cache_entry is not None:
+                shutil.rmtree(self.cache_entry, ignore_errors=True)
+                self.cache_entry = None
+            raise
+
+        # Only a complete set of samples goes in the cache: every call_ffmpeg()
+        # went fine, and every file was checked on the way in.
+        if self.cache_entry is not None:
+            self.cache.finish(cache_key, self.cache_entry, self.samples)
+            self.cache_entry = None
+
+        # Clean up
+        print("********************* \n\n Removing temporary files; cleaning up \n\n*********************")
+        # remove the original file intermediate: "samplethis.flv"
+        rmargs = shlex.split("rm samplethis.flv")
+        call(rmargs)
+
+        # And we're done!
+        new_warc_file.close()
+        new_warc_file.index.write("%(warc_file_base)s-POSTPROCESSED.cdxj" % item)
+        os.chdir(original_path)
+
+    ###################
+    # Sampling routines
+    #
+
+    # Adds a log record and a conversion record, like the module-level
+    # functions of the same names, but puts the files in the cache entry
+    # being made, if there is one, first.
+    def write_sample_records(self, new_warc_file, record_ids, log_name,
+                             content_type, filename):
+        check_outputs([filename])
+        self.cache_sample(log_name, content_type, [filename])
+        write_sample_records(new_warc_file, record_ids, log_name,
+            content_type, filename)
+
+    def write_snapshot_records(self, new_warc_file, record_ids, log_name,
+                               snapshots):
+        check_outputs(snapshots)
+        self.cache_sample(log_name, SNAPSHOT_CONTENT_TYPE, snapshots)
+        write_snapshot_records(new_warc_file, record_ids, log_name, snapshots)
+
+    def cache_sample(self, log_name, content_type, filenames):
+        if self.cache_entry is None:
+            return
+        sample = {"log": log_name, "content_type": content_type,
+            "files": filenames}
+        self.cache.add(self.cache_entry, sample)
+        self.samples.append(sample)
+
+    # Writes the records of samples that came out of the cache
+    def write_cached_samples(self, new_warc_file, record_ids, samples):
+        for sample in samples:
+            if sample["content_type"] == SNAPSHOT_CONTENT_TYPE:
+                write_snapshot_records(new_warc_file, record_ids,
+                    sample["log"], sample["files"])
+            else:
+                write_sample_records(new_warc_file, record_ids,
+                    sample["log"], sample["content_type"], sample["files"][0])
+                os.remove(sample["files"][0])
+
+        # one log may go with more than one sample
+        for log_name in set(sample["log"] for sample in samples):
+            os.remove(log_name)
+
+    # The snapshot files to archive, deduplicated if we were told to
+    def snapshots(self, plan):
+        if self.snapshot_dedup_distance is None:
+            return snapshot_files()
+        return dedup_snapshots(self.ffmpeg, plan, self.snapshot_dedup_distance)
+
+    # High fidelity snapshots
+    def SnapShot(self, new_warc_file, record_ids, plan):
+
+        # The native-resolution frame sampling rate comes from the plan and
+        # scales with the length of the video.
+
+        print("********************* \n\n Getting snapshots. \n\n*********************")
+
+        # snapshot
+        # This is the "proper" way to handle complex command lines with lots of args
+        # https://stackoverflow.com/questions/8581140/python-subprocess-call-with-arguments-having-multiple-quotations
+        ffmpegsnapshotargs = [self.ffmpeg, "-i", "samplethis.flv", "-vf", snapshot_filter(plan)] + SNAPSHOT_OUTPUT_ARGS
+        call_ffmpeg(ffmpegsnapshotargs, "ffmpeg-snapshots.log")
+
+        # Add ffmpeg log record and the actual snapshot record
+        self.write_snapshot_records(new_warc_file, record_ids, "ffmpeg-snapshots.log",
+            self.snapshots(plan))
+
+        # remove log
+        os.remove("ffmpeg-snapshots.log")
+
+        # end of SnapShot()
+
+    # High fidelity snapshots, the quick way
+    def SeekSnapShot(self, new_warc_file, record_ids, plan):
+
+        # SnapShot() decodes every frame of the video to keep one in every
+        # few hundred. Instead, seek to each snapshot's timestamp and decode
+        # from the keyframe before it (or only take that keyframe), with the
+        # timestamps shared out among several ffmpeg processes. Snapshot time
+        # then goes with the number of snapshots, not the length of the video.
+
+        print("********************* \n\n Getting snapshots by seeking. \n\n*********************")
+
+        times = snapshot_times(plan)
+        keyframe_only = self.snapshot_mode == "keyframe"
+
+        def take_snapshot(number):
+            call_ffmpeg(seek_snapshot_args(self.ffmpeg, times[number - 1],
+                "images%05d.jpg" % number, keyframe_only),
+                "ffmpeg-snapshot%05d.log" % number)
+
+        pool = ThreadPool(self.snapshot_jobs)
+        pool.map(take_snapshot, range(1, len(times) + 1))
+        pool.close()
+        pool.join()
+
+        # one log for all the ffmpeg runs, in snapshot order
+        join_logs(["ffmpeg-snapshot%05d.log" % number
+            for number in range(1, len(times) + 1)], "ffmpeg-snapshots.log")
+
+        # Add ffmpeg log record and the actual snapshot record
+        self.write_snapshot_records(new_warc_file, record_ids, "ffmpeg-snapshots.log",
+            self.snapshots(plan))
+
+        # remove log
+        os.remove("ffmpeg-snapshots.log")
+
+        # end of SeekSnapShot()
+
+    # Low fidelity, shrinked video
+    def ShrinkRay(self, new_warc_file, record_ids, plan):
+
+        # The output size, frame rate and bitrate come from the plan, and
+        # scale with the length, size and aspect ratio of the video.
+
+        print("********************* \n\n Shrinking Video. (This will take a while) \n\n*********************")
+
+        # shrink; using the webm format at this resolution cuts the file size by
+        # *about* an order of magnitude, while still maintaining more-or-less
+        # perfectly crisp detail and motion. I'm thinking we don't need to drop
+        # frames, and that cutting the resolution down to this ~240P-level
+        # resolution is good enough.
+
+        ffmpegshrinkargs = [self.ffmpeg, "-i", "samplethis.flv", "-vf", shrink_filter(plan)] + shrink_output_args(plan)
+        call_ffmpeg(ffmpegshrinkargs, "ffmpeg-shrinking.log")
+
+        # The final size of snapshots and shrunken video is anywhere from a fifth to
+        # a seventh of the original file size.
+
+        # add ffmpeg log record and actual shrunken webm record
+        self.write_sample_records(new_warc_file, record_ids, "ffmpeg-shrinking.log",
+            "video/webm", "shrunken-to-webm.webm")
+
+        # remove shrunken video and log file
+        call(shlex.split("rm shrunken-to-webm.webm ffmpeg-shrinking.log"))
+
+        # end of ShrinkRay()
+
+    # Low fidelity, shrinked video, on several cores
+    def SegmentedShrinkRay(self, new_warc_file, record_ids, plan):
+
+        # A single libvpx encode keeps one core busy for hours on a long
+        # broadcast. So cut the flv into segments at keyframes (which takes
+        # no transcoding at all), shrink the segments in parallel, and stitch
+        # the webms back together without transcoding them again.
+
+        print("********************* \n\n Shrinking Video in segments. (This will take a while) \n\n*********************")
+
+        call_ffmpeg([self.ffmpeg, "-nostdin", "-i", "samplethis.flv", "-map", "0",
+            "-c", "copy", "-f", "segment",
+            "-segment_time", str(self.shrink_segment_length),
+            "-reset_timestamps", "1", "segment%05d.flv"],
+            "ffmpeg-segmenting.log")
+        segments = [segment[:-len(".flv")]
+            for segment in sorted(glob.glob("segment*.flv"))]
+
+        def shrink_segment(segment):
+            call_ffmpeg([self.ffmpeg, "-nostdin", "-loglevel", "error",
+                "-i", segment + ".flv", "-vf", shrink_filter(plan)] +
+                shrink_output_args(plan, segment + ".webm"),
+                segment + ".log")
+            os.remove(segment + ".flv")
+
+        pool = ThreadPool(self.shrink_jobs)
+        pool.map(shrink_segment, segments)
+        pool.close()
+        pool.join()
+
+        with open("segments.txt", "w") as segment_list:
+            for segment in segments:
+                segment_list.write("file '%s.webm'\n" % segment)
+        call_ffmpeg([self.ffmpeg, "-nostdin", "-f", "concat", "-i", "segments.txt",
+            "-c", "copy", "shrunken-to-webm.webm"],
+            "ffmpeg-concat.log")
+
+        join_logs(["ffmpeg-segmenting.log"] +
+            [segment + ".log" for segment in segments] + ["ffmpeg-concat.log"],
+            "ffmpeg-shrinking.log")
+        for segment in segments:
+            if os.path.exists(segment + ".webm"):
+                os.remove(segment + ".webm")
+        os.remove("segments.txt")
+
+        # Make sure no segment went missing (or turned up twice) on the way.
+        duration = probe_video(self.ffmpeg, "shrunken-to-webm.webm").get("duration", 0)
+        if abs(duration - plan["duration"]) > SHRINK_MAX_DURATION_ERROR:
+            print("Shrunken video is %.1f seconds long instead of %.1f; "
+                "shrinking it in one go instead." % (duration, plan["duration"]))
+            call(shlex.split("rm -f shrunken-to-webm.webm ffmpeg-shrinking.log"))
+            self.ShrinkRay(new_warc_file, record_ids, plan)
+            return
+
+        # add ffmpeg log record and actual shrunken webm record
+        self.write_sample_records(new_warc_file, record_ids, "ffmpeg-shrinking.log",
+            "video/webm", "shrunken-to-webm.webm")
+
+        # remove shrunken video and log file
+        call(shlex.split("rm shrunken-to-webm.webm ffmpeg-shrinking.log"))
+
+        # end of SegmentedShrinkRay()
+
+    # Both of the above, out of a single decode of the video
+    def SnapShotAndShrinkRay(self, new_warc_file, record_ids, plan):
+
+        # Decoding the flv is most of the work in both SnapShot() and
+        # ShrinkRay(), so rather than running ffmpeg twice, decode once and
+        # split the decoded video into two filter chains: one that keeps a
+        # frame every so often for the snapshots, and one that scales it down
+        # for the webm.
+
+        print("********************* \n\n Getting snapshots and shrinking Video. (This will take a while) \n\n*********************")
+
+        ffmpegsampleargs = [
+            self.ffmpeg, "-i", "samplethis.flv",
+            "-filter_complex",
+            "[0:v]split=2[snap][shrink];"
+            "[snap]%s[snapout];"
+            "[shrink]%s[shrinkout]" % (snapshot_filter(plan), shrink_filter(plan)),
+            "-map", "[snapout]",
+        ] + SNAPSHOT_OUTPUT_ARGS + [
+            "-map", "[shrinkout]", "-map", "0:a?",
+        ] + shrink_output_args(plan)
+        call_ffmpeg(ffmpegsampleargs, "ffmpeg-sampling.log")
+
+        # There is only one ffmpeg log now; it goes into the resource record
+        # next to each of the two conversion records, same as before.
+        self.write_snapshot_records(new_warc_file, record_ids, "ffmpeg-sampling.log",
+            self.snapshots(plan))
+        self.write_sample_records(new_warc_file, record_ids, "ffmpeg-sampling.log",
+            "video/webm", "shrunken-to-webm.webm")
+
+        # remove outputs and log
+        call(shlex.split("rm shrunken-to-webm.webm ffmpeg-sampling.log"))
+
+        # end of SnapShotAndShrinkRay()
+
+    #end of class Sampler(object)
+
+
+###########################################################################
+# Batch post-processing.
+#
+# Runs the same truncate-and-sample transform over WARCs that were grabbed
+# long ago, whole directories of them, on a pool of processes. Every WARC is
+# sampled in a scratch directory of its own, and its new warc and index are
+# only moved into the output directory once they're complete. Then it's
+# written down in a journal, so a run that gets killed carries on where it
+# left off. A WARC that fails leaves nothing but its log behind, and the
+# rest carry on regardless.
+
+# Name of the journal, in the output directory.
+BATCH_JOURNAL = "postprocess-batch.journal"
+
+
+def find_batch_warcs(paths):
+    # The .warc.gz files among `paths` and in the directories among them,
+    # except for ones that are post-processed already.
+    warc_names = []
+    for path in paths:
+        if os.path.isdir(path):
+            warc_names.extend(sorted(glob.glob(os.path.join(path, "*.warc.gz"))))
+        else:
+            warc_names.append(path)
+    return [os.path.abspath(warc_name) for warc_name in warc_names
+        if not warc_name.endswith("-POSTPROCESSED.warc.gz")]
+
+
+def read_batch_journal(filename):
+    # The WARCs that earlier runs got done. Failed ones get another go.
+    done = set()
+    if os.path.exists(filename):
+        with open(filename) as journal:
+            for line in journal:
+                fields = line.rstrip("\n").split("\t")
+                if fields[0] == "done":
+                    done.add(fields[1])
+    return done
+
+
+def check_warc(filename):
+    # Reads a finished .warc.gz through, record by record. iter_warc_members
+    # raises if a gzip member or a record in it is cut short.
+    with open(filename, "rb") as warc_fileobj:
+        for member in iter_warc_members(warc_fileobj):
+            for chunk in iter(lambda: member.record.payload.read(
+                    WARC_CHUNK_SIZE), ""):
+                pass
+
+
+def sample_batch_warc(job):
+    # Pool worker: samples one WARC into `output_dir`. Returns the name of
+    # the WARC and, if anything went wrong, the error.
+    sampler, warc_name, output_dir = job
+    warc_file_base = os.path.basename(warc_name)[:-len(".warc.gz")]
+
+    work_dir = os.path.join(output_dir, ".%s.batch" % warc_file_base)
+    if os.path.exists(work_dir):
+        # left behind by a run that got killed
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    os.symlink(warc_name, os.path.join(work_dir, warc_file_base + ".warc.gz"))
+
+    # The Sampler and ffmpeg have a lot to say; it all goes to a log file
+    # rather than drowning out the progress report.
+    log_name = os.path.join(work_dir, "batch.log")
+    original_path = os.getcwd()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_stdout, saved_stderr = os.dup(1), os.dup(2)
+    with open(log_name, "w") as log_file:
+        os.dup2(log_file.fileno(), 1)
+        os.dup2(log_file.fileno(), 2)
+        error = None
+        try:
+            sampler.process({
+                "item_name": "video-bulk:" + warc_file_base,
+                "item_dir": work_dir,
+                "warc_file_base": warc_file_base,
+            })
+            # Only a new warc that reads back whole goes in the journal. (A
+            # WARC without a video doesn't get one.)
+            new_warc_name = os.path.join(work_dir,
+                warc_file_base + "-POSTPROCESSED.warc.gz")
+            if sampler.compression == "gz" and os.path.exists(new_warc_name):
+                check_warc(new_warc_name)
+        except Exception:
+            traceback.print_exc()
+            error = traceback.format_exc().strip().splitlines()[-1]
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_stdout, 1)
+            os.dup2(saved_stderr, 2)
+            os.close(saved_stdout)
+            os.close(saved_stderr)
+            os.chdir(original_path)
+
+    if error is None:
+        for name in os.listdir(work_dir):
+            if name.startswith(warc_file_base + "-POSTPROCESSED."):
+                os.rename(os.path.join(work_dir, name),
+                    os.path.join(output_dir, name))
+    else:
+        os.rename(log_name, os.path.join(output_dir,
+            warc_file_base + "-POSTPROCESSED.failed.log"))
+    shutil.rmtree(work_dir)
+
+    return warc_name, error
+
+
+def run_batch(sampler, paths, output_dir=None, jobs=None):
+    # Samples all the WARCs in `paths` with `sampler`, `jobs` at a time (as
+    # many as there are cores, by default). The results go to `output_dir`,
+    # or next to each WARC if there's none. Returns how many WARCs failed.
+    warc_names = find_batch_warcs(paths)
+    journal_name = os.path.join(output_dir or ".", BATCH_JOURNAL)
+    done = read_batch_journal(journal_name)
+    todo = [warc_name for warc_name in warc_names if warc_name not in done]
+    print("%d WARCs, %d done already, %d to go" % (len(warc_names),
+        len(warc_names) - len(todo), len(todo)))
+
+    if output_dir is not None and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    # Ask ffmpeg for its version once, not in every worker.
+    if sampler.ffmpeg_version is None:
+        sampler.ffmpeg_version = ffmpeg_version(sampler.ffmpeg)
+    jobs_list = [(sampler, warc_name,
+        os.path.abspath(output_dir or os.path.dirname(warc_name)))
+        for warc_name in todo]
+
+    # One WARC per worker process: whatever a sampling run leaves behind
+    # (working directory, open files, memory) goes away with the process.
+    pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count(),
+        maxtasksperchild=1)
+    start = time.time()
+    total_bytes = 0
+    failed = 0
+    with open(journal_name, "a") as journal:
+        results = pool.imap_unordered(sample_batch_warc, jobs_list)
+        for count, (warc_name, error) in enumerate(results, 1):
+            if error is None:
+                journal.write("done\t%s\n" % warc_name)
+            else:
+                journal.write("failed\t%s\t%s\n" % (warc_name, error))
+                failed += 1
+            journal.flush()
+            os.fsync(journal.fileno())
+
+            total_bytes += os.path.getsize(warc_name)
+            elapsed = time.time() - start
+            remaining = elapsed / count * (len(jobs_list) - count)
+            print("[%d/%d] %s %s (%.1f MB/s, %d failed, %d:%02d to go)" % (
+                count, len(jobs_list), "done" if error is None else "FAILED",
+                os.path.basename(warc_name),
+                total_bytes / 1000000.0 / max(elapsed, 0.001), failed,
+                remaining // 3600, remaining % 3600 // 60))
+            if error is not None:
+                print("    " + error)
+            sys.stdout.flush()
+    pool.close()
+    pool.join()
+
+    return failed
+
+
+def get_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(WARC_CHUNK_SIZE), ""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def read_dictionary(filename):
+    if not filename:
+        return None
+    with open(filename, "rb") as in_file:
+        return in_file.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Post-process grabbed WARCs.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    compression_parser = argparse.ArgumentParser(add_help=False)
+    compression_parser.add_argument("--compress-level", type=int,
+        default=COMPRESS_LEVEL, help="gzip compression level of the new warc")
+    compression_parser.add_argument("--compress-threads", type=int,
+        default=COMPRESS_THREADS, help="how many threads compress the new warc")
+    compression_parser.add_argument("--zstd-level", type=int,
+        default=ZSTD_LEVEL, help="zstd compression level of the new warc")
+    compression_parser.add_argument("--zstd-dictionary",
+        help="file holding the dictionary to compress zstd warcs with")
+
+    sampling_parser = argparse.ArgumentParser(add_help=False,
+        parents=[compression_parser])
+    sampling_parser.add_argument("--ffmpeg", default="ffmpeg",
+        help="the ffmpeg executable to use")
+    sampling_parser.add_argument("--ffmpeg-version",
+        help='what the warcinfo record says about ffmpeg, e.g. "ffmpeg/2.3.1" '
+             '(default: ask ffmpeg)')
+    sampling_parser.add_argument("--byte-budget", type=int,
+        default=SAMPLE_BYTE_BUDGET,
+        help="how many bytes the shrunken video may take up")
+    sampling_parser.add_argument("--pixel-budget", type=int,
+        default=SAMPLE_PIXEL_BUDGET,
+        help="how many pixels ffmpeg may encode for the shrunken video")
+    sampling_parser.add_argument("--compression", choices=["gz", "zst"],
+        default="gz", help="write a .warc.gz or a .warc.zst")
+    sampling_parser.add_argument("--snapshot-mode",
+        choices=["decode", "seek", "keyframe"], default=SNAPSHOT_MODE,
+        help="decode the whole video for snapshots, seek to each one, or "
+             "only take the nearest keyframes")
+    sampling_parser.add_argument("--snapshot-jobs", type=int,
+        default=SNAPSHOT_JOBS,
+        help="how many ffmpeg processes take snapshots by seeking at once")
+    sampling_parser.add_argument("--shrink-jobs", type=int,
+        default=SHRINK_JOBS,
+        help="how many segments of a long video to shrink at once")
+    sampling_parser.add_argument("--shrink-segment-length", type=int,
+        default=SHRINK_SEGMENT_LENGTH,
+        help="length in seconds of the segments long videos are cut into")
+    sampling_parser.add_argument("--snapshot-dedup-distance", type=int,
+        default=SNAPSHOT_DEDUP_DISTANCE,
+        help="drop snapshots whose perceptual hash is at most this many "
+             "bits off the last one kept (default: keep them all)")
+    sampling_parser.add_argument("--cache-dir",
+        help="keep samples in this directory, to reuse if the same video "
+             "comes around again")
+    sampling_parser.add_argument("--cache-size", type=int,
+        default=SAMPLE_CACHE_SIZE, help="size of the sample cache in bytes")
+
+    sample_parser = subparsers.add_parser("sample",
+        parents=[sampling_parser],
+        help="truncate and sample the video in an item's WARC")
+    sample_parser.add_argument("item_name")
+    sample_parser.add_argument("item_dir")
+    sample_parser.add_argument("warc_file_base")
+
+    train_parser = subparsers.add_parser("train-dictionary",
+        help="train a zstd dictionary on the records of some WARCs")
+    train_parser.add_argument("--size", type=int, default=ZSTD_DICTIONARY_SIZE,
+        help="size of the dictionary in bytes")
+    train_parser.add_argument("dictionary")
+    train_parser.add_argument("warc", nargs="+")
+
+    benchmark_parser = subparsers.add_parser("benchmark",
+        parents=[compression_parser],
+        help="compare gzip and zstd on the records of some WARCs")
+    benchmark_parser.add_argument("warc", nargs="+")
+
+    batch_parser = subparsers.add_parser("batch",
+        parents=[sampling_parser],
+        help="truncate and sample the videos in lots of existing WARCs")
+    batch_parser.add_argument("--jobs", type=int,
+        help="how many WARCs to sample at once (default: one per core)")
+    batch_parser.add_argument("--output-dir",
+        help="where the new warcs go (default: next to the old ones); "
+             "the journal of the run is kept here as well")
+    batch_parser.add_argument("warc", nargs="+",
+        help="a .warc.gz file, or a directory of them")
+
+    args = parser.parse_args()
+
+    if args.command in ("sample", "batch"):
+        sampler = Sampler(args.ffmpeg, args.byte_budget, args.pixel_budget,
+            args.compress_level, args.compress_threads, args.compression,
+            args.zstd_level, read_dictionary(args.zstd_dictionary),
+            args.snapshot_mode, args.snapshot_jobs, args.shrink_jobs,
+            args.shrink_segment_length, args.snapshot_dedup_distance,
+            args.cache_dir, args.cache_size, args.ffmpeg_version)
+
+    if args.command == "sample":
+        sampler.process({
+            "item_name": args.item_name,
+            "item_dir": args.item_dir,
+            "warc_file_base": args.warc_file_base,
+        })
+
+    elif args.command == "batch":
+        if run_batch(sampler, args.warc, args.output_dir, args.jobs):
+            sys.exit(1)
+
+    elif args.command == "train-dictionary":
+        dictionary = train_zstd_dictionary(args.warc, args.size)
+        with open(args.dictionary, "wb") as out_file:
+            out_file.write(dictionary)
+
+    elif args.command == "benchmark":
+        benchmark_compression(args.warc, args.compress_level,
+            args.compress_threads, args.zstd_level,
+            read_dictionary(args.zstd_dictionary))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+# encoding=utf8
+#
+# Runs download.py against a range-capable HTTP server on localhost.
+#
+#     python -m unittest discover tests
+import BaseHTTPServer
+import SocketServer
+import base64
+import hashlib
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import warc
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# download.py, with its sizes scaled down to fit a test video.
+DOWNLOAD_COMMAND = """
+import download
+download.PARALLEL_MIN_PART_SIZE = 256 * 1024
+download.CHECKPOINT_INTERVAL = 64 * 1024
+download.main()
+"""
+
+VIDEO_SIZE = 3 * 1024 * 1024
+
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Serves server.video at /video.flv, with Range requests if
+    # server.ranges (or just saying so, if server.advertise_ranges),
+    # stalling after server.stall_after bytes of a body until
+    # server.release is set. The ETag is the MD5 of the video, unless
+    # server.etag says otherwise; server.content_md5 goes in a Content-MD5.
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        video = server.video
+        etag = server.etag or '"%s"' % hashlib.md5(video).hexdigest()
+        server.requests.append(self.headers.get("Range"))
+
+        start, end, status = 0, len(video), 200
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if (match and server.ranges and
+                self.headers.get("If-Range", etag) == etag):
+            start, status = int(match.group(1)), 206
+            if match.group(2):
+                end = int(match.group(2)) + 1
+
+        self.send_response(status)
+        self.send_header("Content-Type", "video/x-flv")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(end - start))
+        if server.content_md5:
+            self.send_header("Content-MD5", server.content_md5)
+        if server.ranges or server.advertise_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        else:
+            self.send_header("Accept-Ranges", "none")
+        if status == 206:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start,
+                end - 1, len(video)))
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        body = video[start:end]
+        if server.stall_after is not None:
+            self.wfile.write(body[:server.stall_after])
+            self.wfile.flush()
+            server.stall_after = None
+            server.release.wait(30)
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RangeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, video):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+            RangeHandler)
+        self.video = video
+        self.ranges = True
+        self.advertise_ranges = False
+        self.stall_after = None
+        self.etag = None
+        self.content_md5 = None
+        self.release = threading.Event()
+        self.requests = []
+
+    def handle_error(self, request, client_address):
+        # (download.py hangs up on a response it doesn't want)
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.item_dir = os.path.join(self.temp_dir, "item")
+        self.checkpoint_dir = os.path.join(self.temp_dir, "partial")
+        os.makedirs(self.item_dir)
+        self.log_file = open(os.path.join(self.temp_dir, "download.log"), "w")
+
+        self.video = os.urandom(VIDEO_SIZE)
+        self.server = RangeServer(self.video)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%d/video.flv" % self.server.server_port
+
+    def tearDown(self):
+        self.server.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.log_file.close()
+        shutil.rmtree(self.temp_dir)
+
+    def start_download(self, warc_file_base, connections=1, segment_size=0):
+        env = dict(os.environ, PYTHONPATH=REPO)
+        return subprocess.Popen([sys.executable, "-c", DOWNLOAD_COMMAND,
+            "--connections", str(connections),
+            "--segment-size", str(segment_size),
+            "--checkpoint-dir", self.checkpoint_dir,
+            self.url, self.item_dir, warc_file_base],
+            env=env, stdout=self.log_file, stderr=subprocess.STDOUT)
+
+    def download(self, warc_file_base, connections=1):
+        self.assertEqual(self.start_download(warc_file_base,
+            connections).wait(), 0)
+        return self.read_warc(os.path.join(self.item_dir,
+            warc_file_base + ".warc.gz"))
+
+    def read_warc(self, filename):
+        records = []
+        warc_file = warc.open(filename)
+        for record in warc_file:
+            records.append((record.header, record.payload.read()))
+        warc_file.close()
+        return records
+
+    def assertVideoRecord(self, records):
+        responses = [(header, block) for header, block in records
+            if header["WARC-Type"] == "response"]
+        self.assertEqual(len(responses), 1)
+        header, block = responses[0]
+        body = block.split("\r\n\r\n", 1)[1]
+        self.assertEqual(len(body), VIDEO_SIZE)
+        self.assertEqual(hashlib.md5(body).digest(),
+            hashlib.md5(self.video).digest())
+        self.assertEqual(header["WARC-Payload-Digest"],
+            "sha1:" + base64.b32encode(hashlib.sha1(self.video).digest()))
+
+    def log(self):
+        self.log_file.flush()
+        with open(self.log_file.name) as log_file:
+            return log_file.read()
+
+    def assertDownloadFails(self, warc_file_base, connections=1):
+        # The download gives up, and leaves no WARC, nor a checkpoint for the
+        # next attempt to carry on from.
+        process = self.start_download(warc_file_base, connections)
+        self.assertNotEqual(process.wait(), 0)
+        self.assertEqual(os.listdir(self.item_dir), [])
+        self.assertEqual(self.checkpoint(), None)
+
+    def checkpoint(self):
+        try:
+            with open(os.path.join(self.checkpoint_dir,
+                    "download.checkpoint")) as checkpoint_file:
+                return json.load(checkpoint_file)
+        except (IOError, ValueError):
+            return None
+
+    def test_parallel_ranges(self):
+        records = self.download("parallel", connections=4)
+
+        self.assertVideoRecord(records)
+        self.assertIn("MD5 of the video checks out", self.log())
+        # the first part comes out of the first response, the others with
+        # a Range request each
+        self.assertEqual(self.server.requests[0], None)
+        ranges = sorted(self.server.requests[1:],
+            key=lambda request: int(re.search(r"\d+", request).group()))
+        self.assertEqual(len(ranges), 3)
+        for number, request in enumerate(ranges, 1):
+            self.assertEqual(request, "bytes=%d-%d" % (
+                VIDEO_SIZE * number // 4, VIDEO_SIZE * (number + 1) // 4 - 1))
+
+    def test_wrong_etag_md5(self):
+        # The parts don't add up to what the server says the video is.
+        self.server.etag = '"%s"' % hashlib.md5("some other video").hexdigest()
+        self.assertDownloadFails("wrong-md5", connections=4)
+        self.assertIn("The video's MD5 is %s instead of %s" % (
+            hashlib.md5(self.video).hexdigest(),
+            hashlib.md5("some other video").hexdigest()), self.log())
+
+    def test_wrong_content_md5(self):
+        self.server.content_md5 = base64.b64encode(
+            hashlib.md5("some other video").digest())
+        self.assertDownloadFails("wrong-md5", connections=4)
+
+    def test_segments(self):
+        # A video of 3 MiB, in WARCs of 1 MiB; they're left in the
+        # checkpoint directory for the pipeline to upload.
+        self.assertEqual(self.start_download("segmented",
+            segment_size=1).wait(), 0)
+        self.assertEqual(os.listdir(self.item_dir), [])
+        segments = sorted(os.listdir(self.checkpoint_dir))
+        self.assertEqual(segments, ["segmented-00001.warc.gz",
+            "segmented-00002.warc.gz", "segmented-00003.warc.gz"])
+        segments = [self.read_warc(os.path.join(self.checkpoint_dir, segment))
+            for segment in segments]
+
+        # Every one has a warcinfo record that names it.
+        for number, records in enumerate(segments, 1):
+            self.assertEqual(records[0][0]["WARC-Type"], "warcinfo")
+            self.assertEqual(records[0][0]["WARC-Filename"],
+                "segmented-%05d.warc.gz" % number)
+
+        # The first one has the request and the start of the response...
+        types = [header["WARC-Type"] for header, block in segments[0]]
+        self.assertEqual(types, ["warcinfo", "request", "response"])
+        response, block = segments[0][2]
+        self.assertEqual(response["WARC-Segment-Number"], "1")
+        self.assertNotIn("WARC-Payload-Digest", response)
+        head, body = block.split("\r\n\r\n", 1)
+        blocks = [block]
+
+        # ...the others a continuation record with the next piece each, and
+        # the last one the log as well.
+        for number, records in enumerate(segments[1:], 2):
+            types = [header["WARC-Type"] for header, block in records]
+            self.assertEqual(types, ["warcinfo", "continuation"] +
+                (["metadata"] if number == 3 else []))
+            continuation, block = records[1]
+            self.assertEqual(continuation["WARC-Segment-Number"], str(number))
+            self.assertEqual(continuation["WARC-Segment-Origin-ID"],
+                response["WARC-Record-ID"])
+            self.assertEqual(continuation["WARC-Target-URI"], self.url)
+            if number == 3:
+                self.assertEqual(continuation["WARC-Segment-Total-Length"],
+                    str(len(head) + 4 + VIDEO_SIZE))
+            else:
+                self.assertNotIn("WARC-Segment-Total-Length", continuation)
+            blocks.append(block)
+
+        # Put back together, it's the whole response.
+        self.assertEqual([len(block) - len(head) - 4 if number == 0 else
+            len(block) for number, block in enumerate(blocks)],
+            [1024 * 1024] * 3)
+        self.assertEqual("".join(blocks), head + "\r\n\r\n" + self.video)
+        self.assertEqual(self.checkpoint(), None)
+
+    def test_small_video_in_one_segment(self):
+        self.assertEqual(self.start_download("segmented",
+            segment_size=4).wait(), 0)
+        self.assertEqual(sorted(os.listdir(self.checkpoint_dir)),
+            ["segmented-00001.warc.gz"])
+        records = self.read_warc(os.path.join(self.checkpoint_dir,
+            "segmented-00001.warc.gz"))
+        self.assertVideoRecord(records)
+        self.assertNotIn("WARC-Segment-Number", records[2][0])
+
+    def test_ranges_ignored(self):
+        self.server.ranges = False
+        records = self.download("single", connections=4)
+
+        # no Range requests, as the server won't take them
+        self.assertEqual(self.server.requests, [None])
+        self.assertVideoRecord(records)
+
+    def test_range_request_ignored(self):
+        # The server says it does ranges, then sends the whole video anyway.
+        self.server.ranges = False
+        self.server.advertise_ranges = True
+        records = self.download("single", connections=4)
+
+        self.assertEqual(self.server.requests[0], None)
+        self.assertTrue(len(self.server.requests) > 1)
+        self.assertEqual(self.server.requests[-1], None)
+        self.assertVideoRecord(records)
+
+    def test_resume_after_kill(self):
+        self.server.stall_after = VIDEO_SIZE // 2
+        process = self.start_download("first-attempt")
+
+        # wait for the checkpoint to have some of the body
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            checkpoint = self.checkpoint()
+            if checkpoint and checkpoint.get("parts") and \
+                    checkpoint["parts"][0][2] > 0:
+                break
+            time.sleep(0.05)
+        else:
+            self.fail("The download never checkpointed any of the body.")
+        process.send_signal(signal.SIGKILL)
+        process.wait()
+        done = checkpoint["parts"][0][2]
+
+        # A later attempt gets a new item directory and WARC name.
+        shutil.rmtree(self.item_dir)
+        os.makedirs(self.item_dir)
+        records = self.download("second-attempt")
+
+        self.assertEqual(self.server.requests[-1], "bytes=%d-%d" % (done,
+            VIDEO_SIZE - 1))
+        self.assertVideoRecord(records)
+        warcinfo = records[0][0]
+        self.assertEqual(warcinfo["WARC-Type"], "warcinfo")
+        self.assertEqual(warcinfo["WARC-Filename"], "second-attempt.warc.gz")
+        self.assertEqual(os.listdir(self.checkpoint_dir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
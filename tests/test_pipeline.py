@@ -0,0 +1,383 @@
+# encoding=utf8
+#
+# Tests of the tasks in pipeline.py. The pipeline is loaded the way seesaw
+# loads it, from a scratch copy of the project with stand-ins for wget-lua
+# and ffmpeg, which only have to say the right version.
+#
+#     python -m unittest discover tests
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from seesaw.item import Item
+from seesaw.task import Task
+from tornado.testing import AsyncTestCase
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROJECT_FILES = ["pipeline.py", "twitchtv.lua", "postprocess.py",
+    "download.py", "measure.py"]
+STAND_INS = {
+    "wget-lua": "GNU Wget 1.14.lua.20130523-9a5c",
+    "ffmpeg": "ffmpeg version 2.3.1",
+}
+
+
+def load_pipeline(project_dir):
+    # Returns the globals of pipeline.py, run in `project_dir`.
+    for filename in PROJECT_FILES:
+        shutil.copy(os.path.join(REPO, filename), project_dir)
+    for filename, version in STAND_INS.items():
+        path = os.path.join(project_dir, filename)
+        with open(path, "w") as stand_in:
+            stand_in.write("#!/bin/sh\necho '%s'\n" % version)
+        os.chmod(path, 0755)
+
+    context = {"downloader": "test"}
+    original_path = os.getcwd()
+    os.chdir(project_dir)
+    try:
+        with open("pipeline.py") as pipeline_file:
+            exec(pipeline_file.read(), context)
+    finally:
+        os.chdir(original_path)
+    return context
+
+
+class StubResolver(object):
+    # Answers with `address` (or raises `error`), and counts the lookups.
+    def __init__(self, address):
+        self.address = address
+        self.error = None
+        self.hosts = []
+        self.threads = []
+
+    def __call__(self, host):
+        self.hosts.append(host)
+        self.threads.append(threading.current_thread())
+        if self.error is not None:
+            raise self.error
+        return self.address
+
+
+class CheckIPTest(AsyncTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.project_dir = tempfile.mkdtemp()
+        cls.pipeline = load_pipeline(cls.project_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.project_dir)
+
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.resolver = StubResolver("192.16.71.10")
+        self.task = self.pipeline["CheckIP"](interval=60,
+            resolver=self.resolver)
+        self.results = {}
+        self.task.on_complete_item += lambda task, item: \
+            self.finished(item, "complete")
+        self.task.on_fail_item += lambda task, item: \
+            self.finished(item, "failed")
+
+    def finished(self, item, result):
+        self.results[item.item_id] = result
+        if self.waiting and len(self.results) == self.expected:
+            self.stop()
+
+    def check(self, *item_ids):
+        # Runs items through the task at the same time, and returns what
+        # became of each.
+        self.results = {}
+        self.expected = len(item_ids)
+        self.waiting = False
+        for item_id in item_ids:
+            self.task.enqueue(Item(None, item_id, 1,
+                prepare_data_directory=False))
+        # (a cached verdict comes right away)
+        if len(self.results) < self.expected:
+            self.waiting = True
+            self.wait()
+        return [self.results[item_id] for item_id in item_ids]
+
+    def test_lookup_off_the_event_loop(self):
+        self.assertEqual(self.check("a", "b"), ["complete", "complete"])
+        # both items waited for the same lookup, made in a thread
+        self.assertEqual(self.resolver.hosts, ["twitch.tv"])
+        self.assertNotEqual(self.resolver.threads[0],
+            threading.current_thread())
+
+    def test_cached_verdict(self):
+        self.assertEqual(self.check("a"), ["complete"])
+        self.assertEqual(self.check("b"), ["complete"])
+        self.assertEqual(len(self.resolver.hosts), 1)
+
+        # once `interval` is up, it's looked up again
+        self.task._checked_at -= 61
+        self.resolver.address = "10.0.0.1"
+        self.assertEqual(self.check("c"), ["failed"])
+        self.assertEqual(len(self.resolver.hosts), 2)
+
+    def test_blocked_address(self):
+        self.resolver.address = "10.0.0.1"
+        self.assertEqual(self.check("a", "b"), ["failed", "failed"])
+        # the verdict is cached too
+        self.assertEqual(self.check("c"), ["failed"])
+        self.assertEqual(len(self.resolver.hosts), 1)
+
+    def test_failed_lookup_not_cached(self):
+        self.resolver.error = socket.gaierror("no such host")
+        self.assertEqual(self.check("a"), ["failed"])
+        self.resolver.error = None
+        self.assertEqual(self.check("b"), ["complete"])
+        self.assertEqual(len(self.resolver.hosts), 2)
+
+
+class StubTask(Task):
+    # Takes items, and leaves them be until the test says otherwise.
+    def __init__(self, name="StubTask"):
+        Task.__init__(self, name)
+        self.items = []
+
+    def enqueue(self, item):
+        self.items.append(item)
+
+
+class UploadSegmentsTest(AsyncTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.project_dir = tempfile.mkdtemp()
+        cls.pipeline = load_pipeline(cls.project_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.project_dir)
+
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.temp_dir = tempfile.mkdtemp()
+        self.uploads = []
+        # (this class has a pipeline of its own to change)
+        self.pipeline["upload_task"] = self.upload_task
+
+        self.download = StubTask("DownloadMedia")
+        self.task = self.pipeline["UploadSegments"](
+            self.pipeline["UploadSlots"](1), self.download)
+        self.result = None
+        self.task.on_complete_item += lambda task, item: \
+            setattr(self, "result", "complete")
+        self.task.on_fail_item += lambda task, item: \
+            setattr(self, "result", "failed")
+
+        self.item = Item(None, "test", 1, prepare_data_directory=False)
+        self.item["item_name"] = "url:http://media.example/video.flv"
+        self.item["data_dir"] = os.path.join(self.temp_dir, "data")
+        self.item["item_dir"] = os.path.join(self.temp_dir, "item")
+        self.item["partial_dir"] = os.path.join(self.temp_dir, "partial")
+        self.item["warc_file_base"] = "twitchtv-test"
+        for key in ("data_dir", "item_dir", "partial_dir"):
+            os.makedirs(self.item[key])
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        AsyncTestCase.tearDown(self)
+
+    def upload_task(self, files, source_path):
+        # Instead of rsync: an upload that's done when the test says so.
+        upload = StubTask("Upload")
+        upload.files = files
+        self.uploads.append(upload)
+        return upload
+
+    def write_segment(self, number, size=1000):
+        path = os.path.join(self.item["partial_dir"],
+            "twitchtv-test-%05d.warc.gz" % number)
+        with open(path, "wb") as segment:
+            segment.write("x" * size)
+        return path
+
+    def finish_upload(self, upload):
+        upload.complete_item(upload.items[0])
+
+    def test_last_segment_uploaded_at_the_end(self):
+        self.task.enqueue(self.item)
+        first = self.write_segment(1)
+        self.task.scan(self.item)
+        self.assertEqual([upload.files for upload in self.uploads], [[first]])
+        self.finish_upload(self.uploads[0])
+        self.assertFalse(os.path.exists(first))
+
+        # The last segment shows up just before the download is done, with
+        # no scan in between; the item waits for it to go up.
+        last = self.write_segment(2, 500)
+        self.download.complete_item(self.item)
+        self.assertEqual(self.uploads[1].files, [last])
+        self.assertEqual(self.result, None)
+        self.finish_upload(self.uploads[1])
+        self.assertEqual(self.result, "complete")
+        self.assertFalse(os.path.exists(last))
+        self.assertEqual(self.item["segment_bytes"], 1500)
+
+    def test_failure_waits_for_uploads(self):
+        self.task.enqueue(self.item)
+        segment = self.write_segment(1)
+        self.task.scan(self.item)
+        self.download.fail_item(self.item)
+
+        # A segment that's on its way up gets there before the item fails.
+        self.assertEqual(self.result, None)
+        self.finish_upload(self.uploads[0])
+        self.assertEqual(self.result, "failed")
+        self.assertFalse(os.path.exists(segment))
+
+    def test_one_upload_at_a_time(self):
+        self.task.enqueue(self.item)
+        self.write_segment(1)
+        self.write_segment(2)
+        self.task.scan(self.item)
+        self.task.scan(self.item)
+        # (a single upload slot, and no segment goes up twice)
+        self.assertEqual(len(self.uploads), 1)
+        self.finish_upload(self.uploads[0])
+        self.assertEqual(len(self.uploads), 2)
+
+    def move_files(self):
+        self.pipeline["MoveFiles"]().process(self.item)
+        return [os.path.basename(path) for path in self.item["upload_files"]]
+
+    def placeholder(self):
+        # What PrepareDirectories leaves in the item directory.
+        path = os.path.join(self.item["item_dir"], "twitchtv-test.warc.gz")
+        open(path, "w").close()
+
+    def test_placeholder_never_uploaded(self):
+        self.placeholder()
+        self.item["segment_bytes"] = 1500
+        self.assertEqual(self.move_files(), [])
+
+    def test_leftover_segments_uploaded_with_the_item(self):
+        self.placeholder()
+        self.item["segment_bytes"] = 1000
+        self.write_segment(2)
+        self.assertEqual(self.move_files(), ["twitchtv-test-00002.warc.gz"])
+        self.assertFalse(os.path.exists(self.item["partial_dir"]))
+
+    def test_nothing_to_upload(self):
+        self.placeholder()
+        self.assertRaises(Exception, self.move_files)
+
+
+class ItemTypeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.project_dir = tempfile.mkdtemp()
+        cls.pipeline = load_pipeline(cls.project_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.project_dir)
+
+    def item(self, item_name):
+        item = Item(None, "test", 1, prepare_data_directory=False)
+        item["item_name"] = item_name
+        item["item_dir"] = self.project_dir
+        item["warc_file_base"] = "twitchtv-test"
+        return item
+
+    def test_sampled_items(self):
+        is_url_item = self.pipeline["is_url_item"]
+        is_sampled_item = self.pipeline["is_sampled_item"]
+        for item_name, url, sampled in [
+                ("video:a123:someone", False, False),
+                ("video-bulk:a123:someone", False, True),
+                ("url:http://media.example/a.flv", True, False),
+                ("url-bulk:http://media.example/a.flv", True, True)]:
+            item = self.item(item_name)
+            self.assertEqual(is_url_item(item), url, item_name)
+            self.assertEqual(is_sampled_item(item), sampled, item_name)
+
+    def test_bulk_video_downloaded_like_video(self):
+        args = self.pipeline["WgetArgs"]().realize(
+            self.item("video-bulk:a123:someone"))
+        self.assertIn("https://api.twitch.tv/kraken/videos/a123", args)
+
+    def test_sampled_video_not_segmented(self):
+        segment_size = self.pipeline["SegmentSize"](
+            self.pipeline["NumberConfigValue"](min=0, max=100000,
+                default="100", name="test:segment_size"))
+        self.assertEqual(segment_size.realize(
+            self.item("url:http://media.example/a.flv")), "100")
+        self.assertEqual(segment_size.realize(
+            self.item("url-bulk:http://media.example/a.flv")), "0")
+
+
+class VideoPageCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.project_dir = tempfile.mkdtemp()
+        cls.pipeline = load_pipeline(cls.project_dir)
+        cls.cache_path = os.path.join(cls.project_dir,
+            cls.pipeline["VIDEO_PAGE_CACHE"])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.project_dir)
+
+    def append(self, *lines):
+        # As twitchtv.lua does it.
+        with open(self.cache_path, "a") as cache_file:
+            for line in lines:
+                cache_file.write(line + "\n")
+
+    def read(self):
+        with open(self.cache_path) as cache_file:
+            return cache_file.read().splitlines()
+
+    def setUp(self):
+        self.pipeline["video_page_cache"].update(file=None, pages={})
+
+    def tearDown(self):
+        if os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+
+    def test_no_cache(self):
+        self.assertEqual(self.pipeline["cached_video_page"]("v1"), None)
+
+    def test_duplicates_tidied_up(self):
+        cached_video_page = self.pipeline["cached_video_page"]
+        self.append("v1 http://www.twitch.tv/a/a/1",
+            "v2 http://www.twitch.tv/a/b/2",
+            "v1 http://www.twitch.tv/a/c/1")
+
+        self.assertEqual(cached_video_page("v1"),
+            "http://www.twitch.tv/a/c/1")
+        self.assertEqual(cached_video_page("v2"),
+            "http://www.twitch.tv/a/b/2")
+        self.assertEqual(self.read(), ["v2 http://www.twitch.tv/a/b/2",
+            "v1 http://www.twitch.tv/a/c/1"])
+
+        # what's added later is picked up
+        self.append("v3 http://www.twitch.tv/a/c/3")
+        self.assertEqual(cached_video_page("v3"),
+            "http://www.twitch.tv/a/c/3")
+
+    def test_size_cap(self):
+        cache_size = self.pipeline["VIDEO_PAGE_CACHE_SIZE"]
+        self.pipeline["VIDEO_PAGE_CACHE_SIZE"] = 2
+        try:
+            self.append("v1 http://www.twitch.tv/a/a/1",
+                "v2 http://www.twitch.tv/a/b/2",
+                "v3 http://www.twitch.tv/a/c/3")
+            self.assertEqual(self.pipeline["cached_video_page"]("v1"), None)
+        finally:
+            self.pipeline["VIDEO_PAGE_CACHE_SIZE"] = cache_size
+        self.assertEqual(self.read(), ["v2 http://www.twitch.tv/a/b/2",
+            "v3 http://www.twitch.tv/a/c/3"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,635 @@
+# encoding=utf8
+#
+# Tests of postprocess.py on small WARCs made up on the spot. The ones that
+# sample a video need ffmpeg, which makes the video as well; without it they
+# are skipped.
+#
+#     python -m unittest discover tests
+import StringIO
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import unittest
+import zlib
+from distutils.spawn import find_executable
+
+import warc
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import postprocess
+
+VIDEO_URL = "http://www.twitch.tv/someone/b/123456789.flv"
+PAGE_URL = "http://www.twitch.tv/someone/b/123456789"
+PAGE = "<html><body>" + "a page of twitch " * 200 + "</body></html>"
+
+
+def write_warc(filename, video=None):
+    # A .warc.gz like wget makes for an item: the warcinfo, a page, the
+    # video if there is one, and the log in a metadata record. Every record
+    # is a gzip member of its own.
+    warc_file = warc.open(filename, "w")
+    warc_file.write_record(warc.WARCRecord(headers={
+        "WARC-Type": "warcinfo",
+        "Content-Type": "application/warc-fields",
+    }, payload="software: Wget/1.14.lua.20130523-9a5c\r\n"
+        "format: WARC File Format 1.0\r\n\r\n"))
+    urls = [(PAGE_URL, "text/html; charset=utf-8", PAGE)]
+    if video is not None:
+        urls.append((VIDEO_URL, "video/x-flv", video))
+    for url, content_type, body in urls:
+        warc_file.write_record(warc.WARCRecord(headers={
+            "WARC-Type": "request",
+            "WARC-Target-URI": url,
+        }, payload="GET %s HTTP/1.1\r\nHost: www.twitch.tv\r\n\r\n" % url))
+        warc_file.write_record(warc.WARCRecord(headers={
+            "WARC-Type": "response",
+            "WARC-Target-URI": url,
+        }, payload="HTTP/1.1 200 OK\r\nContent-Type: %s\r\n"
+            "Content-Length: %d\r\n\r\n%s" % (content_type, len(body), body)))
+    warc_file.write_record(warc.WARCRecord(headers={
+        "WARC-Type": "metadata",
+        "WARC-Target-URI": "metadata://gnu.org/software/wget/warc/wget.log",
+        "Content-Type": "text/plain",
+    }, payload="wget said this and that\n"))
+    warc_file.close()
+
+
+def gzip_members(filename):
+    # The raw gzip members of a .warc.gz, as (offset, bytes).
+    with open(filename, "rb") as warc_fileobj:
+        data = warc_fileobj.read()
+    members = []
+    offset = 0
+    while offset < len(data):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decompressor.decompress(data[offset:])
+        end = len(data) - len(decompressor.unused_data)
+        members.append((offset, data[offset:end]))
+        offset = end
+    return members
+
+
+def parse_record(data):
+    # The (header, block) of the one record in `data`.
+    record = warc.WARCFile(fileobj=StringIO.StringIO(data)).read_record()
+    return record.header, record.payload.read()
+
+
+def read_warc(filename):
+    records = []
+    warc_file = warc.open(filename)
+    for record in warc_file:
+        records.append((record.header, record.payload.read()))
+    warc_file.close()
+    return records
+
+
+def read_index(filename):
+    # The entries of a CDXJ index, with their SURT keys and timestamps.
+    entries = []
+    with open(filename) as index_file:
+        for line in index_file:
+            key, timestamp, entry = line.split(" ", 2)
+            entry = json.loads(entry)
+            entry["key"] = key
+            entry["timestamp"] = timestamp
+            entries.append(entry)
+    return entries
+
+
+def write_records(warc_file, records):
+    # Writes (header, block) pairs to a warc opened by open_warc_writer(),
+    # each in a gzip member or zstd frame of its own.
+    for header, block in records:
+        header = warc.WARCHeader(header, defaults=True)
+        header["Content-Length"] = str(len(block))
+        postprocess.write_record_header(warc_file, header, block)
+        warc_file.fileobj.write(block)
+        postprocess.finish_record(warc_file)
+
+
+class TempDirTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def path(self, *names):
+        return os.path.join(self.temp_dir, *names)
+
+
+class WARCMemberTest(TempDirTest):
+    def test_records(self):
+        write_warc(self.path("item.warc.gz"), video=os.urandom(600000))
+        expected = read_warc(self.path("item.warc.gz"))
+
+        records = []
+        with open(self.path("item.warc.gz"), "rb") as warc_fileobj:
+            for member in postprocess.iter_warc_members(warc_fileobj):
+                records.append((member.record.header,
+                    member.record.payload.read()))
+
+        self.assertEqual([(header["WARC-Record-ID"], block)
+            for header, block in records],
+            [(header["WARC-Record-ID"], block) for header, block in expected])
+
+    def test_copy_raw(self):
+        # Members copied as they are come out byte for byte, where they were.
+        write_warc(self.path("item.warc.gz"), video=os.urandom(600000))
+
+        copy = StringIO.StringIO()
+        offsets = []
+        with open(self.path("item.warc.gz"), "rb") as warc_fileobj:
+            for member in postprocess.iter_warc_members(warc_fileobj):
+                offsets.append(member.offset)
+                self.assertEqual(member.offset, copy.tell())
+                # (the headers are read already, and some of the block)
+                member.peek(postprocess.HTTP_HEAD_PEEK_LENGTH)
+                member.copy_raw(copy)
+
+        with open(self.path("item.warc.gz"), "rb") as warc_fileobj:
+            self.assertEqual(copy.getvalue(), warc_fileobj.read())
+        self.assertEqual(offsets, [offset for offset, data
+            in gzip_members(self.path("item.warc.gz"))])
+
+    def test_cut_short(self):
+        write_warc(self.path("item.warc.gz"), video=os.urandom(600000))
+        with open(self.path("item.warc.gz"), "rb") as warc_fileobj:
+            data = warc_fileobj.read()
+        with open(self.path("cut.warc.gz"), "wb") as warc_fileobj:
+            warc_fileobj.write(data[:-1000])
+
+        with self.assertRaises(Exception) as context:
+            postprocess.check_warc(self.path("cut.warc.gz"))
+        self.assertIn("cut short", str(context.exception))
+
+
+class WriterTest(TempDirTest):
+    # What the writers write reads back with the warc library, one record
+    # to a gzip member or zstd frame.
+    def setUp(self):
+        TempDirTest.setUp(self)
+        self.records = [
+            ({"WARC-Type": "resource", "WARC-Target-URI": "http://x/%d" % number,
+              "Content-Type": "text/plain"}, block)
+            for number, block in enumerate([
+                "small",
+                # several blocks for ParallelGzipWriter to share out
+                os.urandom(postprocess.COMPRESS_BLOCK_SIZE * 3 + 12345),
+                "",
+                "the same thing over and over " * 100000,
+            ])]
+
+    def assertRecords(self, records):
+        self.assertEqual([(header["WARC-Target-URI"], block)
+            for header, block in records],
+            [(header["WARC-Target-URI"], block)
+            for header, block in self.records])
+
+    def test_parallel_gzip(self):
+        for threads in [1, 4]:
+            filename = self.path("%d.warc.gz" % threads)
+            warc_file = postprocess.open_warc_writer(filename,
+                compress_threads=threads)
+            write_records(warc_file, self.records)
+            warc_file.close()
+
+            self.assertRecords(read_warc(filename))
+            self.assertEqual(len(gzip_members(filename)), len(self.records))
+            # gzip itself can read it too
+            gzip_file = gzip.open(filename)
+            self.assertEqual(gzip_file.read().count("WARC/1.0\r\n"),
+                len(self.records))
+            gzip_file.close()
+
+    def read_zstd_warc(self, filename, dictionary=None):
+        if dictionary:
+            decompressor = postprocess.zstandard.ZstdDecompressor(
+                dict_data=postprocess.zstandard.ZstdCompressionDict(dictionary))
+        else:
+            decompressor = postprocess.zstandard.ZstdDecompressor()
+        data = StringIO.StringIO()
+        with open(filename, "rb") as warc_fileobj:
+            decompressor.copy_stream(warc_fileobj, data)
+        warc_file = warc.WARCFile(fileobj=StringIO.StringIO(data.getvalue()))
+        records = [(record.header, record.payload.read())
+            for record in warc_file]
+        return records
+
+    @unittest.skipIf(postprocess.zstandard is None, "no zstandard module")
+    def test_zstd(self):
+        warc_file = postprocess.open_warc_writer(self.path("item.warc.zst"),
+            "zst")
+        write_records(warc_file, self.records)
+        warc_file.close()
+
+        self.assertRecords(self.read_zstd_warc(self.path("item.warc.zst")))
+
+    @unittest.skipIf(postprocess.zstandard is None, "no zstandard module")
+    def test_zstd_dictionary(self):
+        dictionary = postprocess.zstandard.train_dictionary(4096,
+            ["<html>page %d of twitch</html>\r\n" % number * 20
+            for number in range(500)]).as_bytes()
+        warc_file = postprocess.open_warc_writer(self.path("item.warc.zst"),
+            "zst", zstd_dictionary=dictionary)
+        write_records(warc_file, self.records)
+        warc_file.close()
+
+        # The dictionary comes first, in a skippable frame.
+        with open(self.path("item.warc.zst"), "rb") as warc_fileobj:
+            self.assertEqual(warc_fileobj.read(8), postprocess.struct.pack("<II",
+                postprocess.ZSTD_DICTIONARY_FRAME_MAGIC, len(dictionary)))
+            self.assertEqual(warc_fileobj.read(len(dictionary)), dictionary)
+        self.assertRecords(self.read_zstd_warc(self.path("item.warc.zst"),
+            dictionary))
+
+
+class RecordIndexTest(TempDirTest):
+    def write_indexed_warc(self, filename, compression="gz"):
+        # Rewrites a grabbed warc the way the Sampler does, copying small
+        # records as they are, and adds a record of its own.
+        write_warc(self.path("item.warc.gz"))
+        warc_file = postprocess.open_warc_writer(filename, compression)
+        warc_file.index = postprocess.RecordIndex(os.path.basename(filename))
+        with open(self.path("item.warc.gz"), "rb") as warc_fileobj:
+            for member in postprocess.iter_warc_members(warc_fileobj):
+                if compression == "gz":
+                    postprocess.write_raw_member(warc_file, member)
+                else:
+                    write_records(warc_file, [(member.record.header,
+                        member.record.payload.read())])
+        write_records(warc_file, [({"WARC-Type": "conversion",
+            "Content-Type": "video/webm",
+            "WARC-Refers-To": "<urn:uuid:something>"}, "webm")])
+        warc_file.close()
+        warc_file.index.write(self.path("item.cdxj"))
+        return read_index(self.path("item.cdxj"))
+
+    def assertOffsets(self, filename, entries, decompress):
+        with open(filename, "rb") as warc_fileobj:
+            data = warc_fileobj.read()
+        for entry in entries:
+            start = int(entry["offset"])
+            member = data[start:start + int(entry["length"])]
+            header, block = parse_record(decompress(member))
+            self.assertEqual(header["WARC-Record-ID"], entry["id"])
+            self.assertEqual(header["WARC-Type"], entry["type"])
+            self.assertEqual(header.get("WARC-Target-URI"), entry.get("url"))
+
+    def assertMimeTypes(self, entries):
+        mime_types = [(entry["type"], entry.get("url"), entry.get("mime"))
+            for entry in entries]
+        self.assertEqual(sorted(mime_types), sorted([
+            ("warcinfo", None, "application/warc-fields"),
+            ("request", PAGE_URL, None),
+            ("response", PAGE_URL, "text/html"),
+            ("metadata", "metadata://gnu.org/software/wget/warc/wget.log",
+                "text/plain"),
+            ("conversion", None, "video/webm"),
+        ]))
+
+    def test_gzip(self):
+        entries = self.write_indexed_warc(self.path("new.warc.gz"))
+
+        self.assertEqual(len(entries), 5)
+        self.assertOffsets(self.path("new.warc.gz"), entries,
+            lambda member: zlib.decompress(member, 16 + zlib.MAX_WBITS))
+        self.assertMimeTypes(entries)
+        # sorted by SURT key, records without a URL first
+        self.assertEqual([entry["key"] for entry in entries][-3:],
+            ["org,gnu)/software/wget/warc/wget.log",
+            "tv,twitch)/someone/b/123456789", "tv,twitch)/someone/b/123456789"])
+
+    @unittest.skipIf(postprocess.zstandard is None, "no zstandard module")
+    def test_zstd(self):
+        entries = self.write_indexed_warc(self.path("new.warc.zst"), "zst")
+
+        self.assertEqual(len(entries), 5)
+        # (the frames don't say how big they are, being streamed)
+        self.assertOffsets(self.path("new.warc.zst"), entries,
+            lambda frame: postprocess.zstandard.ZstdDecompressor()
+                .decompressobj().decompress(frame))
+        self.assertMimeTypes(entries)
+
+    def test_mime_type(self):
+        self.assertEqual(postprocess.record_mime_type(
+            {"Content-Type": "application/http; msgtype=response"},
+            "HTTP/1.1 200 OK\r\ncontent-type: Video/X-FLV; foo=bar\r\n\r\n"
+            "Content-Type: text/html\r\n"), "video/x-flv")
+        self.assertEqual(postprocess.record_mime_type(
+            {"Content-Type": "application/http; msgtype=response"},
+            "HTTP/1.1 304 Not Modified\r\n\r\nContent-Type: text/html\r\n"),
+            None)
+        self.assertEqual(postprocess.record_mime_type(
+            {"Content-Type": "application/x-gtar"}, "\x1f\x8b"),
+            "application/x-gtar")
+
+
+class SampleCacheTest(TempDirTest):
+    def setUp(self):
+        TempDirTest.setUp(self)
+        self.original_path = os.getcwd()
+        os.makedirs(self.path("work"))
+        os.chdir(self.path("work"))
+
+    def tearDown(self):
+        os.chdir(self.original_path)
+        TempDirTest.tearDown(self)
+
+    def cache_sample(self, cache, key, size):
+        entry_dir = cache.start()
+        sample = {"log": "%s.log" % key, "content_type": "video/webm",
+            "files": ["%s.webm" % key]}
+        with open(sample["log"], "w") as log_file:
+            log_file.write("ffmpeg said things")
+        with open(sample["files"][0], "wb") as video_file:
+            video_file.write(os.urandom(size))
+        cache.add(entry_dir, sample)
+        cache.finish(key, entry_dir, [sample])
+        os.remove(sample["log"])
+        os.remove(sample["files"][0])
+        return sample
+
+    def test_restore(self):
+        cache = postprocess.SampleCache(self.path("cache"))
+        self.assertEqual(cache.restore("one"), None)
+
+        sample = self.cache_sample(cache, "one", 1000)
+        self.assertEqual(cache.restore("one"), [sample])
+        self.assertEqual(sorted(os.listdir(".")), ["one.log", "one.webm"])
+        with open("one.webm", "rb") as video_file:
+            self.assertEqual(len(video_file.read()), 1000)
+
+    def test_empty_file(self):
+        cache = postprocess.SampleCache(self.path("cache"))
+        self.cache_sample(cache, "one", 0)
+        self.assertEqual(cache.restore("one"), None)
+
+    def test_evict(self):
+        # Least recently used goes first.
+        cache = postprocess.SampleCache(self.path("cache"), 25000)
+        self.cache_sample(cache, "one", 10000)
+        self.cache_sample(cache, "two", 10000)
+        past = time.time() - 60
+        os.utime(self.path("cache", "two"), (past, past))
+        os.utime(self.path("cache", "one"), (past + 1, past + 1))
+
+        self.cache_sample(cache, "three", 10000)
+        self.assertEqual(sorted(os.listdir(self.path("cache"))),
+            ["one", "three"])
+
+    def test_unfinished_entries(self):
+        cache = postprocess.SampleCache(self.path("cache"))
+        old_entry, new_entry = cache.start(), cache.start()
+        past = time.time() - 2 * 86400
+        os.utime(old_entry, (past, past))
+
+        cache.evict()
+        self.assertEqual(os.listdir(self.path("cache")),
+            [os.path.basename(new_entry)])
+
+
+def postprocess_command(args, log_file):
+    return subprocess.call([sys.executable,
+        os.path.join(REPO, "postprocess.py")] + args,
+        stdout=log_file, stderr=subprocess.STDOUT)
+
+
+class BatchTest(TempDirTest):
+    # Without a video in them, WARCs are done without ever running ffmpeg.
+    def setUp(self):
+        TempDirTest.setUp(self)
+        os.makedirs(self.path("grabbed"))
+        self.log_file = open(self.path("batch.log"), "w")
+
+    def tearDown(self):
+        self.log_file.close()
+        TempDirTest.tearDown(self)
+
+    def batch(self):
+        return postprocess_command(["batch", "--ffmpeg", "no-ffmpeg-here",
+            "--ffmpeg-version", "ffmpeg/test", "--jobs", "2",
+            "--output-dir", self.path("out"), self.path("grabbed")],
+            self.log_file)
+
+    def journal(self):
+        with open(self.path("out", postprocess.BATCH_JOURNAL)) as journal:
+            return sorted(line.rstrip("\n").split("\t")[:2]
+                for line in journal)
+
+    def test_resume(self):
+        write_warc(self.path("grabbed", "one.warc.gz"))
+        write_warc(self.path("grabbed", "two.warc.gz"))
+        with open(self.path("grabbed", "broken.warc.gz"), "wb") as warc_fileobj:
+            warc_fileobj.write("this is no warc")
+
+        self.assertEqual(self.batch(), 1)
+        self.assertEqual(self.journal(), [
+            ["done", self.path("grabbed", "one.warc.gz")],
+            ["done", self.path("grabbed", "two.warc.gz")],
+            ["failed", self.path("grabbed", "broken.warc.gz")],
+        ])
+        # nothing to sample, so no new warcs; the failed one left its log
+        self.assertEqual(sorted(os.listdir(self.path("out"))), [
+            "broken-POSTPROCESSED.failed.log", postprocess.BATCH_JOURNAL])
+
+        # Done ones are skipped, even if they're broken now; the failed one
+        # gets another go, and goes through this time.
+        with open(self.path("grabbed", "one.warc.gz"), "wb") as warc_fileobj:
+            warc_fileobj.write("this is no warc either")
+        write_warc(self.path("grabbed", "broken.warc.gz"))
+
+        self.assertEqual(self.batch(), 0)
+        self.assertEqual(self.journal(), [
+            ["done", self.path("grabbed", "broken.warc.gz")],
+            ["done", self.path("grabbed", "one.warc.gz")],
+            ["done", self.path("grabbed", "two.warc.gz")],
+            ["failed", self.path("grabbed", "broken.warc.gz")],
+        ])
+        self.log_file.flush()
+        with open(self.path("batch.log")) as log_file:
+            self.assertIn("3 WARCs, 2 done already, 1 to go", log_file.read())
+
+
+class SamplerTest(TempDirTest):
+    # Samples a video of a few seconds, made with ffmpeg, just big enough
+    # (postprocess.py takes any response of 5 MB or more for the video).
+    @classmethod
+    def setUpClass(cls):
+        cls.ffmpeg = find_executable("ffmpeg")
+        if cls.ffmpeg is None:
+            raise unittest.SkipTest("no ffmpeg")
+        cls.video_dir = tempfile.mkdtemp()
+        filename = os.path.join(cls.video_dir, "video.flv")
+        with open(os.devnull, "w") as null_file:
+            subprocess.check_call([cls.ffmpeg, "-nostdin", "-f", "lavfi",
+                "-i", "testsrc=size=320x240:rate=25,noise=alls=60:allf=t",
+                "-t", "4", "-c:v", "flv", "-q:v", "2", "-an", filename],
+                stdout=null_file, stderr=null_file)
+        with open(filename, "rb") as video_file:
+            cls.video = video_file.read()
+        assert len(cls.video) >= 5000000
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.video_dir)
+
+    def setUp(self):
+        TempDirTest.setUp(self)
+        self.log_file = open(self.path("sample.log"), "w")
+
+    def tearDown(self):
+        self.log_file.close()
+        TempDirTest.tearDown(self)
+
+    def sample(self, item_name, video=None, args=[]):
+        # Samples a new item's WARC, and returns the item directory.
+        item_dir = self.path(item_name.replace(":", "-"))
+        os.makedirs(item_dir)
+        write_warc(os.path.join(item_dir, "item.warc.gz"), video)
+        self.assertEqual(postprocess_command(["sample", "--ffmpeg",
+            self.ffmpeg, "--ffmpeg-version", "ffmpeg/test"] + args +
+            [item_name, item_dir, "item"], self.log_file), 0)
+        return item_dir
+
+    def log(self):
+        self.log_file.flush()
+        with open(self.log_file.name) as log_file:
+            return log_file.read()
+
+    def conversion(self, records, content_type):
+        conversions = [(header, block) for header, block in records
+            if header["WARC-Type"] == "conversion" and
+            header["Content-Type"] == content_type]
+        self.assertEqual(len(conversions), 1)
+        return conversions[0]
+
+    def snapshot_names(self, records):
+        header, block = self.conversion(records, "application/x-gtar")
+        archive = tarfile.open(fileobj=StringIO.StringIO(block), mode="r:gz")
+        return archive.getnames()
+
+    def test_sample(self):
+        item_dir = self.sample("video-bulk:v123456789", self.video)
+        self.assertEqual(sorted(os.listdir(item_dir)), ["item-POSTPROCESSED.cdxj",
+            "item-POSTPROCESSED.warc.gz", "item.warc.gz"])
+        old_warc = os.path.join(item_dir, "item.warc.gz")
+        new_warc = os.path.join(item_dir, "item-POSTPROCESSED.warc.gz")
+
+        old_records = read_warc(old_warc)
+        records = read_warc(new_warc)
+        video_header, video_block = old_records[4]
+        self.assertEqual(video_header["WARC-Target-URI"], VIDEO_URL)
+
+        # The small records are the very same gzip members as before.
+        old_members = [data for offset, data in gzip_members(old_warc)]
+        new_members = [data for offset, data in gzip_members(new_warc)]
+        for number in [1, 2, 3, 5]:
+            self.assertIn(old_members[number], new_members)
+
+        # The warcinfo says ffmpeg was there.
+        self.assertEqual(records[0][0]["WARC-Record-ID"],
+            old_records[0][0]["WARC-Record-ID"])
+        self.assertTrue(records[0][1].endswith(
+            "format: WARC File Format 1.0\r\nsoftware: ffmpeg/test\r\n\r\n"))
+
+        # The video is cut short.
+        header, block = records[4]
+        self.assertEqual(header["WARC-Record-ID"],
+            video_header["WARC-Record-ID"])
+        self.assertEqual(header["WARC-Truncated"], "length")
+        self.assertEqual(header["Content-Length"],
+            str(postprocess.TRUNCATED_BLOCK_LENGTH))
+        self.assertEqual(block,
+            video_block[:postprocess.TRUNCATED_BLOCK_LENGTH])
+
+        # The samples refer to it.
+        for content_type in ["application/x-gtar", "video/webm"]:
+            header, block = self.conversion(records, content_type)
+            self.assertEqual(header["WARC-Refers-To"],
+                video_header["WARC-Record-ID"])
+            self.assertEqual(header["WARC-Payload-Digest"],
+                "sha1:" + hashlib.sha1(block).hexdigest())
+            self.assertTrue(block)
+        self.assertTrue(self.snapshot_names(records))
+        self.assertTrue(all(name.endswith(".jpg")
+            for name in self.snapshot_names(records)))
+
+        # Every record is in the index, at the right offset, with the type
+        # of its payload.
+        entries = read_index(os.path.join(item_dir,
+            "item-POSTPROCESSED.cdxj"))
+        self.assertEqual(len(entries), len(records))
+        with open(new_warc, "rb") as warc_fileobj:
+            data = warc_fileobj.read()
+        mime_types = []
+        for entry in entries:
+            start = int(entry["offset"])
+            header, block = parse_record(zlib.decompress(
+                data[start:start + int(entry["length"])], 16 + zlib.MAX_WBITS))
+            self.assertEqual(header["WARC-Record-ID"], entry["id"])
+            mime_types.append((entry["type"], entry.get("url"),
+                entry.get("mime")))
+        self.assertIn(("response", VIDEO_URL, "video/x-flv"), mime_types)
+        self.assertIn(("response", PAGE_URL, "text/html"), mime_types)
+        self.assertIn(("request", VIDEO_URL, None), mime_types)
+        self.assertEqual(sorted(mime for record_type, url, mime in mime_types
+            if record_type == "conversion"), ["application/x-gtar",
+            "video/webm"])
+
+    def test_not_bulk(self):
+        item_dir = self.sample("video:v123456789", self.video)
+        self.assertEqual(os.listdir(item_dir), ["item.warc.gz"])
+        self.assertIn("not a -bulk item", self.log())
+
+    def test_no_video(self):
+        item_dir = self.sample("video-bulk:v123456789")
+        self.assertEqual(os.listdir(item_dir), ["item.warc.gz"])
+        self.assertIn("No video to sample", self.log())
+
+    def test_dedup(self):
+        # Everything is within 64 bits of everything else; only the first
+        # snapshot stays, and the manifest says what happened to the others.
+        item_dir = self.sample("video-bulk:v123456789", self.video,
+            ["--snapshot-dedup-distance", "64"])
+        records = read_warc(os.path.join(item_dir,
+            "item-POSTPROCESSED.warc.gz"))
+
+        names = self.snapshot_names(records)
+        self.assertEqual(names, ["images00001.jpg",
+            postprocess.SNAPSHOT_MANIFEST])
+        header, block = self.conversion(records, "application/x-gtar")
+        archive = tarfile.open(fileobj=StringIO.StringIO(block), mode="r:gz")
+        manifest = archive.extractfile(postprocess.SNAPSHOT_MANIFEST).read()
+        self.assertIn("images00002.jpg", manifest)
+        self.assertIn("images00001.jpg\n", manifest)
+
+    def test_cache(self):
+        # The second time round, the samples come out of the cache, and
+        # the records are the same as the first time.
+        args = ["--cache-dir", self.path("cache")]
+        first = read_warc(os.path.join(self.sample("video-bulk:one",
+            self.video, args), "item-POSTPROCESSED.warc.gz"))
+        self.assertNotIn("Found the samples", self.log())
+        second = read_warc(os.path.join(self.sample("video-bulk:two",
+            self.video, args), "item-POSTPROCESSED.warc.gz"))
+        self.assertIn("Found the samples of this video in the cache.",
+            self.log())
+        self.assertEqual(len(os.listdir(self.path("cache"))), 1)
+
+        def samples(records):
+            return [(header["Content-Type"], header["WARC-Payload-Digest"])
+                for header, block in records
+                if header["WARC-Type"] == "conversion"]
+        self.assertEqual(samples(first), samples(second))
+        self.assertEqual(len(samples(first)), 2)
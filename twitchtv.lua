@@ -1,6 +1,11 @@
 local url_count = 0
 local tries = 0
-local item_type = os.getenv('item_type')
+-- ("video-bulk" items are downloaded like "video" ones; they only get
+-- sampled afterwards. "url" items don't come here: download.py gets those.)
+local item_type = (string.gsub(os.getenv('item_type') or "", "%-bulk$", ""))
+local item_value = os.getenv('item_value')
+local video_page_cache = os.getenv('video_page_cache')
+local known_video_page = os.getenv('known_video_page')
 
 
 read_file = function(file)
@@ -15,31 +20,130 @@ read_file = function(file)
 end
 
 
-  
-if item_type == "url" then
-  io.stdout:write("\nDonate to the Internet Archive! Help keep the library free for millions of people.\n")
-  io.stdout:write("Visit https://archive.org/donate/ for details. (Archive Team is not affiliated with the Internet Archive.)\n")
-  io.stdout:write("\n* A video file is now being downloaded. It may take a while.. *\n\n")
-  io.stdout:flush()
+-- Requests are paced per host with a token bucket whose rate goes up a
+-- little for every second of good responses and is halved whenever the
+-- server pushes back (additive increase, multiplicative decrease), so we go
+-- as fast as Twitch lets us. LuaSocket gives us a proper clock and sleep if
+-- it's installed. Otherwise the clock is /proc/uptime, which has hundredths
+-- of a second and never goes backwards, and sleep is forked only once the
+-- wait is long enough to be worth it.
+local RATE_START = 4.0       -- requests per second
+local RATE_START_CDN = 50.0  -- images etc. go as fast as a browser would
+local RATE_MIN = 0.2
+local RATE_MAX = 50.0
+local RATE_INCREASE = 0.5    -- requests per second, every second
+local RATE_DECREASE = 0.5
+local BURST = 5.0
+local MIN_FORKED_SLEEP = 0.25  -- seconds
+local PROGRESS_INTERVAL = 1  -- seconds between progress lines
+
+local have_socket, socket = pcall(require, "socket")
+local uptime_file = not have_socket and io.open("/proc/uptime")
+local buckets = {}
+local last_progress = 0
+
+local now = function()
+  if have_socket then
+    return socket.gettime()
+  elseif uptime_file then
+    uptime_file:seek("set", 0)
+    return uptime_file:read("*n")
+  else
+    return os.time()
+  end
+end
+
+local sleep = function(seconds)
+  if have_socket then
+    socket.sleep(seconds)
+  else
+    os.execute(string.format("sleep %.2f", seconds))
+  end
+end
+
+local bucket_for = function(host)
+  local bucket = buckets[host]
+
+  if not bucket then
+    local rate = RATE_START
+
+    if string.match(host, "cdn") or string.match(host, "media") then
+      rate = RATE_START_CDN
+    end
+
+    bucket = { rate=rate, tokens=BURST, updated=now(), increased=now() }
+    buckets[host] = bucket
+  end
+
+  return bucket
+end
+
+-- Take a token for the next request to this host, waiting if there isn't
+-- one. Without LuaSocket a short wait isn't worth forking sleep for, so the
+-- bucket goes into debt instead (the tokens go below zero) until the debt
+-- adds up to a wait that is.
+local take_token = function(bucket)
+  local t = now()
+
+  bucket.tokens = math.min(BURST, bucket.tokens + (t - bucket.updated) * bucket.rate)
+  bucket.updated = t
+  bucket.tokens = bucket.tokens - 1
+
+  if bucket.tokens < 0 then
+    local wait = -bucket.tokens / bucket.rate
+
+    if have_socket or wait >= MIN_FORKED_SLEEP then
+      -- With neither LuaSocket nor /proc/uptime the clock only has whole
+      -- seconds, so wait whole seconds: the clock wouldn't see a fraction.
+      if not have_socket and not uptime_file then
+        wait = math.ceil(wait)
+      end
+
+      sleep(wait)
+      t = now()
+      bucket.tokens = math.min(BURST, bucket.tokens + (t - bucket.updated) * bucket.rate)
+      bucket.updated = t
+    end
+  end
+end
+
+-- The rate goes up with the time the host has been answering well, not
+-- with the number of answers, or a quick host would be at RATE_MAX after a
+-- few seconds. A long gap between answers counts as one second at most.
+local speed_up = function(bucket)
+  local t = now()
+
+  bucket.rate = math.min(RATE_MAX, bucket.rate + RATE_INCREASE * math.min(1, t - bucket.increased))
+  bucket.increased = t
 end
 
+local back_off = function(bucket)
+  bucket.rate = math.max(RATE_MIN, bucket.rate * RATE_DECREASE)
+  bucket.tokens = math.min(0, bucket.tokens)
+  bucket.increased = now()
+end
 
 
 wget.callbacks.httploop_result = function(url, err, http_stat)
   -- NEW for 2014: Slightly more verbose messages because people keep
   -- complaining that it's not moving or not working
   local status_code = http_stat["statcode"]
+  local bucket = bucket_for(url["host"])
 
   url_count = url_count + 1
-  io.stdout:write(url_count .. "=" .. status_code .. " " .. url["url"] .. ".  \r")
-  io.stdout:flush()
+
+  if now() - last_progress >= PROGRESS_INTERVAL then
+    last_progress = now()
+    io.stdout:write(url_count .. "=" .. status_code .. " " .. url["url"] .. ".  \r")
+    io.stdout:flush()
+  end
 
   if status_code >= 500 or
     (status_code >= 400 and status_code ~= 404) then
-    io.stdout:write("\nServer returned "..http_stat.statcode..". Sleeping.\n")
-    io.stdout:flush()
+    back_off(bucket)
 
-    os.execute("sleep 2")
+    io.stdout:write("\nServer returned "..http_stat.statcode.." for "..url["url"]..". Slowing down to "..string.format("%.1f", bucket.rate).." requests a second.\n")
+    io.stdout:flush()
 
     tries = tries + 1
 
@@ -48,25 +152,61 @@ wget.callbacks.httploop_result = function(url, err, http_stat)
       io.stdout:flush()
       return wget.actions.ABORT
     else
+      take_token(bucket)
       return wget.actions.CONTINUE
     end
   end
 
   tries = 0
 
-  -- We're okay; sleep a bit (if we have to) and continue
-  local sleep_time = 0.1 * (math.random(75, 1000) / 100.0)
+  -- We're okay; go a little faster, waiting only if we're over the rate
+  speed_up(bucket)
+  take_token(bucket)
+
+  return wget.actions.NOTHING
+end
+
+
+-- The kraken response for a video says which page it's really on, so we
+-- only fetch that one instead of trying /a/, /b/ and /c/. The answer goes
+-- in the cache for pipeline.py to use if the item comes around again.
+wget.callbacks.get_urls = function(file, url, is_css, iri)
+  local urls = {}
+
+  if item_type ~= "video" or not string.match(url, "^https?://api%.twitch%.tv/kraken/videos/") then
+    return urls
+  end
+
+  local video_id, username = string.match(item_value, "^([^:]+):(.+)$")
+  local data = read_file(file)
+  local video_page = string.match(data, '"url"%s*:%s*"(https?:[^"]+)"')
+  local preview = string.match(data, '"preview"%s*:%s*"(https?:[^"]+)"')
+
+  if video_page then
+    video_page = string.gsub(video_page, "\\/", "/")
+    table.insert(urls, { url=video_page, link_expect_html=1 })
+
+    if video_page_cache and video_page ~= known_video_page then
+      local f = io.open(video_page_cache, "a")
+      if f then
+        f:write(video_id .. " " .. video_page .. "\n")
+        f:close()
+      end
+    end
+  else
+    io.stdout:write("\nNo page URL for " .. video_id .. ". Trying them all.\n")
+    io.stdout:flush()
 
-  if string.match(url["host"], "cdn") or string.match(url["host"], "media") then
-    -- We should be able to go fast on images since that's what a web browser does
-    sleep_time = 0
+    for _, video_type in ipairs({"a", "b", "c"}) do
+      table.insert(urls, { url="http://www.twitch.tv/" .. username .. "/" .. video_type .. "/" .. string.sub(video_id, 2), link_expect_html=1 })
+    end
   end
 
-  if sleep_time > 0.001 then
-    os.execute("sleep " .. sleep_time)
+  if preview then
+    table.insert(urls, { url=string.gsub(preview, "\\/", "/") })
   end
 
-  return wget.actions.NOTHING
+  return urls
 end
 
 